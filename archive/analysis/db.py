@@ -39,6 +39,7 @@ class Paper(Base):
     doi: Mapped[Optional[str]]
     citations_added: Mapped[bool] = mapped_column(default=False)
     references_added: Mapped[bool] = mapped_column(default=False)
+    last_synced_at: Mapped[Optional[datetime.datetime]]  # set by `citeq --refresh`
 
 
 class Authorship(Base):
@@ -60,9 +61,14 @@ class Citation(Base):
     intent: Mapped[Optional[str]] = mapped_column(default="unknown")
     llm_purpose: Mapped[Optional[str]]
     sentiment: Mapped[Optional[str]]
+    self_citation: Mapped[Optional[bool]]  # computed by citeq/self_citations.py
 
 
 if os.path.exists("./citeQ.db"):
     print("Database already exists")
+    with engine.begin() as connection:
+        for table, column, column_type in [("citations", "self_citation", "BOOLEAN"), ("papers", "last_synced_at", "DATETIME")]:
+            if not any(row[1] == column for row in connection.exec_driver_sql(f"PRAGMA table_info({table})")):
+                connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
 else:
     Base.metadata.create_all(engine)
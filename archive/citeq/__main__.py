@@ -1,23 +1,43 @@
 from thefuzz import fuzz
 from typing import Tuple
-import requests
 import argparse
 import json
 import os
 import hashlib
 import asyncio
 import time
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 from PyPDF2 import PdfReader
 from db import Researcher, Paper, Authorship, Citation, engine
 from sqlalchemy.orm import Session
+from sqlalchemy import insert, update, text, func
+import datetime
 from types import SimpleNamespace
-import backoff
 from dotenv import load_dotenv
 import logging
 from tqdm import tqdm
 
 from logger import LOG_SINGLETON as LOG, trace
+from http_client import get_url, post_url, IN_FLIGHT
+from rate_limiter import RateController
 from llm_classifier import LlmClassifier, SentimentClass
+from transformer_classifier import TransformerClassifier
+from citation_metrics import CitationMetrics
+from self_citations import SelfCitationIndex
+from s2_ids import S2Ids
+from context_index import ContextEmbeddingIndex, FewShotSelector
+from cascade_classifier import CascadeClassifier
+from ensemble_classifier import EnsembleClassifier
+from context_preprocessing import ContextPreprocessor
+from ollama_pool import OllamaHostPool
+from pdf_store import PdfPipeline
+from work_queue import WorkQueue, RemoteWorkQueue, QueueCoordinator, QueueWorker
+from label_provenance import LabelProvenanceStore
+from fetch_ledger import FetchLedger
+from s2_dump import S2DumpIngestor
+from memory_guard import MemoryGuard
+from profiler import PROFILER
 
 
 def get_args() -> argparse.Namespace:
@@ -25,13 +45,44 @@ def get_args() -> argparse.Namespace:
     parser.add_argument("-n", "--name", nargs="+", help="the researcher's name", type=str)
     parser.add_argument("-a", "--alias", nargs="+", help="the researcher's alternative names", type=str)
     parser.add_argument("-i", "--institution", nargs="+", help="the researcher's last known institution", type=str)
-    parser.add_argument("-d", "--download-pdfs", help="download pdfs of papers that cite the researcher's papers", type=bool, default=False)
+    parser.add_argument("-d", "--download-pdfs", help="download pdfs of papers that cite the researcher's papers", action=argparse.BooleanOptionalAction, type=bool, default=False)
     parser.add_argument("-s", "--ss-id", help="the semantic scholar id of the researcher", type=int, default=None)
     parser.add_argument("-f", "--file", help="file to read the profs from", type=str, default=None)
     parser.add_argument("-c", "--llm-classify", help="Classify the citatiations using llm", action=argparse.BooleanOptionalAction, type=bool, default=False)
     parser.add_argument("--start", help="start value", type=int, default=None)
     parser.add_argument("--end", help="end value", type=int, default=None)
-    return parser.parse_args()
+    parser.add_argument("--llm", help="llm backend used for classification", type=str, choices=["mistral", "llama", "gpt3", "gpt4", "random"], default="mistral")
+    parser.add_argument("--build-index", help="embed all citation contexts and build the similarity index", action=argparse.BooleanOptionalAction, type=bool, default=False)
+    parser.add_argument("--few-shot", help="add the most similar annotated citations as examples to each prompt", action=argparse.BooleanOptionalAction, type=bool, default=False)
+    parser.add_argument("--constrained", help="json constrained llm output with a token budget and bounded retries", action=argparse.BooleanOptionalAction, type=bool, default=False)
+    parser.add_argument("--max-tokens", help="max generated tokens per llm call in constrained mode", type=int, default=32)
+    parser.add_argument("--max-retries", help="max retries per citation before falling back to BAD_CONTEXT", type=int, default=3)
+    parser.add_argument("--streaming", help="stream llm responses and stop generating as soon as the answer is known", action=argparse.BooleanOptionalAction, type=bool, default=False)
+    parser.add_argument("--prefix-reuse", help="keep the model loaded and reuse the evaluated instruction prompt between calls", action=argparse.BooleanOptionalAction, type=bool, default=False)
+    parser.add_argument("--ollama-hosts", nargs="+", help="ollama servers to spread classification over (default: $OLLAMA_HOSTS or the local server)", type=str, default=None)
+    parser.add_argument("--host-concurrency", help="max concurrent requests per ollama host", type=int, default=2)
+    parser.add_argument("--workers", help="number of citations classified concurrently", type=int, default=1)
+    parser.add_argument("--ensemble", help="label with the two cheapest llms and only ask --ensemble-strong when they disagree", action=argparse.BooleanOptionalAction, type=bool, default=False)
+    parser.add_argument("--ensemble-strong", help="llm that decides when the cheap models of --ensemble disagree", type=str, choices=["mistral", "llama", "gpt3", "gpt4"], default="gpt4")
+    parser.add_argument("--preprocess", help="clean contexts, trim them to --context-budget tokens and label garbage as bad context without an llm call", action=argparse.BooleanOptionalAction, type=bool, default=False)
+    parser.add_argument("--context-budget", help="token budget of a preprocessed context", type=int, default=128)
+    parser.add_argument("--cascade-threshold", help="let a tf-idf model label citations it is at least this confident about, only the rest goes to the llm", type=float, default=None)
+    parser.add_argument("--queue-init", help="split unlabelled citations into chunks of this size for queue workers", type=int, default=None)
+    parser.add_argument("--queue-serve", help="serve the classification queue over http on this port", type=int, default=None)
+    parser.add_argument("--queue-worker", help="classify chunks leased from the queue until it is empty", action=argparse.BooleanOptionalAction, type=bool, default=False)
+    parser.add_argument("--queue-url", help="url of a queue coordinator, workers use the local database otherwise", type=str, default=None)
+    parser.add_argument("--max-memory-mb", help="stop the ingestion (resumable) if the process grows beyond this many MB", type=float, default=None)
+    parser.add_argument("--s2-dump", help="load the researcher(s) from a local semantic scholar datasets dump instead of the api, see s2_dump.py", type=str, default=None)
+    parser.add_argument("--only-stale", help="only classify citations that are unlabelled or were labelled by another model or prompt", action=argparse.BooleanOptionalAction, type=bool, default=False)
+    parser.add_argument("--profile", help="write wall/cpu time per stage and sampled stacks (flamegraph) to ./profiles", action=argparse.BooleanOptionalAction, type=bool, default=False)
+    parser.add_argument("--refresh", help="compare citation counts of the researcher's papers and only re-fetch the citations of papers that changed", action=argparse.BooleanOptionalAction, type=bool, default=False)
+    parser.add_argument("--refresh-older-than", help="with --refresh, skip papers synced less than this many hours ago", type=float, default=None)
+    parser.add_argument("--exclude-self-citations", help="leave self-citations out of --metrics", action=argparse.BooleanOptionalAction, type=bool, default=False)
+    parser.add_argument("-m", "--metrics", help="compute and cache h-index, i10 and sentiment-aware metrics for all papers and researchers", action=argparse.BooleanOptionalAction, type=bool, default=False)
+    args = parser.parse_args()
+    if args.ensemble and args.cascade_threshold is not None:
+        parser.error("--ensemble and --cascade-threshold are alternative first stages, pass only one of them")
+    return args
 
 
 def is_cached_get_path(cache_key: str, filename: str) -> Tuple[bool, str]:
@@ -58,31 +109,6 @@ def is_cached_get_path(cache_key: str, filename: str) -> Tuple[bool, str]:
     return is_cached, filepath
 
 
-@backoff.on_exception(backoff.expo, requests.exceptions.RequestException, max_tries=8)
-def get_url(url, headers=None):
-    r = requests.get(url, headers=headers)
-
-    if r.status_code == 404:
-        LOG.warning(f"could not find resource at {url}")
-        return r
-    if r.status_code != 200:
-        LOG.warning(f"request failed with status code {r.status_code} - retrying")
-        raise requests.exceptions.RequestException
-
-    return r
-
-
-@backoff.on_exception(backoff.expo, requests.exceptions.RequestException, max_tries=8)
-def post_url(url, params, json):
-    r = requests.post(url, params=params, json=json)
-
-    if r.status_code != 200:
-        LOG.warning(f"request failed with status code {r.status_code} - retrying")
-        raise requests.exceptions.RequestException
-
-    return r
-
-
 class OpenAlexClient:
     @staticmethod
     def get_researcher_obj(_name: str, _alias: str, _institution: str) -> dict:
@@ -93,7 +119,7 @@ class OpenAlexClient:
         query = "https://api.openalex.org/authors?search=" + "%20".join(_name).strip().lower() + "?&per-page=200&cursor="
         cursor = "*"
         while cursor is not None:
-            response = requests.get(query + cursor).json()
+            response = get_url(query + cursor).json()
             results.extend(response["results"])
             cursor = response["meta"]["next_cursor"]
 
@@ -146,11 +172,11 @@ class OpenAlexClient:
         match_works = researcher_obj["works_api_url"]
         query = match_works + "?&per-page=200&cursor="
 
-        total = requests.get(query).json()["meta"]["count"]
+        total = get_url(query).json()["meta"]["count"]
         papers = []
         cursor = "*"
         while cursor is not None:
-            response = requests.get(query + cursor).json()
+            response = get_url(query + cursor).json()
             papers.extend(response["papers"])
             cursor = response["meta"]["next_cursor"]
             LOG.info(f"\tprogress: {len(papers)}/{total}")
@@ -187,7 +213,7 @@ class OpenAlexClient:
 
             cursor = "*"
             while cursor is not None:
-                response = requests.get(sub_query + cursor).json()  # citing paper
+                response = get_url(sub_query + cursor).json()  # citing paper
                 output.append(response)
                 cursor = response["meta"]["next_cursor"]
 
@@ -198,6 +224,8 @@ class OpenAlexClient:
 
 
 class SemanticScholarClient:
+    memory_guard = MemoryGuard()
+
     @staticmethod
     def match(args: argparse.Namespace, oa_researcher_obj: dict) -> dict:
         # open alex researcher obj:
@@ -214,7 +242,7 @@ class SemanticScholarClient:
             + "+".join(args.name).strip().lower()
             + "&fields=authorId,url,name,aliases,paperCount,citationCount,hIndex,papers.year&limit=1000"
         )
-        response = requests.get(query).json()
+        response = get_url(query).json()
         total = response["total"]
         if total <= 0:
             LOG.info(f"no results found for {args.name}")
@@ -277,7 +305,7 @@ class SemanticScholarClient:
         papers = []
         offset = None
         while (offset is None) or (offset != 0):
-            response = requests.get(query + ("" if offset is None else f"&offset={offset}")).json()
+            response = get_url(query + ("" if offset is None else f"&offset={offset}")).json()
             papers.extend(response["data"])
             offset = response["offset"]
 
@@ -286,20 +314,28 @@ class SemanticScholarClient:
         LOG.info(f"\tfound {len(papers)} papers")
 
         # get details of papers
+        # papers shared with researchers that were ingested before are skipped, their authorships are already stored (see: fetch_ledger.py)
         # send requests in batches of 400
+        paper_fields = "title,year,venue,externalIds,citationCount,authors"
+        missing_ids = FetchLedger.missing(db.session, [f"paper:{paper['paperId']}" for paper in papers if paper.get("paperId")], paper_fields)
+        missing_ids = [resource.split(":", 1)[1] for resource in missing_ids]
+        LOG.info(f"\t{len(missing_ids)} papers not fetched before")
         paper_details = []
-        for i in range(0, len(papers), 400):
-            paper_ids = [paper["paperId"] for paper in papers[i : i + 400]]
-            r = post_url("https://api.semanticscholar.org/graph/v1/paper/batch", params={"fields": "title,year,venue,externalIds,citationCount,authors"}, json={"ids": paper_ids}).json()
-            paper_details.extend(r)
+        for i in range(0, len(missing_ids), 400):
+            paper_ids = missing_ids[i : i + 400]
+            r = post_url("https://api.semanticscholar.org/graph/v1/paper/batch", params={"fields": paper_fields}, json={"ids": paper_ids}).json()
+            paper_details.extend(paper for paper in r if paper is not None)
 
         # get the author data
+        author_fields = "name,hIndex,affiliations"
         authors = []
         for paper in paper_details:
             authors.extend(paper["authors"])
         author_ids_set = set([author["authorId"] for author in authors if author["authorId"] is not None])
-        author_ids = list(author_ids_set)
-        author_details = post_url("https://api.semanticscholar.org/graph/v1/author/batch", params={"fields": "name,hIndex,affiliations"}, json={"ids": author_ids}).json()
+        author_ids = [resource.split(":", 1)[1] for resource in FetchLedger.missing(db.session, [f"author:{author_id}" for author_id in sorted(author_ids_set)], author_fields)]
+        author_details = []
+        for i in range(0, len(author_ids), 1000):
+            author_details.extend(post_url("https://api.semanticscholar.org/graph/v1/author/batch", params={"fields": author_fields}, json={"ids": author_ids[i : i + 1000]}).json())
 
         # add authors to db
         for author in author_details:
@@ -327,10 +363,13 @@ class SemanticScholarClient:
                     continue
                 db_researcher = db.session.query(Researcher).filter(Researcher.semantic_scholar_id == author["authorId"]).first()
                 if db_researcher is None:
+                    if not FetchLedger.missing(db.session, [f"author:{author['authorId']}:single"], author_fields):
+                        continue  # not found before
                     # query the author
-                    query = f"https://api.semanticscholar.org/graph/v1/author/{author['authorId']}?fields=name,hIndex,affiliations"
+                    query = f"https://api.semanticscholar.org/graph/v1/author/{author['authorId']}?fields={author_fields}"
                     result = get_url(query)
                     if result.status_code == 404:
+                        FetchLedger.record(db.session, [f"author:{author['authorId']}:single"], author_fields, status=404)
                         continue
                     ss_researcher_obj = result.json()
 
@@ -338,21 +377,42 @@ class SemanticScholarClient:
 
                 db.add_authorship(db_researcher, db_paper, i)
 
+        # papers are only recorded once their authorships are stored, an interrupted run fetches them again
+        FetchLedger.record(db.session, [f"author:{author_id}" for author_id in author_ids], author_fields)
+        FetchLedger.record(db.session, [f"paper:{paper['paperId']}" for paper in paper_details], paper_fields)
         return papers
 
+    @staticmethod
+    def refresh_citation_counts(db, researcher: Researcher, older_than_hours: float = None) -> int:
+        # delta refresh: new papers were already added by `get_papers_of_researcher` (see fetch_ledger.py),
+        # here the stored citation counts are compared in batches and only papers whose count changed are marked for `get_citations`.
+        # see: https://api.semanticscholar.org/api-docs/#tag/Paper-Data/operation/post_graph_get_papers
+        papers = db.get_papers_to_sync(researcher, older_than_hours)
+        LOG.info(f"comparing citation counts of {len(papers)} papers")
+        changed = 0
+        for i in range(0, len(papers), 500):
+            batch = papers[i : i + 500]
+            fresh = post_url("https://api.semanticscholar.org/graph/v1/paper/batch", params={"fields": "citationCount"}, json={"ids": [ss_id for _, ss_id, _ in batch]}).json()
+            counts = {}
+            for (paper_id, _, stored), paper in zip(batch, fresh):
+                if paper is not None and paper.get("citationCount") is not None and paper["citationCount"] != stored:
+                    counts[paper_id] = paper["citationCount"]
+            db.sync_papers([paper_id for paper_id, _, _ in batch], counts)
+            changed += len(counts)
+        LOG.info(f"\t{changed} papers have new citations")
+        return changed
+
     @staticmethod
     def get_citations(db, ss_researcher_obj: dict):
-        # fetch papers
-        papers = db.session.query(Paper).filter(Paper.citations_added == False).all()
+        # papers are streamed and every api page is inserted right away, so memory doesn't grow with the number of papers or citations
         headers = {"x-api-key": os.getenv("S2_API_KEY")} if os.getenv("S2_API_KEY") else None
+        total = db.session.query(Paper.id).filter(Paper.citations_added == False).count()
 
         LOG.info(f"fetching citations")
         # fetch citations of papers
         # see: https://api.semanticscholar.org/api-docs/#tag/Paper-Data/operation/get_graph_get_paper_citations
         c = 0
-        for paper in papers:
-            citations = []
-            id = paper.semantic_scholar_id
+        for paper_id, id in db.iter_papers(Paper.citations_added):
             paper_query = f"https://api.semanticscholar.org/graph/v1/paper/{id}/citations?fields=contexts,intents,paperId"
 
             # paginate through citations (also avoid rate limit)
@@ -361,32 +421,31 @@ class SemanticScholarClient:
                 ppquery = paper_query + ("" if offset == 0 else f"&offset={offset}")
                 response = get_url(ppquery, headers=headers).json()
                 assert response
-                citations.extend(response["data"])
-                offset = response.get("next")
 
-            # add citations to db
-            for citation in citations:
-                if citation.get("citingPaper") is None or citation["citingPaper"].get("paperId") is None:
-                    continue
-                for i, context in enumerate(citation["contexts"]):
-                    db_citation = db.add_citation(citation["citingPaper"]["paperId"], id, context, citation["intents"][0] if len(citation["intents"]) > 0 else None)
+                # add citations to db
+                rows = []
+                for citation in response["data"]:
+                    if citation.get("citingPaper") is None or citation["citingPaper"].get("paperId") is None:
+                        continue
+                    for context in citation["contexts"]:
+                        rows.append((citation["citingPaper"]["paperId"], id, context, citation["intents"][0] if len(citation["intents"]) > 0 else None))
+                db.add_citations(rows)
+                offset = response.get("next")
+                SemanticScholarClient.memory_guard.check(db)
 
-            db.update_paper_citations_added(paper)
-            LOG.info(f"\tprogress: {c}/{len(papers)}")
+            db.update_paper_flag(paper_id, Paper.citations_added)
+            LOG.info(f"\tprogress: {c}/{total}")
             c += 1
 
     @staticmethod
     def get_references(db, ss_researcher_obj: dict):
-        # fetch papers
-        papers = db.session.query(Paper).filter(Paper.references_added == False).all()
         headers = {"x-api-key": os.getenv("S2_API_KEY")} if os.getenv("S2_API_KEY") else None
+        total = db.session.query(Paper.id).filter(Paper.references_added == False).count()
 
         LOG.info(f"fetching references")
         # fetch references of papers
         c = 0
-        for paper in papers:
-            references = []
-            id = paper.semantic_scholar_id
+        for paper_id, id in db.iter_papers(Paper.references_added):
             paper_query = f"https://api.semanticscholar.org/graph/v1/paper/{id}/references?fields=contexts,intents,paperId"
 
             # paginate through references (also avoid rate limit)
@@ -395,46 +454,97 @@ class SemanticScholarClient:
                 ppquery = paper_query + ("" if offset == 0 else f"&offset={offset}")
                 response = get_url(ppquery, headers=headers).json()
                 assert response
-                references.extend(response["data"])
-                offset = response.get("next")
 
-            # add references to db
-            for reference in references:
-                if reference.get("citedPaper") is None or reference["citedPaper"].get("paperId") is None:
-                    continue
-                for i, context in enumerate(reference["contexts"]):
-                    db_citation = db.add_citation(id, reference["citedPaper"]["paperId"], context, reference["intents"][0] if len(reference["intents"]) > 0 else None)
+                # add references to db
+                rows = []
+                for reference in response["data"]:
+                    if reference.get("citedPaper") is None or reference["citedPaper"].get("paperId") is None:
+                        continue
+                    for context in reference["contexts"]:
+                        rows.append((id, reference["citedPaper"]["paperId"], context, reference["intents"][0] if len(reference["intents"]) > 0 else None))
+                db.add_citations(rows)
+                offset = response.get("next")
+                SemanticScholarClient.memory_guard.check(db)
 
-            db.update_paper_references_added(paper)
-            LOG.info(f"\tprogress: {c}/{len(papers)}")
+            db.update_paper_flag(paper_id, Paper.references_added)
+            LOG.info(f"\tprogress: {c}/{total}")
             c += 1
 
 
 class OllamaSentimentClassifier:
     @staticmethod
-    def classify(db, start=0, end=-1, to_csv=False):
-        row_count = db.session.query(Citation.id).count()
-        LOG.info(f"total citations: {row_count}")
+    def classify(db, start=0, end=-1, to_csv=False, llm_type="mistral", cascade_threshold=None, workers=1, only_stale=False, ensemble_strong=None):
+        # cheap first stage in front of the llm, see: cascade_classifier.py
+        cascade = None
+        if cascade_threshold is not None:
+            cascade = CascadeClassifier(threshold=cascade_threshold, llm_type=llm_type).load(db.session)
+        # or two cheap llms that only escalate disagreements, see: ensemble_classifier.py
+        ensemble = None
+        if ensemble_strong is not None:
+            ensemble = EnsembleClassifier(strong_model=ensemble_strong, workers=workers)
+            LOG.info(f"ensemble: {ensemble.cheap_models} > {ensemble.strong_model}")
+
+        # every label is stored with the model and prompt that produced it, see: label_provenance.py
+        LabelProvenanceStore.ensure_schema()
+        if cascade is not None:
+            model, prompt_fingerprint = cascade.get_provenance()
+        elif ensemble is not None:
+            model, prompt_fingerprint = ensemble.get_provenance()
+        else:
+            model, prompt_fingerprint = LlmClassifier.get_model_name(llm_type), LlmClassifier.get_prompt_fingerprint(llm_type)
+        LOG.info(f"model: {model}, prompt fingerprint: {prompt_fingerprint[:12]}")
+
+        stale_ids = None
+        if only_stale:
+            stale_ids = LabelProvenanceStore.stale_citation_ids(db.session, model, prompt_fingerprint)
+            row_count = len(stale_ids)
+            LOG.info(f"citations without an up to date label: {row_count}")
+        else:
+            row_count = db.session.query(Citation.id).count()
+            LOG.info(f"total citations: {row_count}")
         LOG.info(f"start: {start}")
         LOG.info(f"end: {end}")
 
-        if end == -1:
+        start = start or 0
+        if end is None or end == -1:
             end = row_count
+
         # fetch citations
         batch_size = 100
-        with tqdm(total=(end - start)) as tq:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        with executor, tqdm(total=(end - start)) as tq:
             for i in range(start, end, batch_size):
-                citations = db.session.query(Citation).offset(i).limit(batch_size).all()
-                for citation in citations:
-                    # if citation.llm_purpose is not None:
-                    #     continue
-                    llm_purpose = LlmClassifier.get_sentiment_class(citation.context)
+                if stale_ids is not None:
+                    citations = db.session.query(Citation).filter(Citation.id.in_(stale_ids[i : min(i + batch_size, end)])).order_by(Citation.id).all()
+                else:
+                    citations = db.session.query(Citation).offset(i).limit(batch_size).all()
+                if cascade is not None:
+                    llm_purposes = cascade.classify_batch([citation.context for citation in citations], [citation.id for citation in citations])
+                    tq.set_postfix(first_stage_coverage=f"{cascade.coverage():.1%}")
+                elif ensemble is not None:
+                    llm_purposes = ensemble.classify_batch([citation.context for citation in citations], [citation.id for citation in citations])
+                    tq.set_postfix(escalation_rate=f"{ensemble.escalation_rate():.1%}")
+                elif workers > 1:
+                    rows = [(citation.context, citation.id) for citation in citations]  # don't touch the session from worker threads
+                    llm_purposes = list(executor.map(lambda row: LlmClassifier.get_sentiment_class(row[0], llm_type, row[1]), rows))
+                else:
+                    llm_purposes = [LlmClassifier.get_sentiment_class(citation.context, llm_type, citation.id) for citation in citations]
+
+                for citation, llm_purpose in zip(citations, llm_purposes):
                     if to_csv:
                         with open("llm_purpose.csv", "a") as f:
                             f.write(f"{citation.id},{llm_purpose.name}\n")
-                    else:
-                        db.update_llm_purpose(citation, llm_purpose.name)
                     tq.update(1)
+                # the csv shards are imported into `llm_purpose` later (insert_llm_out.py), the provenance is recorded right away
+                LabelProvenanceStore.record(db.session, [(citation.id, llm_purpose.name) for citation, llm_purpose in zip(citations, llm_purposes)], model, prompt_fingerprint, update_citations=not to_csv)
+
+        LOG.info(f"llm stats: {LlmClassifier.stats.summary()}")
+        if ensemble is not None:
+            ensemble.close()
+            LOG.info(f"ensemble stats: {ensemble.summary()}")
+        if LlmClassifier.pool is not None:
+            LOG.info(f"ollama hosts: {LlmClassifier.pool.stats()}")
+            LlmClassifier.pool.close()  # stops the health checks
 
 
 class DatabaseClient:
@@ -493,7 +603,10 @@ class DatabaseClient:
         return authorship
 
     def add_citation(self, citing_paper_ss_id: str, cited_paper_ss_id: str, context: str, intent: str) -> Citation:
-        citation = self.session.query(Citation).filter(Citation.citing_paper_id == citing_paper_ss_id, Citation.cited_paper_id == cited_paper_ss_id, Citation.context == context).first()
+        [(citing_paper_ss_id, cited_paper_ss_id)] = S2Ids.encode(self.session.connection(), [(citing_paper_ss_id, cited_paper_ss_id)])
+        # compared on the decoded context: binding `context` to the column would compress it, which never matches plain text rows
+        # or rows compressed with another dictionary, see: context_compression.py
+        citation = self.session.query(Citation).filter(Citation.citing_paper_id == citing_paper_ss_id, Citation.cited_paper_id == cited_paper_ss_id, func.context_text(Citation.context) == context).first()
         if citation is not None:
             LOG.info(f"citation already exists")
             return citation
@@ -502,6 +615,75 @@ class DatabaseClient:
         self.session.commit()
         return citation
 
+    def add_citations(self, rows: list) -> int:
+        # bulk version of `add_citation` for one api page: rows of (citing ss id, cited ss id, context, intent).
+        # duplicates are checked with one query per page and the rows are inserted without creating orm objects.
+        if not rows:
+            return 0
+        rows = S2Ids.encode(self.session.connection(), rows)
+        # a page has one side in common (the cited paper for citations, the citing paper for references)
+        citing_ids, cited_ids = list({row[0] for row in rows}), list({row[1] for row in rows})
+        fixed, fixed_ids, other, other_ids = (Citation.cited_paper_id, cited_ids, Citation.citing_paper_id, citing_ids) if len(cited_ids) <= len(citing_ids) else (Citation.citing_paper_id, citing_ids, Citation.cited_paper_id, cited_ids)
+        existing = set()
+        for fixed_id in fixed_ids:
+            for i in range(0, len(other_ids), 900):
+                query = self.session.query(Citation.citing_paper_id, Citation.cited_paper_id, Citation.context).filter(fixed == fixed_id, other.in_(other_ids[i : i + 900]))
+                existing.update(query.all())
+
+        new_rows = []
+        for citing, cited, context, intent in rows:
+            if (citing, cited, context) in existing:
+                continue
+            existing.add((citing, cited, context))
+            new_rows.append({"citing_paper_id": citing, "cited_paper_id": cited, "context": context, "intent": intent, "llm_purpose": None, "sentiment": None})
+        if new_rows:
+            self.session.execute(insert(Citation), new_rows)
+        self.session.commit()
+        self.session.expunge_all()  # nothing from this page is needed anymore, keep the identity map from growing
+        return len(new_rows)
+
+    def iter_papers(self, done_flag, page_size: int = 200):
+        # yields (id, semantic scholar id) of papers whose `done_flag` is not set yet.
+        # keyset pagination instead of `.all()` or `yield_per`: the ingestion commits after every page, which would invalidate an open cursor.
+        last_id = 0
+        while True:
+            page = self.session.query(Paper.id, Paper.semantic_scholar_id).filter(done_flag == False, Paper.id > last_id).order_by(Paper.id).limit(page_size).all()
+            if not page:
+                return
+            yield from page
+            last_id = page[-1][0]
+
+    def update_paper_flag(self, paper_id: int, flag):
+        values = {flag: True}
+        if flag is Paper.citations_added:
+            values[Paper.last_synced_at] = datetime.datetime.utcnow()
+        self.session.query(Paper).filter(Paper.id == paper_id).update(values)
+        self.session.commit()
+
+    def get_papers_to_sync(self, researcher: Researcher, older_than_hours: float = None) -> list:
+        # (id, semantic scholar id, stored citation count) of the researcher's papers whose citations were fetched before
+        query = self.session.query(Paper.id, Paper.semantic_scholar_id, Paper.citation_count).join(Authorship, Authorship.paper_id == Paper.id)
+        query = query.filter(Authorship.researcher_id == researcher.id, Paper.citations_added == True)
+        if older_than_hours is not None:
+            synced_before = datetime.datetime.utcnow() - datetime.timedelta(hours=older_than_hours)
+            query = query.filter((Paper.last_synced_at == None) | (Paper.last_synced_at < synced_before))
+        return query.order_by(Paper.id).all()
+
+    def sync_papers(self, paper_ids: list, citation_counts: dict):
+        # all papers are marked as synced, papers with a new citation count (id -> count) get their citations fetched again
+        now = datetime.datetime.utcnow()
+        unchanged = [{"id": paper_id, "last_synced_at": now} for paper_id in paper_ids if paper_id not in citation_counts]
+        changed = [{"id": paper_id, "citation_count": count, "citations_added": False} for paper_id, count in citation_counts.items()]
+        if unchanged:
+            self.session.execute(update(Paper), unchanged)
+        if changed:
+            self.session.execute(update(Paper), changed)
+        self.session.commit()
+
+    def recycle_session(self):
+        self.session.close()
+        self.session = Session(engine)
+
     def update_llm_purpose(self, citation: Citation, llm_purpose: str) -> Citation:
         citation.llm_purpose = llm_purpose
         self.session.commit()
@@ -523,20 +705,95 @@ class DatabaseClient:
         self.session.commit()
         return paper
 
+    def get_citing_paper_ids(self, researcher_id: int) -> list:
+        connection = self.session.connection()
+        query = f"""
+            SELECT DISTINCT {S2Ids.endpoint(connection, "c.citing_paper_id")}
+            FROM citations c
+            JOIN papers p ON p.{S2Ids.paper_key(connection)} = c.cited_paper_id
+            JOIN authorships a ON a.paper_id = p.id
+            WHERE a.researcher_id = :researcher_id
+        """
+        return [row[0] for row in connection.execute(text(query), {"researcher_id": researcher_id}).fetchall()]
+
     def session_close(self):
         self.session.close()
 
 
+def configure_llm_classifier(args: argparse.Namespace, db: DatabaseClient):
+    LlmClassifier.constrained = args.constrained
+    LlmClassifier.streaming = args.streaming
+    LlmClassifier.prefix_reuse = args.prefix_reuse
+    LlmClassifier.max_tokens = args.max_tokens
+    LlmClassifier.max_retries = args.max_retries
+    LlmClassifier.stats.tokens_path = "llm_tokens.csv"
+    if args.ollama_hosts:
+        LlmClassifier.pool = OllamaHostPool(args.ollama_hosts, max_concurrency=args.host_concurrency)
+    else:
+        LlmClassifier.pool = OllamaHostPool.from_env(max_concurrency=args.host_concurrency)
+    if args.preprocess:
+        LlmClassifier.preprocessor = ContextPreprocessor(token_budget=args.context_budget)
+        TransformerClassifier.preprocessor = LlmClassifier.preprocessor
+    if args.few_shot:
+        LlmClassifier.example_selector = FewShotSelector(ContextEmbeddingIndex().load(), db.session)
+
+
 def main():
     load_dotenv()
     args = get_args()
     LOG.info(f"args: {args}")
     db = DatabaseClient()
+    if args.profile:
+        PROFILER.start()
+        atexit.register(PROFILER.stop)  # also covers early returns and interrupted runs
+
+    if args.metrics:
+        SelfCitationIndex.refresh(db.session)
+        CitationMetrics.refresh(db.session, exclude_self_citations=args.exclude_self_citations)
+        return
+
+    if args.build_index:
+        ContextEmbeddingIndex().build(db.session)
+        return
+
+    if args.queue_init is not None:
+        WorkQueue().init(chunk_size=args.queue_init, reset=True)
+        return
+
+    if args.queue_serve is not None:
+        QueueCoordinator(WorkQueue(), port=args.queue_serve).serve_forever()
+        return
+
+    if args.queue_worker:
+        configure_llm_classifier(args, db)
+        queue = RemoteWorkQueue(args.queue_url) if args.queue_url else WorkQueue()
+        provenance = (LlmClassifier.get_model_name(args.llm), LlmClassifier.get_prompt_fingerprint(args.llm))
+        QueueWorker(queue, lambda context, c_id: LlmClassifier.get_sentiment_class(context, args.llm, c_id), provenance=provenance).run()
+        LOG.info(f"llm stats: {LlmClassifier.stats.summary()}")
+        if LlmClassifier.pool is not None:
+            LlmClassifier.pool.close()
+        return
 
     if args.llm_classify:
-        OllamaSentimentClassifier.classify(db, start=args.start, end=args.end, to_csv=True)
+        configure_llm_classifier(args, db)
+        with PROFILER.stage("classify"):
+            OllamaSentimentClassifier.classify(db, start=args.start, end=args.end, to_csv=True, llm_type=args.llm, cascade_threshold=args.cascade_threshold, workers=args.workers, only_stale=args.only_stale, ensemble_strong=args.ensemble_strong if args.ensemble else None)
         return
 
+    if args.s2_dump is not None:
+        # targets: --ss-id or the ids in --file ("<name>,<ss id>" per line)
+        author_ids = {str(args.ss_id)} if args.ss_id is not None else set()
+        if args.file is not None:
+            author_ids |= {line.split(",")[1].strip() for line in open(args.file, "r") if "," in line}
+        S2DumpIngestor(args.s2_dump, author_ids=author_ids).run()
+        return
+
+    SemanticScholarClient.memory_guard = MemoryGuard(args.max_memory_mb)
+    FetchLedger.ensure_schema()
+
+    # pdfs of citing papers are fetched in the background while the ingestion continues
+    pdf_pipeline = PdfPipeline() if args.download_pdfs else None
+
     if args.file is not None:
         LOG.setLevel(logging.DEBUG)
         with open(args.file, "r") as f:
@@ -544,36 +801,62 @@ def main():
                 try:
                     name, ss_id = line.split(",")
                     ss_id = int(ss_id.strip())
-                    ss_researcher_obj = SemanticScholarClient.get_researcher_from_ss_id(ss_id)
+                    with PROFILER.stage("match"):
+                        ss_researcher_obj = SemanticScholarClient.get_researcher_from_ss_id(ss_id)
                     LOG.warning(f"researcher: {ss_researcher_obj}")
                     db_researcher = db.add_researcher(ss_researcher_obj)
-                    SemanticScholarClient.get_papers_of_researcher(db, ss_researcher_obj)
-                    SemanticScholarClient.get_citations(db, ss_researcher_obj)
-                    SemanticScholarClient.get_references(db, ss_researcher_obj)
+                    researcher_id = db_researcher.id  # `add_citations` detaches all orm objects
+                    with PROFILER.stage("papers"):
+                        SemanticScholarClient.get_papers_of_researcher(db, ss_researcher_obj)
+                    if args.refresh:
+                        with PROFILER.stage("refresh"):
+                            SemanticScholarClient.refresh_citation_counts(db, db_researcher, args.refresh_older_than)
+                    with PROFILER.stage("citations"):
+                        SemanticScholarClient.get_citations(db, ss_researcher_obj)
+                    if pdf_pipeline is not None:
+                        pdf_pipeline.start(db.get_citing_paper_ids(researcher_id))
+                    with PROFILER.stage("references"):
+                        SemanticScholarClient.get_references(db, ss_researcher_obj)
                 except Exception as e:
                     LOG.warning(f"error: {e}")
                     LOG.warning(f"skipping line: {line}")
                     with open("errors.txt", "a") as f:
                         f.write(line)
+        if pdf_pipeline is not None:
+            pdf_pipeline.join()
+        LOG.info(f"rate limiter stats: {RateController.stats()}, in-flight coalescing: {IN_FLIGHT.stats}, fetch ledger: {FetchLedger.stats}")
         return
 
-    if args.ss_id is not None:
-        ss_researcher_obj = SemanticScholarClient.get_researcher_from_ss_id(args.ss_id)
-    else:
-        # find researcher in openalex
-        oa_researcher_obj = OpenAlexClient.get_researcher_obj(args.name, args.alias, args.institution)
-        ss_researcher_obj = SemanticScholarClient.match(args, oa_researcher_obj)
+    with PROFILER.stage("match"):
+        if args.ss_id is not None:
+            ss_researcher_obj = SemanticScholarClient.get_researcher_from_ss_id(args.ss_id)
+        else:
+            # find researcher in openalex
+            oa_researcher_obj = OpenAlexClient.get_researcher_obj(args.name, args.alias, args.institution)
+            ss_researcher_obj = SemanticScholarClient.match(args, oa_researcher_obj)
 
     LOG.info(f"researcher: {ss_researcher_obj}")
     db_researcher = db.add_researcher(ss_researcher_obj)
+    researcher_id = db_researcher.id  # `add_citations` detaches all orm objects
     # print(json.dumps(oa_researcher_obj))
 
     # print(json.dumps(ss_researcher_obj))
     # # find citations on semantic scholar
-    SemanticScholarClient.get_papers_of_researcher(db, ss_researcher_obj)
-    SemanticScholarClient.get_citations(db, ss_researcher_obj)
-    SemanticScholarClient.get_references(db, ss_researcher_obj)
-
+    with PROFILER.stage("papers"):
+        SemanticScholarClient.get_papers_of_researcher(db, ss_researcher_obj)
+    if args.refresh:
+        with PROFILER.stage("refresh"):
+            SemanticScholarClient.refresh_citation_counts(db, db_researcher, args.refresh_older_than)
+    with PROFILER.stage("citations"):
+        SemanticScholarClient.get_citations(db, ss_researcher_obj)
+    if pdf_pipeline is not None:
+        pdf_pipeline.start(db.get_citing_paper_ids(researcher_id))
+    with PROFILER.stage("references"):
+        SemanticScholarClient.get_references(db, ss_researcher_obj)
+    if pdf_pipeline is not None:
+        pdf_pipeline.join()
+
+    LOG.info(f"rate limiter stats: {RateController.stats()}, in-flight coalescing: {IN_FLIGHT.stats}, fetch ledger: {FetchLedger.stats}")
     LOG.info(f"Done: Researcher: {ss_researcher_obj}")
 
 
@@ -1,7 +1,9 @@
 from db import Researcher, Paper, Authorship, Citation, engine
 from sqlalchemy.orm import Session
-from sqlalchemy.sql.functions import random
 from enum import Enum
+import argparse
+
+from annotation_sampler import AnnotationSampler, read_annotated_ids
 
 
 class SentimentClass(Enum):
@@ -11,22 +13,34 @@ class SentimentClass(Enum):
     BAD_CONTEXT = 3
 
 
+parser = argparse.ArgumentParser(description="annotate citations by hand")
+parser.add_argument("--mode", help="how the next citation is picked, see annotation_sampler.py", type=str, choices=["random", "stratified", "disagreement"], default="random")
+parser.add_argument("--allocation", help="stratified mode: same number of samples per stratum or proportional to its size", type=str, choices=["equal", "proportional"], default="equal")
+parser.add_argument("--first-stage", help="disagreement mode: count the tf-idf first stage of the cascade as another model", action=argparse.BooleanOptionalAction, type=bool, default=False)
+parser.add_argument("--total", help="number of annotations to reach", type=int, default=100)
+parser.add_argument("--seed", type=int, default=0)
+args = parser.parse_args()
+
 # Create a session to use the tables
 session = Session(engine)
 
 # Read the already annotated citations
-annotated_citations = []
-with open("citations_annotated.csv", "r") as f:
-    citations = f.readlines()
-    for citation in citations:
-        annotated_citations.append(citation.split(",")[0])
+annotated_citations = read_annotated_ids("citations_annotated.csv")
+
+first_stage = None
+if args.first_stage:
+    from cascade_classifier import CascadeClassifier
 
-total_annotation = 100
+    first_stage = CascadeClassifier().load(session)
 
-for i in range(len(annotated_citations), total_annotation):
-    citation = session.query(Citation).order_by(random()).first()
-    while citation.id in annotated_citations:
-        citation = session.query(Citation).order_by(random()).first()
+sampler = AnnotationSampler(session, seed=args.seed)
+candidates = sampler.order(args.mode, annotated_citations, allocation=args.allocation, first_stage=first_stage)
+
+i = len(annotated_citations)
+for c_id in candidates:
+    if i >= args.total:
+        break
+    citation = session.get(Citation, c_id)
 
     print(f"---------- Citation: {i} ----------\n")
     print(citation.context + "\n")
@@ -43,3 +57,5 @@ for i in range(len(annotated_citations), total_annotation):
         continue
     with open("citations_annotated.csv", "a") as f:
         f.write(f"{citation.id},{annotation}\n")
+    annotated_citations.add(citation.id)
+    i += 1
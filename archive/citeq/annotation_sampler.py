@@ -0,0 +1,171 @@
+import os
+import glob
+import heapq
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from db import get_dataset_version
+from s2_ids import S2Ids
+from citation_metrics import LABELS, LABEL_CODES
+from logger import LOG_SINGLETON as LOG
+
+# picks the next citation to annotate without sorting the citations table on every draw.
+# a random permutation of all citation ids (with their llm label and year) is computed once per dataset version and cached,
+# every mode below is just a different walk over it:
+#
+#   random        permutation order
+#   stratified    round robin over (llm label, year bucket) strata, so rare labels like NEGATIVE are annotated early
+#   disagreement  citations on which the available models disagree most first (active learning)
+
+SAMPLE_PATH = os.path.join(os.getcwd(), ".cache", "annotation_sample.npz")
+
+
+def read_annotated_ids(path: str = "citations_annotated.csv") -> set:
+    if not os.path.exists(path):
+        return set()
+    return {int(line.split(",")[0]) for line in open(path, "r") if line.strip()}
+
+
+def vote_entropy(votes: np.ndarray) -> np.ndarray:
+    # votes: (n, classes) summed label distributions, rows with less than two votes get -1
+    totals = votes.sum(axis=1, keepdims=True)
+    p = votes / np.maximum(totals, 1e-12)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        entropy = -np.sum(np.where(p > 0, p * np.log(p), 0.0), axis=1)
+    return np.where(totals[:, 0] >= 2, entropy, -1.0)
+
+
+class AnnotationSampler:
+    def __init__(self, session: Session, seed: int = 0, path: str = SAMPLE_PATH, year_bucket: int = 5):
+        self.session = session
+        self.seed = seed
+        self.path = path
+        self.year_bucket = year_bucket
+        self.ids = None  # permuted citation ids
+        self.labels = None  # llm label codes, -1 if unlabelled
+        self.years = None  # year of the cited paper, -1 if unknown
+        self.load()
+
+    def load(self):
+        dataset_version = get_dataset_version(self.session.connection())
+        if os.path.exists(self.path):
+            sample = np.load(self.path)
+            if str(sample["dataset_version"]) == dataset_version and int(sample["seed"]) == self.seed:
+                self.ids, self.labels, self.years = sample["ids"], sample["labels"], sample["years"]
+                return
+        self.build(dataset_version)
+
+    def build(self, dataset_version: str):
+        # one sequential scan without contexts, instead of an `ORDER BY random()` sort per draw
+        paper_key = S2Ids.paper_key(self.session.connection())
+        rows = self.session.execute(text(f"SELECT c.id, c.llm_purpose, p.year FROM citations c LEFT JOIN papers p ON p.{paper_key} = c.cited_paper_id")).fetchall()
+        ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        labels = np.fromiter((LABEL_CODES.get(row[1], -1) for row in rows), dtype=np.int8, count=len(rows))
+        years = np.fromiter((row[2] if row[2] is not None else -1 for row in rows), dtype=np.int32, count=len(rows))
+
+        order = np.random.default_rng(self.seed).permutation(len(ids))
+        self.ids, self.labels, self.years = ids[order], labels[order], years[order]
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        np.savez(self.path, ids=self.ids, labels=self.labels, years=self.years, dataset_version=dataset_version, seed=self.seed)
+        LOG.info(f"cached a random permutation of {len(ids)} citations at '{self.path}'")
+
+    def random_order(self, annotated: set):
+        for c_id in self.ids:
+            if int(c_id) not in annotated:
+                yield int(c_id)
+
+    def strata(self) -> np.ndarray:
+        year_buckets = np.where(self.years >= 0, self.years // self.year_bucket, -1)
+        return (self.labels.astype(np.int64) + 1) * 10_000 + (year_buckets + 1)
+
+    def stratified_order(self, annotated: set, allocation: str = "equal"):
+        # `equal`: every stratum gets the same number of annotations, `proportional`: strata are sampled by their size.
+        # a stratum's position in the permutation is kept, so within a stratum this is still a uniform random sample.
+        strata = self.strata()
+        grouped = np.argsort(strata, kind="stable")
+        keys, starts, sizes = np.unique(strata[grouped], return_index=True, return_counts=True)
+        is_annotated = np.fromiter((int(c_id) in annotated for c_id in self.ids), dtype=bool, count=len(self.ids))
+        done = np.bincount(np.searchsorted(keys, strata[is_annotated]), minlength=len(keys))
+
+        weights = np.ones(len(keys)) if allocation == "equal" else sizes / sizes.sum()
+        positions = starts.copy()
+        heap = [(done[i] / weights[i], i) for i in range(len(keys))]
+        heapq.heapify(heap)
+        while heap:
+            _, i = heapq.heappop(heap)
+            while positions[i] < starts[i] + sizes[i] and is_annotated[grouped[positions[i]]]:
+                positions[i] += 1
+            if positions[i] == starts[i] + sizes[i]:
+                continue  # stratum exhausted
+            row = grouped[positions[i]]
+            positions[i] += 1
+            done[i] += 1
+            heapq.heappush(heap, (done[i] / weights[i], i))
+            yield int(self.ids[row])
+
+    def read_model_labels(self, pattern: str = "llm_data/llm_purpose_*.csv") -> dict:
+        # model -> (citation ids, label codes). the csv shards are the mistral run, provenance adds every model that labelled since
+        sources = {}
+        shard_labels = {}
+        for path in sorted(glob.glob(pattern)):
+            for line in open(path, "r"):
+                parts = line.strip().split(",")
+                if len(parts) == 2 and parts[1] in LABEL_CODES:
+                    shard_labels[int(parts[0])] = LABEL_CODES[parts[1]]
+        if shard_labels:
+            sources["mistral"] = shard_labels
+
+        has_provenance = self.session.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'label_provenance'")).first() is not None
+        if has_provenance:
+            # latest label of every (citation, model) pair, later rows overwrite earlier ones
+            for c_id, model, label in self.session.execute(text("SELECT citation_id, model, label FROM label_provenance ORDER BY id")):
+                if label in LABEL_CODES:
+                    sources.setdefault(model, {})[c_id] = LABEL_CODES[label]
+
+        return {model: (np.fromiter(labels.keys(), dtype=np.int64, count=len(labels)), np.fromiter(labels.values(), dtype=np.int64, count=len(labels))) for model, labels in sources.items()}
+
+    def disagreement_scores(self, first_stage=None) -> np.ndarray:
+        # vote entropy over all models that labelled a citation, aligned with `self.ids`.
+        # `first_stage` is an optional trained `CascadeClassifier` whose probabilities count as one more (soft) vote.
+        sorted_order = np.argsort(self.ids)
+        sorted_ids = self.ids[sorted_order]
+        votes = np.zeros((len(self.ids), len(LABELS)))
+        for model, (c_ids, codes) in self.read_model_labels().items():
+            rows = np.searchsorted(sorted_ids, c_ids)
+            known = (rows < len(sorted_ids)) & (sorted_ids[np.minimum(rows, len(sorted_ids) - 1)] == c_ids)
+            np.add.at(votes, (sorted_order[rows[known]], codes[known]), 1.0)
+            LOG.info(f"{model}: {int(known.sum())} labels")
+
+        if first_stage is not None:
+            from cascade_classifier import get_contexts
+
+            candidates = np.flatnonzero(votes.sum(axis=1) >= 1)
+            for start in range(0, len(candidates), 10_000):
+                batch = candidates[start : start + 10_000]
+                contexts = get_contexts(self.session, self.ids[batch].tolist())
+                probabilities = first_stage.model.predict_proba([contexts.get(int(c_id), "") for c_id in self.ids[batch]])
+                votes[batch[:, None], first_stage.model.classes_[None, :].astype(np.int64)] += probabilities
+        return vote_entropy(votes)
+
+    def disagreement_order(self, annotated: set, first_stage=None, allocation: str = "equal"):
+        scores = self.disagreement_scores(first_stage)
+        # highest disagreement first, ties keep their random permutation order
+        yielded = False
+        for row in np.argsort(-scores, kind="stable"):
+            if scores[row] < 0:
+                break  # only citations with at least two votes
+            if int(self.ids[row]) not in annotated:
+                yielded = True
+                yield int(self.ids[row])
+        if not yielded:
+            # e.g. only the mistral shards cover the whole database, the llm_annotations_* files only the annotated citations
+            LOG.warning("no unannotated citation has labels of two models, falling back to the stratified order (see --first-stage)")
+            yield from self.stratified_order(annotated, allocation)
+
+    def order(self, mode: str, annotated: set, allocation: str = "equal", first_stage=None):
+        if mode == "stratified":
+            return self.stratified_order(annotated, allocation)
+        if mode == "disagreement":
+            return self.disagreement_order(annotated, first_stage, allocation)
+        return self.random_order(annotated)
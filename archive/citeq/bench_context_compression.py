@@ -0,0 +1,51 @@
+import os
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+
+from context_compression import ContextCodec, migrate, register
+
+# compares database size and full-scan throughput of plain and zstd compressed contexts on a copy of the database
+# usage: python citeq/bench_context_compression.py --db ./citeQ.db
+
+
+def context_bytes(connection) -> int:
+    return connection.execute("SELECT SUM(LENGTH(CAST(context AS BLOB))) FROM citations").fetchone()[0] or 0
+
+
+def scan(db_path: str, repeat: int = 3) -> tuple[float, int]:
+    # best of `repeat` full scans that materialize every context as a python string
+    best = float("inf")
+    for _ in range(repeat):
+        connection = sqlite3.connect(db_path)
+        ContextCodec.loaded = False
+        register(connection)
+        start = time.perf_counter()
+        count = sum(1 for _ in connection.execute("SELECT id, context_text(context) FROM citations"))
+        best = min(best, time.perf_counter() - start)
+        connection.close()
+    return best, count
+
+
+def report(name: str, db_path: str):
+    connection = sqlite3.connect(db_path)
+    size = context_bytes(connection)
+    connection.close()
+    elapsed, count = scan(db_path)
+    print(f"{name:>10}: file {os.path.getsize(db_path) / 2**20:8.1f} MiB, contexts {size / 2**20:8.1f} MiB, scan {elapsed:6.2f} s ({count / elapsed:,.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", type=str, default="./citeQ.db")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        copy = os.path.join(directory, "citeQ.db")
+        shutil.copyfile(args.db, copy)
+        migrate(copy, compress=False)  # baseline is plain text, even if the source is already compressed
+        report("plain", copy)
+        migrate(copy, compress=True)
+        report("zstd+dict", copy)
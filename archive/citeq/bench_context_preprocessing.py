@@ -0,0 +1,67 @@
+import time
+import argparse
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from db import engine
+from context_preprocessing import ContextPreprocessor, estimate_tokens
+from cascade_classifier import read_annotations, get_contexts
+from ensemble_classifier import read_llm_annotations
+
+# token savings of the context preprocessing on a sample of the database, and its accuracy impact on citations_annotated.csv.
+# offline, the garbage flag is scored against the human labels and substituted into the labels an llm already produced (llm_data/).
+# with --llm the annotated citations are classified again, with and without preprocessing.
+# usage: python citeq/bench_context_preprocessing.py --samples 20000 --budget 128 [--llm mistral]
+
+BAD_CONTEXT = 3
+
+
+def accuracy(predicted: dict, gold: dict) -> float:
+    return sum(predicted[c_id] == gold[c_id] for c_id in predicted) / len(predicted) if predicted else float("nan")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", type=int, default=20_000)
+    parser.add_argument("--budget", type=int, default=128)
+    parser.add_argument("--llm", type=str, default=None)
+    parser.add_argument("--llm-annotations", type=str, default="mistral", help="model of the existing llm labels, see `read_llm_annotations`")
+    args = parser.parse_args()
+
+    preprocessor = ContextPreprocessor(token_budget=args.budget)
+    session = Session(engine)
+    contexts = session.execute(text("SELECT context_text(context) FROM citations ORDER BY random() LIMIT :n"), {"n": args.samples}).scalars().all()
+
+    start = time.perf_counter()
+    results = [preprocessor.preprocess(context) for context in contexts]
+    elapsed = time.perf_counter() - start
+    before = np.array([estimate_tokens(context or "") for context in contexts])
+    after = np.array([0 if garbage else estimate_tokens(context) for context, garbage in results])
+    garbage = np.array([garbage for _, garbage in results])
+    print(f"{len(contexts)} contexts, preprocessed in {elapsed:.2f} s ({len(contexts) / max(elapsed, 1e-9):,.0f}/s)")
+    print(f"tokens per context: before mean {before.mean():.1f} p95 {np.percentile(before, 95):.0f} max {before.max()}, after mean {after.mean():.1f} p95 {np.percentile(after, 95):.0f} max {after.max()}")
+    print(f"tokens saved: {1 - after.sum() / before.sum():.1%} ({(before - after).sum():,} of {before.sum():,}), flagged as garbage: {garbage.mean():.2%}")
+
+    # accuracy impact on the human annotations
+    gold = read_annotations()
+    annotated = get_contexts(session, gold)
+    gold = {c_id: label for c_id, label in gold.items() if c_id in annotated}
+    flagged = {c_id for c_id, context in annotated.items() if preprocessor.preprocess(context)[1]}
+    print(f"\n{len(gold)} annotated citations, {len(flagged)} flagged as garbage, {sum(gold[c_id] == BAD_CONTEXT for c_id in flagged)} of them are BAD_CONTEXT in the annotations")
+    try:
+        llm_labels = {c_id: label for c_id, label in read_llm_annotations(args.llm_annotations).items() if c_id in gold}
+        with_flags = {c_id: BAD_CONTEXT if c_id in flagged else label for c_id, label in llm_labels.items()}
+        print(f"{args.llm_annotations}: accuracy {accuracy(llm_labels, gold):.2%}, with garbage flags {accuracy(with_flags, gold):.2%}")
+    except FileNotFoundError:
+        print(f"no llm annotations of {args.llm_annotations}")
+
+    if args.llm is not None:
+        from llm_classifier import LlmClassifier
+
+        for preprocess in [False, True]:
+            LlmClassifier.preprocessor = preprocessor if preprocess else None
+            start = time.perf_counter()
+            predicted = {c_id: LlmClassifier.get_sentiment_class(annotated[c_id], args.llm, c_id).value for c_id in gold}
+            print(f"{args.llm} preprocessing {'on ' if preprocess else 'off'}: accuracy {accuracy(predicted, gold):.2%}, {time.perf_counter() - start:.1f} s")
+    session.close()
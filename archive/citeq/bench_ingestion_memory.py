@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+import importlib.util
+
+# peak python heap (tracemalloc) of `SemanticScholarClient.get_citations` on a synthetic run.
+# the semantic scholar api is replaced by generated pages, so only the ingestion itself is measured.
+# usage: python citeq/bench_ingestion_memory.py --citations 100000
+
+
+class FakeResponse:
+    def __init__(self, body: dict):
+        self.body = body
+        self.status_code = 200
+
+    def json(self) -> dict:
+        return self.body
+
+
+def fake_get_url(citations_per_paper: int, page_size: int, context_length: int):
+    def get_url(url: str, headers=None):
+        paper_id = url.split("/paper/")[1].split("/")[0]
+        offset = int(url.split("&offset=")[1]) if "&offset=" in url else 0
+        count = min(page_size, citations_per_paper - offset)
+        data = [{"citingPaper": {"paperId": f"citing-{paper_id}-{offset + i}"}, "contexts": [f"{offset + i} " + "x" * context_length], "intents": ["background"]} for i in range(count)]
+        return FakeResponse({"offset": offset, "next": offset + count if offset + count < citations_per_paper else None, "data": data})
+
+    return get_url
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--citations", type=int, default=100_000)
+    parser.add_argument("--papers", type=int, default=100)
+    parser.add_argument("--page-size", type=int, default=100, help="citations per api page")
+    parser.add_argument("--context-length", type=int, default=200)
+    args = parser.parse_args()
+
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(tempfile.mkdtemp())  # db.py opens ./citeQ.db
+    sys.path.insert(0, source_dir)
+    spec = importlib.util.spec_from_file_location("citeq_cli", os.path.join(source_dir, "__main__.py"))
+    cli = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(cli)
+
+    db = cli.DatabaseClient()
+    for i in range(args.papers):
+        db.add_paper(f"paper-{i}", f"paper {i}", 2000, None, 0, None)
+    db.recycle_session()
+    cli.get_url = fake_get_url(args.citations // args.papers, args.page_size, args.context_length)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    cli.SemanticScholarClient.get_citations(db, {})
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stored = db.session.query(cli.Citation.id).count()
+    print(f"{stored} citations of {args.papers} papers in {elapsed:.1f} s ({stored / elapsed:,.0f} rows/s)")
+    print(f"tracemalloc peak {peak / 2**20:.1f} MB, rss {cli.SemanticScholarClient.memory_guard.peak_mb:.0f} MB")
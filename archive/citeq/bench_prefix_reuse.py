@@ -0,0 +1,48 @@
+import time
+import argparse
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from db import engine
+from llm_classifier import LlmClassifier
+
+# compares time-to-first-token of classification calls with and without prefix reuse
+# usage: python citeq/bench_prefix_reuse.py --samples 50 --llm mistral
+
+
+def time_to_first_token(prompt: str, llm_type: str) -> float:
+    prompt, kwargs = LlmClassifier.split_prefix(prompt, llm_type)
+    start = time.perf_counter()
+    stream = LlmClassifier.get_client(llm_type).generate_stream(prompt, options={"num_predict": 8}, **kwargs)
+    for chunk in stream:
+        if chunk.get("response"):
+            break
+    elapsed = time.perf_counter() - start
+    stream.close()
+    return elapsed
+
+
+def run(contexts: list, llm_type: str, prefix_reuse: bool) -> np.ndarray:
+    LlmClassifier.prefix_reuse = prefix_reuse
+    if prefix_reuse:
+        time_to_first_token(LlmClassifier.build_prompt(contexts[0], llm_type), llm_type)  # warm up: primes the prefix tokens
+    return np.array([time_to_first_token(LlmClassifier.build_prompt(context, llm_type), llm_type) for context in contexts])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", type=int, default=50)
+    parser.add_argument("--llm", type=str, default="mistral")
+    args = parser.parse_args()
+
+    session = Session(engine)
+    ids = [line.split(",")[0] for line in open("citations_annotated.csv", "r") if line.strip()][: args.samples]
+    contexts = session.execute(text(f"SELECT context_text(context) FROM citations WHERE id IN ({','.join(ids)})")).scalars().all()
+    session.close()
+
+    # the first request without reuse also loads the model, exclude it
+    time_to_first_token(LlmClassifier.build_prompt(contexts[0], args.llm), args.llm)
+    for prefix_reuse in [False, True]:
+        ttft = run(contexts, args.llm, prefix_reuse)
+        print(f"prefix reuse {'on ' if prefix_reuse else 'off'}: mean {ttft.mean() * 1000:.0f} ms, p50 {np.percentile(ttft, 50) * 1000:.0f} ms, p90 {np.percentile(ttft, 90) * 1000:.0f} ms ({len(ttft)} calls)")
@@ -0,0 +1,67 @@
+import time
+import random
+import asyncio
+import argparse
+import aiohttp
+import numpy as np
+
+# open-loop load test for query_service.py: requests are started at a fixed rate regardless of how fast responses come back,
+# so a slow service shows up as growing latency instead of a silently lower request rate.
+# usage: python citeq/query_service.py & python citeq/bench_query_service.py --rate 200 --duration 30
+
+
+async def get_targets(session: aiohttp.ClientSession, url: str, max_researchers: int = 200) -> list[str]:
+    async with session.get(f"{url}/researchers", params={"limit": max_researchers}) as r:
+        researchers = [item["semantic_scholar_id"] for item in (await r.json())["items"]]
+    targets = [f"{url}/venues", f"{url}/years", f"{url}/researchers?offset=0&limit=100"]
+    for researcher in researchers:
+        targets += [f"{url}/researchers/{researcher}", f"{url}/researchers/{researcher}/papers"]
+    return targets
+
+
+async def timed_get(session: aiohttp.ClientSession, target: str, latencies: list, errors: list):
+    start = time.perf_counter()
+    try:
+        async with session.get(target) as r:
+            await r.read()
+            if r.status != 200:
+                errors.append(r.status)
+                return
+    except aiohttp.ClientError as e:
+        errors.append(type(e).__name__)
+        return
+    latencies.append(time.perf_counter() - start)
+
+
+async def run(url: str, rate: float, duration: float, seed: int = 0):
+    rng = random.Random(seed)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        targets = await get_targets(session, url)
+        latencies, errors, tasks = [], [], []
+        start = time.perf_counter()
+        for i in range(int(rate * duration)):
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(timed_get(session, rng.choice(targets), latencies, errors)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+        async with session.get(f"{url}/stats") as r:
+            stats = await r.json()
+
+    latencies = np.array(latencies) * 1000
+    print(f"{len(tasks)} requests in {elapsed:.1f} s ({len(tasks) / elapsed:.0f} req/s, target {rate:.0f} req/s), {len(errors)} errors")
+    if len(latencies):
+        print(f"latency p50 {np.percentile(latencies, 50):.1f} ms, p99 {np.percentile(latencies, 99):.1f} ms, max {latencies.max():.1f} ms")
+    print(f"cache: {stats['cache_hits']} hits, {stats['cache_misses']} misses")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8080")
+    parser.add_argument("--rate", type=float, default=100, help="requests per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    args = parser.parse_args()
+    asyncio.run(run(args.url.rstrip("/"), args.rate, args.duration))
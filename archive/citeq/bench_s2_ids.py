@@ -0,0 +1,99 @@
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from sqlalchemy import create_engine, event, text
+
+from context_compression import register
+from s2_ids import S2Ids, migrate
+
+# compares semantic scholar ids and interned integer keys as citation endpoints on a copy of the database:
+# file size, join latency of the read paths and insert rate of api pages (including the interning).
+# both copies get the same index on `citations.cited_paper_id`, so only the key representation differs.
+# usage: python citeq/bench_s2_ids.py --db ./citeQ.db --inserts 20000
+
+
+def open_engine(db_path: str):
+    engine = create_engine(f"sqlite+pysqlite:///{db_path}")
+    event.listen(engine, "connect", register)
+    return engine
+
+
+def endpoint_bytes(connection) -> int:
+    return connection.execute(text("SELECT SUM(LENGTH(CAST(citing_paper_id AS BLOB)) + LENGTH(CAST(cited_paper_id AS BLOB))) FROM citations")).scalar() or 0
+
+
+def join_queries(connection) -> dict:
+    key = S2Ids.paper_key(connection)
+    researcher_id = connection.execute(text("SELECT researcher_id FROM authorships GROUP BY researcher_id ORDER BY COUNT(*) DESC LIMIT 1")).scalar()
+    return {
+        "join only": (f"SELECT COUNT(*) FROM citations c JOIN papers p ON p.{key} = c.cited_paper_id", {}),
+        "metrics": (f"SELECT p.id, c.citing_paper_id, c.llm_purpose FROM citations c JOIN papers p ON p.{key} = c.cited_paper_id", {}),
+        "researchers": (f"SELECT a.researcher_id, COUNT(c.id), SUM(c.llm_purpose = 'NEGATIVE') FROM authorships a JOIN papers p ON p.id = a.paper_id LEFT JOIN citations c ON c.cited_paper_id = p.{key} GROUP BY a.researcher_id", {}),
+        "citing papers": (
+            f"SELECT DISTINCT {S2Ids.endpoint(connection, 'c.citing_paper_id')} FROM citations c JOIN papers p ON p.{key} = c.cited_paper_id JOIN authorships a ON a.paper_id = p.id WHERE a.researcher_id = :r",
+            {"r": researcher_id},
+        ),
+    }
+
+
+def time_joins(engine, repeat: int = 3) -> dict:
+    # best of `repeat` runs of each query, fetching all rows
+    timings = {}
+    with engine.connect() as connection:
+        for name, (query, params) in join_queries(connection).items():
+            best = float("inf")
+            for _ in range(repeat):
+                start = time.perf_counter()
+                connection.execute(text(query), params).fetchall()
+                best = min(best, time.perf_counter() - start)
+            timings[name] = best
+    return timings
+
+
+def insert_rate(engine, num_rows: int, page_size: int = 1000, seed: int = 0) -> float:
+    # api pages like `add_citations`: one cited paper per page, citing papers are half known, half new (stub rows)
+    rng = random.Random(seed)
+    with engine.connect() as connection:
+        papers = [row[0] for row in connection.execute(text("SELECT semantic_scholar_id FROM papers"))]
+        start = time.perf_counter()
+        for i in range(0, num_rows, page_size):
+            cited = rng.choice(papers)
+            rows = [(rng.choice(papers) if rng.random() < 0.5 else f"{rng.getrandbits(160):040x}", cited, f"benchmark context {i + j}", "background") for j in range(min(page_size, num_rows - i))]
+            rows = S2Ids.encode(connection, rows)
+            connection.execute(text("INSERT INTO citations (citing_paper_id, cited_paper_id, context, intent) VALUES (:citing, :cited, :context, :intent)"), [{"citing": r[0], "cited": r[1], "context": r[2], "intent": r[3]} for r in rows])
+            connection.commit()
+        return num_rows / (time.perf_counter() - start)
+
+
+def report(name: str, db_path: str, num_inserts: int):
+    engine = open_engine(db_path)
+    with engine.connect() as connection:
+        endpoints = endpoint_bytes(connection)
+    joins = time_joins(engine)
+    size = os.path.getsize(db_path)
+    rate = insert_rate(engine, num_inserts)
+    engine.dispose()
+    print(f"{name:>9}: file {size / 2**20:8.1f} MiB, endpoints {endpoints / 2**20:7.1f} MiB, inserts {rate:,.0f} rows/s")
+    print("           joins: " + ", ".join(f"{query} {seconds * 1000:.1f} ms" for query, seconds in joins.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", type=str, default="./citeQ.db")
+    parser.add_argument("--inserts", type=int, default=20_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name, intern in [("plain", False), ("interned", True)]:
+            # a fresh copy per mode, the insert benchmark writes to it
+            copy = os.path.join(directory, f"{name}.db")
+            shutil.copyfile(args.db, copy)
+            migrate(copy, intern=intern)  # the baseline is plain, even if the source is already interned
+            engine = open_engine(copy)
+            with engine.begin() as connection:
+                connection.execute(text("CREATE INDEX IF NOT EXISTS ix_citations_cited_paper_id ON citations (cited_paper_id)"))
+            engine.dispose()
+            report(name, copy, args.inserts)
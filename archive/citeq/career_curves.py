@@ -0,0 +1,149 @@
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from db import engine, get_dataset_version
+from citation_metrics import LABELS, negativity_rate
+from s2_ids import S2Ids
+from logger import LOG_SINGLETON as LOG
+
+# sentiment curves over the careers of a cohort of researchers, replaces the "n-th paper of each professor" loop in the notebook.
+# papers are numbered per researcher with a window function, then all curves are aggregated in a single pass:
+#
+#   ordinal       n-th paper of a researcher, ordered by (year, paper id) like in the notebook
+#   year          publication year
+#   career_year   years since the researcher's first paper
+#
+# a cohort is a dict, e.g. {"institution": "Waterloo"} or {"semantic_scholar_ids": ["1741101"]} or {"where": "r.waterloo_prof = 1"}.
+# results are cached in .cache/career_curves per cohort definition and dataset version.
+# with `exclude_self_citations` citations flagged by self_citations.py are left out.
+
+CACHE_DIR = os.path.join(os.getcwd(), ".cache", "career_curves")
+CURVES = ["ordinal", "year", "career_year"]
+
+# "received": sentiment of citations to the cohort's papers (like citation_metrics.py),
+# "given": sentiment of the cohort's papers towards the work they cite (the join used in the notebook)
+DIRECTIONS = {"received": ("cited_paper_id", "citing_paper_id"), "given": ("citing_paper_id", "cited_paper_id")}
+
+
+def cohort_filter(cohort: dict) -> tuple[str, dict]:
+    clauses, params = [], {}
+    if cohort.get("researcher_ids"):
+        clauses.append(f"r.id IN ({', '.join(str(int(i)) for i in cohort['researcher_ids'])})")
+    if cohort.get("semantic_scholar_ids"):
+        keys = [f":ss_id_{i}" for i in range(len(cohort["semantic_scholar_ids"]))]
+        clauses.append(f"r.semantic_scholar_id IN ({', '.join(keys)})")
+        params.update({key[1:]: str(ss_id) for key, ss_id in zip(keys, cohort["semantic_scholar_ids"])})
+    if cohort.get("institution"):
+        clauses.append("r.institution LIKE :institution")
+        params["institution"] = f"%{cohort['institution']}%"
+    if cohort.get("where"):
+        clauses.append(f"({cohort['where']})")  # trusted input, e.g. columns that only exist in the analysis schema
+    return " AND ".join(clauses) or "1 = 1", params
+
+
+def cohort_key(cohort: dict, direction: str, dataset_version: str, exclude_self_citations: bool = False) -> str:
+    definition = json.dumps({"cohort": cohort, "direction": direction, "dataset_version": dataset_version, "exclude_self_citations": exclude_self_citations}, sort_keys=True)
+    return hashlib.sha256(definition.encode("utf-8")).hexdigest()
+
+
+class CareerCurves:
+    @staticmethod
+    def load_paper_rows(connection, cohort: dict, direction: str = "received", exclude_self_citations: bool = False) -> dict:
+        # one row per (researcher, paper) with its position in the career and the label counts of its citations
+        own_column, _ = DIRECTIONS[direction]
+        where, params = cohort_filter(cohort)
+        label_columns = ", ".join(f"COALESCE(SUM(c.llm_purpose = '{label}'), 0)" for label in LABELS)
+        query = f"""
+            WITH cohort_papers AS (
+                SELECT a.researcher_id, p.{S2Ids.paper_key(connection)} AS paper_key, p.year,
+                       ROW_NUMBER() OVER (PARTITION BY a.researcher_id ORDER BY p.year, p.id) - 1 AS ordinal,
+                       p.year - MIN(p.year) OVER (PARTITION BY a.researcher_id) AS career_year
+                FROM researchers r
+                JOIN authorships a ON a.researcher_id = r.id
+                JOIN papers p ON p.id = a.paper_id
+                WHERE p.year IS NOT NULL AND {where}
+            ),
+            paper_labels AS (
+                SELECT c.{own_column} AS paper_key, {label_columns}
+                FROM citations c
+                WHERE c.{own_column} IN (SELECT paper_key FROM cohort_papers){" AND c.self_citation IS NOT 1" if exclude_self_citations else ""}
+                GROUP BY c.{own_column}
+            )
+            SELECT cp.researcher_id, cp.ordinal, cp.year, cp.career_year, pl.*
+            FROM cohort_papers cp
+            LEFT JOIN paper_labels pl ON pl.paper_key = cp.paper_key
+        """
+        rows = connection.execute(text(query), params).fetchall()
+        columns = {"researcher_id": 0, "ordinal": 1, "year": 2, "career_year": 3}
+        result = {name: np.fromiter((row[i] for row in rows), dtype=np.int64, count=len(rows)) for name, i in columns.items()}
+        for j, label in enumerate(LABELS):
+            result[label.lower()] = np.fromiter((row[5 + j] or 0 for row in rows), dtype=np.int64, count=len(rows))
+        return result
+
+    @staticmethod
+    def aggregate(rows: dict, curve: str) -> dict:
+        if len(rows[curve]) == 0:
+            return {"x": [], "paper_count": [], "researcher_count": []}
+        offset = int(rows[curve].min())
+        bins = rows[curve] - offset
+        size = int(bins.max()) + 1
+        result = {"x": list(range(offset, offset + size)), "paper_count": np.bincount(bins, minlength=size)}
+        # researchers that reached this point of the curve, i.e. contribute to it
+        pairs = np.unique(np.stack([rows["researcher_id"], bins]), axis=1)
+        result["researcher_count"] = np.bincount(pairs[1], minlength=size)
+        for label in LABELS:
+            result[label.lower()] = np.bincount(bins, weights=rows[label.lower()], minlength=size).astype(np.int64)
+        result["negativity_rate"] = negativity_rate(result["positive"], result["negative"], result["neutral"])
+
+        # only keep populated points, years without papers would otherwise show up as zeros
+        populated = result["paper_count"] > 0
+        return {key: [None if isinstance(v, float) and np.isnan(v) else v for v in np.asarray(value)[populated].tolist()] for key, value in result.items()}
+
+    @staticmethod
+    def compute(connection, cohort: dict, direction: str = "received", exclude_self_citations: bool = False) -> dict:
+        rows = CareerCurves.load_paper_rows(connection, cohort, direction, exclude_self_citations)
+        curves = {curve: CareerCurves.aggregate(rows, curve) for curve in CURVES}
+        curves["researchers"] = int(len(np.unique(rows["researcher_id"])))
+        return curves
+
+    @staticmethod
+    def get(session: Session, cohort: dict, direction: str = "received", cache_dir: str = CACHE_DIR, exclude_self_citations: bool = False) -> dict:
+        dataset_version = get_dataset_version(session.connection())
+        path = os.path.join(cache_dir, f"{cohort_key(cohort, direction, dataset_version, exclude_self_citations)}.json")
+        if os.path.exists(path):
+            return json.load(open(path, "r"))
+
+        LOG.info(f"computing career curves for {cohort} ({direction})")
+        curves = CareerCurves.compute(session.connection(), cohort, direction, exclude_self_citations)
+        curves.update({"cohort": cohort, "direction": direction, "dataset_version": dataset_version, "exclude_self_citations": exclude_self_citations})
+        os.makedirs(cache_dir, exist_ok=True)
+        json.dump(curves, open(path, "w"))
+        return curves
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="sentiment curves over the careers of a cohort")
+    parser.add_argument("--institution", type=str, default=None)
+    parser.add_argument("--ss-ids", nargs="+", type=str, default=None)
+    parser.add_argument("--where", help="sql condition on researchers r", type=str, default=None)
+    parser.add_argument("--direction", type=str, choices=list(DIRECTIONS), default="received")
+    parser.add_argument("--curve", type=str, choices=CURVES, default="ordinal")
+    parser.add_argument("--exclude-self-citations", action=argparse.BooleanOptionalAction, type=bool, default=False)
+    args = parser.parse_args()
+
+    cohort = {key: value for key, value in {"institution": args.institution, "semantic_scholar_ids": args.ss_ids, "where": args.where}.items() if value}
+    session = Session(engine)
+    curves = CareerCurves.get(session, cohort, args.direction, exclude_self_citations=args.exclude_self_citations)
+    session.close()
+
+    curve = curves[args.curve]
+    print(f"{curves['researchers']} researchers")
+    print(f"{args.curve:>12} {'papers':>7} {'authors':>7} {'positive':>8} {'negative':>8} {'neutral':>8} {'bad':>6} {'neg rate':>8}")
+    for i, x in enumerate(curve["x"]):
+        rate = curve["negativity_rate"][i]
+        print(f"{x:>12} {curve['paper_count'][i]:>7} {curve['researcher_count'][i]:>7} {curve['positive'][i]:>8} {curve['negative'][i]:>8} {curve['neutral'][i]:>8} {curve['bad_context'][i]:>6} {'-' if rate is None else f'{rate:.2%}':>8}")
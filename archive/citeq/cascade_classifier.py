@@ -0,0 +1,138 @@
+import os
+import glob
+import pickle
+import hashlib
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import make_pipeline
+
+from db import engine
+from logger import LOG_SINGLETON as LOG
+from llm_classifier import LlmClassifier, SentimentClass
+
+MODEL_PATH = os.path.join(os.getcwd(), ".cache", "cascade-tfidf-logreg.pkl")
+
+
+def read_llm_labels(pattern: str = "llm_data/llm_purpose_*.csv") -> dict:
+    # shards written by `OllamaSentimentClassifier.classify`: "<citation id>,<SentimentClass name>"
+    labels = {}
+    for path in sorted(glob.glob(pattern)):
+        for line in open(path, "r"):
+            c_id, label = line.strip().split(",")
+            labels[int(c_id)] = SentimentClass[label].value
+    return labels
+
+
+def read_annotations(path: str = "citations_annotated.csv") -> dict:
+    return {int(row[0]): int(row[1]) for row in (line.strip().split(",") for line in open(path, "r") if line.strip())}
+
+
+def get_contexts(session: Session, ids) -> dict:
+    contexts = {}
+    ids = list(ids)
+    for i in range(0, len(ids), 900):  # stay below sqlite's bound parameter limit
+        batch = ids[i : i + 900]
+        rows = session.execute(text(f"SELECT id, context_text(context) FROM citations WHERE id IN ({','.join(str(c) for c in batch)})")).fetchall()
+        contexts.update({row[0]: row[1] or "" for row in rows})
+    return contexts
+
+
+class CascadeClassifier:
+    # first stage: a linear model over tf-idf features, trained on the labels the llm already produced.
+    # it only commits to a label if its probability reaches `threshold`, everything else is passed on to the llm.
+    # see: https://scikit-learn.org/stable/modules/generated/sklearn.linear_model.LogisticRegression.html
+
+    def __init__(self, threshold: float = 0.9, llm_type: str = "mistral", model_path: str = MODEL_PATH):
+        self.threshold = threshold
+        self.llm_type = llm_type
+        self.model_path = model_path
+        self.model = None
+        self.committed = 0
+        self.escalated = 0
+
+    def train(self, session: Session, max_samples: int = 200_000, exclude: set = None):
+        labels = read_llm_labels()
+        exclude = exclude if exclude is not None else set(read_annotations())
+        ids = [c_id for c_id in labels if c_id not in exclude]  # never train on the evaluation set
+        if len(ids) > max_samples:
+            ids = list(np.random.default_rng(0).choice(ids, size=max_samples, replace=False))
+        contexts = get_contexts(session, ids)
+        ids = [c_id for c_id in ids if c_id in contexts]
+        LOG.info(f"training first stage on {len(ids)} llm labelled citations")
+
+        self.model = make_pipeline(TfidfVectorizer(ngram_range=(1, 2), min_df=3, max_features=200_000, sublinear_tf=True), LogisticRegression(max_iter=1000))
+        self.model.fit([contexts[c_id] for c_id in ids], [labels[c_id] for c_id in ids])
+
+        os.makedirs(os.path.dirname(self.model_path), exist_ok=True)
+        pickle.dump(self.model, open(self.model_path, "wb"))
+        LOG.info(f"first stage model cached at '{self.model_path}'")
+        return self
+
+    def load(self, session: Session = None):
+        if os.path.exists(self.model_path):
+            self.model = pickle.load(open(self.model_path, "rb"))
+            return self
+        assert session is not None, "no trained first stage model found"
+        return self.train(session)
+
+    def predict_first_stage(self, contexts: list) -> tuple[np.ndarray, np.ndarray]:
+        probabilities = self.model.predict_proba(contexts)
+        best = np.argmax(probabilities, axis=1)
+        return self.model.classes_[best], probabilities[np.arange(len(contexts)), best]
+
+    def classify_batch(self, contexts: list, citation_ids: list = None) -> list[SentimentClass]:
+        labels, confidences = self.predict_first_stage(contexts)
+        results = []
+        for i, context in enumerate(contexts):
+            if confidences[i] >= self.threshold:
+                self.committed += 1
+                results.append(SentimentClass(int(labels[i])))
+            else:
+                self.escalated += 1
+                results.append(LlmClassifier.get_sentiment_class(context, self.llm_type, citation_ids[i] if citation_ids else None))
+        return results
+
+    def get_provenance(self) -> tuple[str, str]:
+        # labels of a cascade run come from either stage, so they are attributed to the combination
+        fingerprint = f"{LlmClassifier.get_prompt_fingerprint(self.llm_type)}:{self.threshold}:{os.path.getmtime(self.model_path) if os.path.exists(self.model_path) else 0}"
+        return f"cascade-tfidf+{LlmClassifier.get_model_name(self.llm_type)}", hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+
+    def coverage(self) -> float:
+        total = self.committed + self.escalated
+        return self.committed / total if total > 0 else 0.0
+
+    def report(self, session: Session, llm_annotations_path: str = "llm_data/llm_annotations_mistral.csv", thresholds=(0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.99)) -> list[dict]:
+        # coverage/accuracy tradeoff on the human annotations.
+        # the cascade accuracy assumes the llm labels from `llm_annotations_path` ("<id>,<gold>,<predicted>") for escalated citations.
+        gold = read_annotations()
+        llm_predictions = {int(row[0]): int(row[2]) for row in (line.strip().split(",") for line in open(llm_annotations_path, "r") if line.strip())}
+        contexts = get_contexts(session, gold)
+        ids = [c_id for c_id in gold if c_id in contexts]
+        labels, confidences = self.predict_first_stage([contexts[c_id] for c_id in ids])
+        gold_labels = np.array([gold[c_id] for c_id in ids])
+        llm_labels = np.array([llm_predictions.get(c_id, -1) for c_id in ids])
+
+        rows = []
+        LOG.info(f"{'threshold':>9} {'coverage':>8} {'stage-1 acc':>11} {'cascade acc':>11} {'llm-only acc':>12}")
+        for threshold in thresholds:
+            committed = confidences >= threshold
+            cascade_labels = np.where(committed, labels, llm_labels)
+            row = {
+                "threshold": threshold,
+                "coverage": float(committed.mean()) if len(ids) else 0.0,
+                "first_stage_accuracy": float((labels[committed] == gold_labels[committed]).mean()) if committed.any() else float("nan"),
+                "cascade_accuracy": float((cascade_labels == gold_labels).mean()) if len(ids) else float("nan"),
+                "llm_accuracy": float((llm_labels == gold_labels).mean()) if len(ids) else float("nan"),
+            }
+            rows.append(row)
+            LOG.info(f"{threshold:>9.2f} {row['coverage']:>8.2%} {row['first_stage_accuracy']:>11.2%} {row['cascade_accuracy']:>11.2%} {row['llm_accuracy']:>12.2%}")
+        return rows
+
+
+if __name__ == "__main__":
+    session = Session(engine)
+    CascadeClassifier().train(session).report(session)
+    session.close()
@@ -0,0 +1,175 @@
+import numpy as np
+from sqlalchemy import text, delete, insert, select, or_
+from sqlalchemy.orm import Session
+
+from db import ResearcherMetrics, PaperMetrics, engine, get_dataset_version, create_missing_tables
+from s2_ids import S2Ids
+from logger import LOG_SINGLETON as LOG
+
+# order matches the `SentimentClass` enum in llm_classifier.py, unlabelled citations are -1
+LABELS = ["POSITIVE", "NEGATIVE", "NEUTRAL", "BAD_CONTEXT"]
+LABEL_CODES = {label: code for code, label in enumerate(LABELS)}
+NEGATIVE = LABEL_CODES["NEGATIVE"]
+
+
+def load_citation_arrays(connection, exclude_self_citations: bool = False) -> dict:
+    # only citations of papers in our dataset are relevant, the citing paper is usually not in the `papers` table
+    rows = connection.execute(
+        text(
+            f"""
+            SELECT p.id, c.citing_paper_id, c.llm_purpose
+            FROM citations c
+            JOIN papers p ON p.{S2Ids.paper_key(connection)} = c.cited_paper_id
+            {"WHERE c.self_citation IS NOT 1" if exclude_self_citations else ""}
+            """
+        )
+    ).fetchall()
+    cited = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    _, citing = np.unique(np.array([row[1] for row in rows], dtype=object), return_inverse=True)
+    labels = np.fromiter((LABEL_CODES.get(row[2], -1) for row in rows), dtype=np.int8, count=len(rows))
+    return {"cited": cited, "citing": citing.astype(np.int64), "labels": labels}
+
+
+def load_authorship_arrays(connection) -> dict:
+    rows = connection.execute(text("SELECT researcher_id, paper_id FROM authorships")).fetchall()
+    researchers = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    papers = np.fromiter((row[1] for row in rows), dtype=np.int64, count=len(rows))
+    return {"researchers": researchers, "papers": papers}
+
+
+def grouped_h_index(groups: np.ndarray, values: np.ndarray, minlength: int) -> np.ndarray:
+    # sort by group, then by value descending – the h-index of a group is the number of rows whose value is >= their 1-based rank
+    # see: https://en.wikipedia.org/wiki/H-index#Calculation
+    if len(groups) == 0:
+        return np.zeros(minlength, dtype=np.int64)
+    order = np.lexsort((-values, groups))
+    sorted_groups = groups[order]
+    sorted_values = values[order]
+    group_starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    group_sizes = np.diff(np.r_[group_starts, len(sorted_groups)])
+    ranks = np.arange(len(sorted_groups)) - np.repeat(group_starts, group_sizes) + 1
+    return np.bincount(sorted_groups, weights=sorted_values >= ranks, minlength=minlength).astype(np.int64)
+
+
+def negativity_rate(positive: np.ndarray, negative: np.ndarray, neutral: np.ndarray) -> np.ndarray:
+    # bad contexts are excluded, just like in the analysis notebook
+    total = positive + negative + neutral
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(total > 0, negative / np.maximum(total, 1), np.nan)
+
+
+class CitationMetrics:
+    @staticmethod
+    def compute_paper_metrics(citations: dict, num_papers: int) -> dict:
+        cited, citing, labels = citations["cited"], citations["citing"], citations["labels"]
+
+        # per-context label counts
+        counts = {label.lower(): np.bincount(cited, weights=labels == code, minlength=num_papers).astype(np.int64) for label, code in LABEL_CODES.items()}
+
+        # a citing paper can cite the same paper in several contexts: dedupe (cited, citing) pairs with a single sort.
+        # a pair counts as negative if any of its contexts is negative.
+        num_citing = int(citing.max()) + 1 if len(citing) > 0 else 1
+        keys = cited * num_citing + citing
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        pair_starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]) if len(keys) > 0 else np.zeros(0, dtype=np.int64)
+        pair_cited = sorted_keys[pair_starts] // num_citing
+        pair_negative = np.maximum.reduceat((labels[order] == NEGATIVE).astype(np.int8), pair_starts) if len(keys) > 0 else np.zeros(0, dtype=np.int8)
+
+        counts["citation_count"] = np.bincount(pair_cited, minlength=num_papers).astype(np.int64)
+        counts["non_negative_citation_count"] = np.bincount(pair_cited, weights=pair_negative == 0, minlength=num_papers).astype(np.int64)
+        counts["negativity_rate"] = negativity_rate(counts["positive"], counts["negative"], counts["neutral"])
+        return counts
+
+    @staticmethod
+    def compute_researcher_metrics(paper_metrics: dict, authorships: dict, num_researchers: int) -> dict:
+        researchers, papers = authorships["researchers"], authorships["papers"]
+        citation_count = paper_metrics["citation_count"][papers]
+        non_negative_count = paper_metrics["non_negative_citation_count"][papers]
+
+        metrics = {
+            "paper_count": np.bincount(researchers, minlength=num_researchers).astype(np.int64),
+            "citation_count": np.bincount(researchers, weights=citation_count, minlength=num_researchers).astype(np.int64),
+            "h_index": grouped_h_index(researchers, citation_count, num_researchers),
+            "i10_index": np.bincount(researchers, weights=citation_count >= 10, minlength=num_researchers).astype(np.int64),
+            "non_negative_h_index": grouped_h_index(researchers, non_negative_count, num_researchers),
+            "non_negative_i10_index": np.bincount(researchers, weights=non_negative_count >= 10, minlength=num_researchers).astype(np.int64),
+        }
+        for label in LABELS:
+            key = label.lower()
+            metrics[key] = np.bincount(researchers, weights=paper_metrics[key][papers], minlength=num_researchers).astype(np.int64)
+        metrics["negativity_rate"] = negativity_rate(metrics["positive"], metrics["negative"], metrics["neutral"])
+        return metrics
+
+    @staticmethod
+    def compute(connection, exclude_self_citations: bool = False) -> tuple[dict, dict]:
+        citations = load_citation_arrays(connection, exclude_self_citations)
+        authorships = load_authorship_arrays(connection)
+        num_papers = int(connection.execute(text("SELECT COALESCE(MAX(id), 0) FROM papers")).scalar()) + 1
+        num_researchers = int(connection.execute(text("SELECT COALESCE(MAX(id), 0) FROM researchers")).scalar()) + 1
+
+        paper_metrics = CitationMetrics.compute_paper_metrics(citations, num_papers)
+        researcher_metrics = CitationMetrics.compute_researcher_metrics(paper_metrics, authorships, num_researchers)
+        paper_metrics["ids"] = np.unique(citations["cited"])
+        researcher_metrics["ids"] = np.unique(authorships["researchers"])
+        return paper_metrics, researcher_metrics
+
+    @staticmethod
+    def to_rows(metrics: dict, id_column: str, columns: list, dataset_version: str) -> list:
+        rows = []
+        for i in metrics["ids"]:
+            row = {"dataset_version": dataset_version, id_column: int(i)}
+            for column in columns:
+                value = metrics[column][i]
+                row[column] = None if column == "negativity_rate" and np.isnan(value) else value.item()
+            rows.append(row)
+        return rows
+
+    @staticmethod
+    def refresh(session: Session, force: bool = False, exclude_self_citations: bool = False) -> str:
+        create_missing_tables(ResearcherMetrics, PaperMetrics)
+        # metrics without self-citations are cached as their own version (see self_citations.py)
+        base_version = get_dataset_version(session.connection())
+        dataset_version = base_version + ("-independent" if exclude_self_citations else "")
+
+        is_cached = session.execute(select(ResearcherMetrics.id).where(ResearcherMetrics.dataset_version == dataset_version).limit(1)).first() is not None
+        if is_cached and not force:
+            LOG.info(f"citation metrics are up to date for dataset version {dataset_version}")
+            return dataset_version
+
+        LOG.info(f"computing citation metrics for dataset version {dataset_version}")
+        paper_metrics, researcher_metrics = CitationMetrics.compute(session.connection(), exclude_self_citations)
+
+        paper_columns = ["citation_count", "non_negative_citation_count", "positive", "negative", "neutral", "bad_context", "negativity_rate"]
+        researcher_columns = ["paper_count", "citation_count", "h_index", "i10_index", "non_negative_h_index", "non_negative_i10_index"]
+        researcher_columns += ["positive", "negative", "neutral", "bad_context", "negativity_rate"]
+
+        # only the latest version is kept, with and without self-citations, so toggling --exclude-self-citations stays cached
+        for model in [PaperMetrics, ResearcherMetrics]:
+            session.execute(delete(model).where(or_(model.dataset_version == dataset_version, model.dataset_version.not_in([base_version, base_version + "-independent"]))))
+        paper_rows = CitationMetrics.to_rows(paper_metrics, "paper_id", paper_columns, dataset_version)
+        researcher_rows = CitationMetrics.to_rows(researcher_metrics, "researcher_id", researcher_columns, dataset_version)
+        if paper_rows:
+            session.execute(insert(PaperMetrics), paper_rows)
+        if researcher_rows:
+            session.execute(insert(ResearcherMetrics), researcher_rows)
+        session.commit()
+        LOG.info(f"cached metrics of {len(paper_rows)} papers and {len(researcher_rows)} researchers")
+        return dataset_version
+
+    @staticmethod
+    def get_researcher_metrics(session: Session, exclude_self_citations: bool = False) -> list:
+        dataset_version = CitationMetrics.refresh(session, exclude_self_citations=exclude_self_citations)
+        return session.query(ResearcherMetrics).filter(ResearcherMetrics.dataset_version == dataset_version).all()
+
+    @staticmethod
+    def get_paper_metrics(session: Session, exclude_self_citations: bool = False) -> list:
+        dataset_version = CitationMetrics.refresh(session, exclude_self_citations=exclude_self_citations)
+        return session.query(PaperMetrics).filter(PaperMetrics.dataset_version == dataset_version).all()
+
+
+if __name__ == "__main__":
+    session = Session(engine)
+    for metrics in sorted(CitationMetrics.get_researcher_metrics(session), key=lambda m: m.h_index, reverse=True)[:20]:
+        print(f"{metrics.researcher_id}: h={metrics.h_index} h_non_negative={metrics.non_negative_h_index} i10={metrics.i10_index} negativity={metrics.negativity_rate}")
+    session.close()
@@ -0,0 +1,140 @@
+import time
+import sqlite3
+import threading
+from sqlalchemy.types import TypeDecorator, Text
+
+# optional storage mode for `Citation.context`: contexts are zstd compressed with a dictionary trained on a sample of citation sentences.
+# sqlite is dynamically typed, so compressed (blob) and plain (text) contexts can live in the same column.
+# the mode is active as soon as the `zstd_dictionaries` table holds a dictionary, i.e. after running the migration below.
+# see: https://python-zstandard.readthedocs.io/en/latest/dictionaries.html
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+COMPRESSION_LEVEL = 9
+DICTIONARY_SIZE = 112 * 1024
+MIN_TRAINING_SAMPLES = 1000  # zstd can't train on a handful of contexts, and a dictionary trained on few is a poor fit for all future inserts
+
+
+class ContextCodec:
+    loaded = False
+    compressor = None
+    decompressors = {}  # dictionary id -> decompressor, older dictionaries stay readable after retraining
+    lock = threading.Lock()  # zstd (de)compressor objects must not be used from several threads at once
+
+    @staticmethod
+    def load(dbapi_connection, force: bool = False):
+        if ContextCodec.loaded and not force:
+            return
+        ContextCodec.loaded = True
+        try:
+            rows = dbapi_connection.execute("SELECT id, data FROM zstd_dictionaries ORDER BY created_at").fetchall()
+        except sqlite3.OperationalError:
+            return  # table doesn't exist: uncompressed mode
+        if not rows:
+            return
+
+        import zstandard
+
+        with ContextCodec.lock:
+            ContextCodec.decompressors = {}
+            for dict_id, data in rows:
+                dictionary = zstandard.ZstdCompressionDict(data)
+                ContextCodec.decompressors[dict_id] = zstandard.ZstdDecompressor(dict_data=dictionary)
+            ContextCodec.compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL, dict_data=dictionary, write_content_size=True)
+
+    @staticmethod
+    def is_enabled() -> bool:
+        return ContextCodec.compressor is not None
+
+    @staticmethod
+    def encode(value):
+        if value is None or ContextCodec.compressor is None:
+            return value
+        with ContextCodec.lock:
+            return ContextCodec.compressor.compress(value.encode("utf-8"))
+
+    @staticmethod
+    def decode(value):
+        if not isinstance(value, bytes) or not value.startswith(ZSTD_MAGIC):
+            return value
+        import zstandard
+
+        dict_id = zstandard.get_frame_parameters(value).dict_id
+        with ContextCodec.lock:
+            return ContextCodec.decompressors[dict_id].decompress(value).decode("utf-8")
+
+
+class CompressedText(TypeDecorator):
+    # transparent for the orm: values are compressed when bound and decompressed when loaded
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return ContextCodec.encode(value)
+
+    def process_result_value(self, value, dialect):
+        return ContextCodec.decode(value)
+
+
+def register(dbapi_connection, connection_record=None):
+    # connect hook: loads the dictionaries and exposes `context_text(context)` to raw sql queries
+    ContextCodec.load(dbapi_connection)
+    dbapi_connection.create_function("context_text", 1, ContextCodec.decode, deterministic=True)
+
+
+def train_dictionary(connection, sample_size: int = 20_000):
+    import zstandard
+
+    # samples are drawn from all contexts, compressed ones are decoded with the dictionaries loaded so far
+    samples = [ContextCodec.decode(row[0]).encode("utf-8") for row in connection.execute("SELECT context FROM citations ORDER BY random() LIMIT ?", (sample_size,)) if row[0]]
+    if len(samples) < MIN_TRAINING_SAMPLES:
+        raise Exception(f"{len(samples)} contexts are too few to train a dictionary, at least {MIN_TRAINING_SAMPLES} are needed")
+    dictionary = zstandard.train_dictionary(DICTIONARY_SIZE, samples, level=COMPRESSION_LEVEL)
+    connection.execute("CREATE TABLE IF NOT EXISTS zstd_dictionaries (id INTEGER PRIMARY KEY, data BLOB NOT NULL, created_at REAL NOT NULL)")
+    connection.execute("INSERT OR REPLACE INTO zstd_dictionaries (id, data, created_at) VALUES (?, ?, ?)", (dictionary.dict_id(), dictionary.as_bytes(), time.time()))
+    connection.commit()
+    return dictionary
+
+
+def migrate(db_path: str, compress: bool = True, batch_size: int = 10_000, vacuum: bool = True, retrain: bool = False):
+    # converts an existing database in place, in batches so it can be interrupted and resumed.
+    # an existing dictionary is reused, so resuming doesn't train on the few contexts that are left.
+    connection = sqlite3.connect(db_path)
+    ContextCodec.load(connection, force=True)
+    if compress and (retrain or not ContextCodec.is_enabled()):
+        dictionary = train_dictionary(connection)
+        print(f"trained a {len(dictionary.as_bytes()) // 1024} KiB dictionary (id {dictionary.dict_id()})")
+        ContextCodec.load(connection, force=True)
+    if compress and not ContextCodec.is_enabled():
+        raise Exception("no dictionary available")
+
+    source_type = "text" if compress else "blob"
+    convert = ContextCodec.encode if compress else ContextCodec.decode
+    converted = 0
+    while True:
+        rows = connection.execute(f"SELECT id, context FROM citations WHERE typeof(context) = '{source_type}' LIMIT ?", (batch_size,)).fetchall()
+        if not rows:
+            break
+        connection.executemany("UPDATE citations SET context = ? WHERE id = ?", [(convert(context), c_id) for c_id, context in rows])
+        connection.commit()
+        converted += len(rows)
+        print(f"\tconverted {converted} contexts")
+
+    if not compress:
+        connection.execute("DROP TABLE IF EXISTS zstd_dictionaries")
+        connection.commit()
+        ContextCodec.compressor = None
+    if vacuum:
+        connection.execute("VACUUM")  # give the freed pages back to the file system
+    connection.close()
+    return converted
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="convert citations.context between plain text and zstd compressed storage")
+    parser.add_argument("--db", type=str, default="./citeQ.db")
+    parser.add_argument("--decompress", action="store_true", help="convert back to plain text")
+    parser.add_argument("--retrain", action="store_true", help="train a new dictionary even if there is one, older ones stay readable")
+    args = parser.parse_args()
+    migrate(args.db, compress=not args.decompress, retrain=args.retrain)
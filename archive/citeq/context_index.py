@@ -0,0 +1,161 @@
+import os
+import json
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from tqdm import tqdm
+
+from db import engine
+from logger import LOG_SINGLETON as LOG
+
+# small cpu-friendly model, see: https://huggingface.co/sentence-transformers/all-MiniLM-L6-v2
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+INDEX_DIR = os.path.join(os.getcwd(), ".cache", "embeddings")
+SENTIMENT_NAMES = ["Positive", "Negative", "Neutral", "Bad Context"]
+
+
+class ContextEmbeddingIndex:
+    # embeddings are stored as a float16 memmap whose rows are aligned with the sorted `ids.npy` array.
+    # the approximate search is an inverted file index (ivf): contexts are bucketed by their nearest k-means centroid
+    # and a query only scans the buckets of its `nprobe` nearest centroids.
+    # see: https://www.pinecone.io/learn/series/faiss/vector-indexes/
+
+    def __init__(self, index_dir: str = INDEX_DIR):
+        self.index_dir = index_dir
+        self.model = None
+        self.ids = None
+        self.vectors = None
+        self.centroids = None
+        self.list_offsets = None
+        self.list_members = None
+
+    def get_model(self):
+        if self.model is None:
+            from sentence_transformers import SentenceTransformer
+
+            self.model = SentenceTransformer(EMBEDDING_MODEL, device="cpu")
+        return self.model
+
+    def embed(self, texts: list) -> np.ndarray:
+        return self.get_model().encode(texts, batch_size=256, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.index_dir, filename)
+
+    def build(self, session: Session, batch_size: int = 2048, num_lists: int = None):
+        os.makedirs(self.index_dir, exist_ok=True)
+        ids = np.array(session.execute(text("SELECT id FROM citations ORDER BY id")).scalars().all(), dtype=np.int64)
+        dim = self.get_model().get_sentence_embedding_dimension()
+        LOG.info(f"embedding {len(ids)} citation contexts into '{self.index_dir}'")
+
+        # resume where a previous run stopped
+        meta_path = self.path("meta.json")
+        meta = json.load(open(meta_path)) if os.path.exists(meta_path) else {}
+        done = meta.get("done", 0) if meta.get("count") == len(ids) and meta.get("model") == EMBEDDING_MODEL else 0
+        vectors = np.lib.format.open_memmap(self.path("contexts.f16.npy"), mode="r+" if done > 0 else "w+", dtype=np.float16, shape=(len(ids), dim))
+        np.save(self.path("ids.npy"), ids)
+
+        with tqdm(total=len(ids), initial=done) as tq:
+            for start in range(done, len(ids), batch_size):
+                batch_ids = ids[start : start + batch_size]
+                rows = session.execute(text("SELECT id, context_text(context) FROM citations WHERE id BETWEEN :lo AND :hi ORDER BY id"), {"lo": int(batch_ids[0]), "hi": int(batch_ids[-1])}).fetchall()
+                vectors[start : start + len(rows)] = self.embed([row[1] or "" for row in rows])
+                vectors.flush()
+                json.dump({"count": len(ids), "done": start + len(rows), "model": EMBEDDING_MODEL}, open(meta_path, "w"))
+                tq.update(len(rows))
+
+        self.build_ivf(vectors, num_lists)
+        self.load()
+
+    def build_ivf(self, vectors: np.ndarray, num_lists: int = None, iterations: int = 10, sample_size: int = 50_000):
+        # train k-means on a sample, then assign every vector to its nearest centroid (spherical k-means since vectors are normalized)
+        n = len(vectors)
+        num_lists = num_lists or max(1, int(np.sqrt(n)))
+        rng = np.random.default_rng(0)
+        sample = np.asarray(vectors[np.sort(rng.choice(n, size=min(n, sample_size), replace=False))], dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), size=min(num_lists, len(sample)), replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+
+        assignment = np.empty(n, dtype=np.int64)
+        for start in range(0, n, 65_536):
+            chunk = np.asarray(vectors[start : start + 65_536], dtype=np.float32)
+            assignment[start : start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+
+        # csr layout: members of list i are list_members[list_offsets[i]:list_offsets[i+1]]
+        list_members = np.argsort(assignment, kind="stable")
+        list_offsets = np.r_[0, np.cumsum(np.bincount(assignment, minlength=len(centroids)))]
+        np.savez(self.path("ivf.npz"), centroids=centroids.astype(np.float32), list_offsets=list_offsets, list_members=list_members)
+        LOG.info(f"built ivf index with {len(centroids)} lists")
+
+    def load(self) -> "ContextEmbeddingIndex":
+        self.ids = np.load(self.path("ids.npy"))
+        self.vectors = np.load(self.path("contexts.f16.npy"), mmap_mode="r")
+        ivf = np.load(self.path("ivf.npz"))
+        self.centroids, self.list_offsets, self.list_members = ivf["centroids"], ivf["list_offsets"], ivf["list_members"]
+        return self
+
+    def rows_of(self, citation_ids) -> np.ndarray:
+        citation_ids = np.asarray(citation_ids, dtype=np.int64)
+        rows = np.searchsorted(self.ids, citation_ids)
+        rows = np.minimum(rows, len(self.ids) - 1)
+        found = self.ids[rows] == citation_ids
+        return np.where(found, rows, -1)
+
+    def get_vectors(self, citation_ids) -> np.ndarray:
+        rows = self.rows_of(citation_ids)
+        assert (rows >= 0).all(), "some citations are not in the index – rebuild it"
+        return np.asarray(self.vectors[rows], dtype=np.float32)
+
+    def search(self, query: np.ndarray, k: int = 10, nprobe: int = 8) -> tuple[np.ndarray, np.ndarray]:
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        probes = np.argsort(-(self.centroids @ query))[:nprobe]
+        candidates = np.concatenate([self.list_members[self.list_offsets[i] : self.list_offsets[i + 1]] for i in probes])
+        if len(candidates) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        candidates.sort()  # sequential reads from the memmap
+        scores = np.asarray(self.vectors[candidates], dtype=np.float32) @ query
+        top = np.argsort(-scores)[:k]
+        return self.ids[candidates[top]], scores[top]
+
+    def search_text(self, context: str, k: int = 10, nprobe: int = 8) -> tuple[np.ndarray, np.ndarray]:
+        return self.search(self.embed([context])[0], k=k, nprobe=nprobe)
+
+
+class FewShotSelector:
+    # picks the most similar human-annotated citations as prompt examples.
+    # the annotated set is small (~100 rows), so an exact search over it is cheaper than going through the ivf index.
+
+    def __init__(self, index: ContextEmbeddingIndex, session: Session, annotations_path: str = "citations_annotated.csv"):
+        self.index = index
+        rows = [line.strip().split(",") for line in open(annotations_path, "r") if line.strip()]
+        ids = [int(row[0]) for row in rows]
+        labels = {int(row[0]): int(row[1]) for row in rows}
+
+        contexts = dict(session.execute(text("SELECT id, context_text(context) FROM citations WHERE id IN (" + ",".join(str(i) for i in ids) + ")")).fetchall()) if ids else {}
+        in_index = [i for i in ids if i in contexts and index.rows_of([i])[0] >= 0]
+        self.ids = np.array(in_index, dtype=np.int64)
+        self.contexts = [contexts[i] for i in in_index]
+        self.labels = [labels[i] for i in in_index]
+        self.vectors = index.get_vectors(self.ids) if in_index else np.zeros((0, 1), dtype=np.float32)
+
+    def select(self, context: str, k: int = 4, citation_id: int = None) -> list[tuple[str, str]]:
+        if len(self.ids) == 0:
+            return []
+        rows = self.index.rows_of([citation_id])[0] if citation_id is not None else -1
+        query = np.asarray(self.index.vectors[rows], dtype=np.float32) if rows >= 0 else self.index.embed([context])[0]
+        scores = self.vectors @ query
+        if citation_id is not None:
+            scores = np.where(self.ids == citation_id, -np.inf, scores)  # never leak the gold label of the citation itself
+        top = np.argsort(-scores)[:k]
+        return [(self.contexts[i], SENTIMENT_NAMES[self.labels[i]]) for i in top if np.isfinite(scores[i])]
+
+
+if __name__ == "__main__":
+    session = Session(engine)
+    ContextEmbeddingIndex().build(session)
+    session.close()
@@ -0,0 +1,102 @@
+import re
+import json
+import hashlib
+
+# cleans semantic scholar contexts before they are classified:
+#
+#   normalize   unicode whitespace, hyphenation at line breaks and latex debris ("\cite{..}", "$..$", "{\em ..}")
+#   collapse    lists of citation markers ("[3, 4, 5-9]", "[1][2]", "(Och and Ney, 2000; Chiang 2005)") become one "[CIT]"
+#   trim        the sentences around the first citation marker, as many as fit into `token_budget`
+#   flag        empty or garbage contexts (mostly symbols or numbers, a few words) are labelled BAD_CONTEXT without an llm call
+#
+# tokens are estimated at ~4 characters each, see: https://platform.openai.com/tokenizer
+
+MARKER = "[CIT]"
+
+WHITESPACE_REGEX = re.compile(r"\s+")
+HYPHENATION_REGEX = re.compile(r"(\w)-\s+(?=[a-z])")
+LATEX_CITE_REGEX = re.compile(r"\\(?:cite|citep|citet|citealp|ref)\*?(?:\[[^\]]*\])*\{[^}]*\}")
+LATEX_MATH_REGEX = re.compile(r"\$[^$]{0,200}\$")
+LATEX_COMMAND_REGEX = re.compile(r"\\[a-zA-Z]+\*?")
+BRACES_REGEX = re.compile(r"[{}]")
+
+NUMERIC_MARKER_REGEX = re.compile(r"\[\s*\d+[a-z]?(?:\s*[-–,;]\s*\d+[a-z]?)*\s*\]")
+AUTHOR_YEAR_MARKER_REGEX = re.compile(r"\((?:[^()]*?(?:1[89]|20)\d{2}[a-z]?)(?:\s*[;,]\s*[^()]*?(?:1[89]|20)\d{2}[a-z]?)*\)")
+MARKER_LIST_REGEX = re.compile(r"\[CIT\](?:[\s,;]*\[CIT\])+")
+
+# splits after sentence punctuation, but not after common abbreviations of citing sentences
+SENTENCE_REGEX = re.compile(r"(?<!\bal\.)(?<!\be\.g\.)(?<!\bi\.e\.)(?<!\bcf\.)(?<!\bFig\.)(?<!\bEq\.)(?<=[.!?])\s+(?=[A-Z\[(])")
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for english text, see: https://platform.openai.com/tokenizer
+    return len(text) // 4 + 1
+
+
+class ContextPreprocessor:
+    def __init__(self, token_budget: int = 128, min_words: int = 3, min_alpha_ratio: float = 0.5):
+        self.token_budget = token_budget
+        self.min_words = min_words
+        self.min_alpha_ratio = min_alpha_ratio  # letters / non-space characters
+
+    @staticmethod
+    def normalize(context: str) -> str:
+        context = LATEX_CITE_REGEX.sub(MARKER, context or "")
+        context = LATEX_MATH_REGEX.sub(" ", context)
+        context = LATEX_COMMAND_REGEX.sub(" ", context)
+        context = BRACES_REGEX.sub("", context)
+        context = HYPHENATION_REGEX.sub(r"\1", context)
+        return WHITESPACE_REGEX.sub(" ", context).strip()
+
+    @staticmethod
+    def collapse_markers(context: str) -> str:
+        context = NUMERIC_MARKER_REGEX.sub(MARKER, context)
+        context = AUTHOR_YEAR_MARKER_REGEX.sub(MARKER, context)
+        return MARKER_LIST_REGEX.sub(MARKER, context)
+
+    def is_garbage(self, context: str) -> bool:
+        text = context.replace(MARKER, " ")
+        if len(re.findall(r"[A-Za-z]{2,}", text)) < self.min_words:
+            return True
+        characters = [c for c in text if not c.isspace()]
+        if not characters:
+            return True
+        return sum(c.isalpha() for c in characters) / len(characters) < self.min_alpha_ratio
+
+    def trim(self, context: str) -> str:
+        if estimate_tokens(context) <= self.token_budget:
+            return context
+        sentences = SENTENCE_REGEX.split(context)
+        center = next((i for i, sentence in enumerate(sentences) if MARKER in sentence), 0)
+        # grow the window around the citing sentence, alternating between the following and the preceding sentence
+        start, end = center, center + 1
+        tokens = estimate_tokens(sentences[center])
+        while True:
+            grown = False
+            for i in (end, start - 1):
+                if 0 <= i < len(sentences) and not (start <= i < end) and tokens + estimate_tokens(sentences[i]) <= self.token_budget:
+                    tokens += estimate_tokens(sentences[i])
+                    start, end = min(start, i), max(end, i + 1)
+                    grown = True
+            if not grown:
+                break
+        window = " ".join(sentences[start:end])
+        # a single sentence can still be over budget, cut it around the marker
+        max_chars = self.token_budget * 4
+        if len(window) > max_chars:
+            marker = max(window.find(MARKER), 0)
+            left = max(0, min(marker - max_chars // 2, len(window) - max_chars))
+            window = window[left : left + max_chars].strip()
+        return window
+
+    def preprocess(self, context: str) -> tuple[str, bool]:
+        # returns the cleaned context and whether it is garbage
+        context = self.collapse_markers(self.normalize(context))
+        if self.is_garbage(context):
+            return context, True
+        return self.trim(context), False
+
+    def fingerprint(self) -> str:
+        # part of the prompt fingerprint (see label_provenance.py), preprocessed contexts can get different labels
+        settings = {"token_budget": self.token_budget, "min_words": self.min_words, "min_alpha_ratio": self.min_alpha_ratio, "version": 1}
+        return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
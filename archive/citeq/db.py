@@ -4,12 +4,15 @@ from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import mapped_column
 from sqlalchemy.orm import relationship
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, UniqueConstraint, Index, text, event
 from typing import Optional
 import datetime
-import os
+import threading
+
+from context_compression import CompressedText, register as register_context_compression
 
 engine = create_engine("sqlite+pysqlite:///./citeQ.db")
+event.listen(engine, "connect", register_context_compression)
 
 
 class Base(DeclarativeBase):
@@ -38,6 +41,7 @@ class Paper(Base):
     doi: Mapped[Optional[str]]
     citations_added: Mapped[bool] = mapped_column(default=False)
     references_added: Mapped[bool] = mapped_column(default=False)
+    last_synced_at: Mapped[Optional[datetime.datetime]]  # last time the citations or the citation count were fetched
 
 
 class Authorship(Base):
@@ -53,15 +57,149 @@ class Citation(Base):
     __tablename__ = "citations"
 
     id: Mapped[int] = mapped_column(primary_key=True)
+    # semantic scholar ids, or keys of `s2_ids` once the database is migrated to interned ids (see s2_ids.py)
     citing_paper_id: Mapped[int] = mapped_column(ForeignKey("papers.semantic_scholar_id"))
     cited_paper_id: Mapped[int] = mapped_column(ForeignKey("papers.semantic_scholar_id"))
-    context: Mapped[str]
+    context: Mapped[str] = mapped_column(CompressedText)
     intent: Mapped[Optional[str]] = mapped_column(default="unknown")
     llm_purpose: Mapped[Optional[str]]
     sentiment: Mapped[Optional[str]]
+    self_citation: Mapped[Optional[bool]]  # citing and cited paper share an author, null if either has no authorships (see self_citations.py)
+
+
+class ResearcherMetrics(Base):
+    __tablename__ = "researcher_metrics"
+    __table_args__ = (UniqueConstraint("dataset_version", "researcher_id"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    dataset_version: Mapped[str] = mapped_column(index=True)
+    researcher_id: Mapped[int] = mapped_column(ForeignKey("researchers.id"))
+    paper_count: Mapped[int]
+    citation_count: Mapped[int]
+    h_index: Mapped[int]
+    i10_index: Mapped[int]
+    non_negative_h_index: Mapped[int]
+    non_negative_i10_index: Mapped[int]
+    positive: Mapped[int]
+    negative: Mapped[int]
+    neutral: Mapped[int]
+    bad_context: Mapped[int]
+    negativity_rate: Mapped[Optional[float]]
+
+
+class PaperMetrics(Base):
+    __tablename__ = "paper_metrics"
+    __table_args__ = (UniqueConstraint("dataset_version", "paper_id"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    dataset_version: Mapped[str] = mapped_column(index=True)
+    paper_id: Mapped[int] = mapped_column(ForeignKey("papers.id"))
+    citation_count: Mapped[int]
+    non_negative_citation_count: Mapped[int]
+    positive: Mapped[int]
+    negative: Mapped[int]
+    neutral: Mapped[int]
+    bad_context: Mapped[int]
+    negativity_rate: Mapped[Optional[float]]
+
 
+class ClassificationChunk(Base):
+    __tablename__ = "classification_chunks"
 
-if os.path.exists("./citeQ.db"):
-    print("Database already exists")
-else:
-    Base.metadata.create_all(engine)
+    id: Mapped[int] = mapped_column(primary_key=True)
+    start_id: Mapped[int]  # citation id range, inclusive
+    end_id: Mapped[int]
+    size: Mapped[int]
+    status: Mapped[str] = mapped_column(default="pending", index=True)  # pending | leased | done
+    worker: Mapped[Optional[str]]
+    lease_expires_at: Mapped[Optional[float]]
+    attempts: Mapped[int] = mapped_column(default=0)
+
+
+class LabelProvenance(Base):
+    __tablename__ = "label_provenance"
+    __table_args__ = (Index("ix_label_provenance_citation_id_id", "citation_id", "id"),)
+
+    # append-only: every classification adds a row, the latest row of a citation is its current label (see the `current_labels` view)
+    id: Mapped[int] = mapped_column(primary_key=True)
+    citation_id: Mapped[int] = mapped_column(ForeignKey("citations.id"))
+    model: Mapped[str]
+    prompt_fingerprint: Mapped[str]  # sha256 of the prompt template and the settings that affect the answer
+    label: Mapped[str]
+    created_at: Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.utcnow)
+
+
+class FetchLedgerEntry(Base):
+    __tablename__ = "fetch_ledger"
+    __table_args__ = (UniqueConstraint("resource", "fields"),)
+
+    # api resources that were already fetched into this database, e.g. ("paper:<ss id>", "title,year,..."), see: fetch_ledger.py
+    id: Mapped[int] = mapped_column(primary_key=True)
+    resource: Mapped[str]
+    fields: Mapped[str]
+    status: Mapped[int]  # http status code, 404s are recorded too so they aren't retried
+    fetched_at: Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.utcnow)
+
+
+def get_dataset_version(connection) -> str:
+    # cheap content stamp: changes whenever rows are added or labelled
+    # see: https://www.sqlite.org/lang_aggfunc.html
+    papers = connection.execute(text("SELECT COUNT(*), MAX(id) FROM papers")).one()
+    authorships = connection.execute(text("SELECT COUNT(*), MAX(id) FROM authorships")).one()
+    citations = connection.execute(text("SELECT COUNT(*), MAX(id), COUNT(llm_purpose) FROM citations")).one()
+    stamp = (*papers, *authorships, *citations)
+    if has_column(connection, "citations", "self_citation"):
+        stamp += tuple(connection.execute(text("SELECT COUNT(self_citation), SUM(self_citation) FROM citations")).one())
+    # reclassification doesn't change any of the counts above, but it always appends provenance rows
+    if connection.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'label_provenance'")).first() is not None:
+        stamp += (connection.execute(text("SELECT MAX(id) FROM label_provenance")).scalar(),)
+    return "-".join(str(value or 0) for value in stamp)
+
+
+def has_column(connection, table: str, column: str) -> bool:
+    return any(row[1] == column for row in connection.execute(text(f"PRAGMA table_info({table})")))
+
+
+def add_missing_columns(connection, model, *columns):
+    # same for columns added to existing tables, see: https://www.sqlite.org/lang_altertable.html#altertabaddcol
+    for column in columns:
+        if not has_column(connection, model.__tablename__, column):
+            column_type = model.__table__.c[column].type.compile(dialect=engine.dialect)
+            connection.execute(text(f"ALTER TABLE {model.__tablename__} ADD COLUMN {column} {column_type}"))
+
+
+def create_missing_columns(model, *columns):
+    with engine.begin() as connection:
+        add_missing_columns(connection, model, *columns)
+
+
+def create_missing_tables(*models):
+    # the schema is only created for new databases (see below), so tables added later have to be created on demand
+    Base.metadata.create_all(engine, tables=[model.__table__ for model in models], checkfirst=True)
+
+
+schema_lock = threading.Lock()
+schema_ready = False
+
+
+def create_schema(connection):
+    # runs on the first connection of `engine` instead of at import, so modules that only need the helpers above
+    # (e.g. query_service.py with its own `--db`) don't create or alter ./citeQ.db
+    global schema_ready
+    if schema_ready:
+        return
+    with schema_lock:
+        if schema_ready:
+            return
+        if connection.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'papers'")).first() is not None:
+            print("Database already exists")
+            # mapped by the orm, so they have to exist before the first query
+            add_missing_columns(connection, Citation, "self_citation")
+            add_missing_columns(connection, Paper, "last_synced_at")
+        else:
+            Base.metadata.create_all(connection)
+        connection.commit()
+        schema_ready = True
+
+
+event.listen(engine, "engine_connect", create_schema)
@@ -0,0 +1,160 @@
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from logger import LOG_SINGLETON as LOG
+from llm_classifier import LlmClassifier, SentimentClass
+from cascade_classifier import read_annotations
+from context_preprocessing import estimate_tokens
+
+# ensemble with early agreement: the two cheapest models label every citation concurrently,
+# their label is accepted if they agree and only disagreements are escalated to a stronger model.
+#
+# costs are estimated per call from the prompt size and the list prices per 1k input/output tokens,
+# local ollama models cost nothing but gpu time, which is tracked as wall seconds per model.
+# see: https://openai.com/pricing
+
+MODEL_PRICES = {"random": (0.0, 0.0), "mistral": (0.0, 0.0), "llama": (0.0, 0.0), "gpt3": (0.001, 0.002), "gpt4": (0.03, 0.06)}
+OUTPUT_TOKENS = 100  # the prompt asks for step by step reasoning before the answer
+
+
+def estimate_cost(model: str, input_tokens: int, output_tokens: int = OUTPUT_TOKENS) -> float:
+    input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return input_tokens / 1000 * input_price + output_tokens / 1000 * output_price
+
+
+def estimate_prompt_tokens(model: str, context: str, citation_id: int = None) -> int:
+    # the prompt `LlmClassifier.get_sentiment_class` sends: model specific template, few-shot examples and the preprocessed context
+    if LlmClassifier.preprocessor is not None:
+        context, garbage = LlmClassifier.preprocessor.preprocess(context)
+        if garbage:
+            return 0  # labelled without a call
+    return estimate_tokens(LlmClassifier.build_prompt(context, model, citation_id))
+
+
+def cheapest(models: list, n: int = 2) -> list:
+    # stable, so models with the same price keep the given order
+    return sorted(models, key=lambda model: sum(MODEL_PRICES.get(model, (float("inf"), 0.0))))[:n]
+
+
+def read_llm_annotations(model: str) -> dict:
+    # "<citation id>,<gold>,<predicted>" per line, written by evaluate.py
+    for path in (f"llm_data/llm_annotations_{model}.csv", f"llm_annotations_{model}.csv"):
+        try:
+            return {int(row[0]): int(row[2]) for row in (line.strip().split(",") for line in open(path, "r") if line.strip())}
+        except FileNotFoundError:
+            continue
+    raise FileNotFoundError(f"no annotations of {model} found")
+
+
+class ModelCosts:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.models = {}
+
+    def record(self, model: str, seconds: float, input_tokens: int):
+        with self.lock:
+            stats = self.models.setdefault(model, {"calls": 0, "seconds": 0.0, "input_tokens": 0, "usd": 0.0})
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["input_tokens"] += input_tokens
+            stats["usd"] += estimate_cost(model, input_tokens)
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {model: dict(stats) for model, stats in self.models.items()}
+
+
+class EnsembleClassifier:
+    def __init__(self, cheap_models: list = None, strong_model: str = "gpt4", workers: int = 1):
+        available = [model for model, llm in LlmClassifier.LLM.items() if llm is not None and model != strong_model]
+        self.cheap_models = cheap_models or cheapest(available)
+        self.strong_model = strong_model
+        assert len(self.cheap_models) == 2, f"the ensemble needs two cheap models, got {self.cheap_models}"
+        self.executor = ThreadPoolExecutor(max_workers=2 * workers)
+        self.costs = ModelCosts()
+        self.agreed = 0
+        self.escalated = 0
+
+    def call(self, model: str, context: str, citation_id: int = None) -> SentimentClass:
+        start = time.perf_counter()
+        label = LlmClassifier.get_sentiment_class(context, model, citation_id)
+        self.costs.record(model, time.perf_counter() - start, estimate_prompt_tokens(model, context, citation_id))
+        return label
+
+    def classify_batch(self, contexts: list, citation_ids: list = None) -> list[SentimentClass]:
+        citation_ids = citation_ids or [None] * len(contexts)
+        # both cheap models of the whole batch are in flight at once, escalations follow once their votes are in
+        votes = [[self.executor.submit(self.call, model, context, c_id) for model in self.cheap_models] for context, c_id in zip(contexts, citation_ids)]
+        votes = [[future.result() for future in futures] for futures in votes]
+
+        results = list(range(len(contexts)))
+        escalations = {}
+        for i, (first, second) in enumerate(votes):
+            if first == second:
+                self.agreed += 1
+                results[i] = first
+            else:
+                self.escalated += 1
+                escalations[i] = self.executor.submit(self.call, self.strong_model, contexts[i], citation_ids[i])
+        for i, future in escalations.items():
+            results[i] = future.result()
+        return results
+
+    def close(self):
+        self.executor.shutdown()
+
+    def get_provenance(self) -> tuple[str, str]:
+        # the label of an ensemble run comes from any of its models, so it is attributed to the combination
+        fingerprint = ":".join(LlmClassifier.get_prompt_fingerprint(model) for model in [*self.cheap_models, self.strong_model])
+        return f"ensemble-{'+'.join(LlmClassifier.get_model_name(model) for model in self.cheap_models)}>{LlmClassifier.get_model_name(self.strong_model)}", hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+
+    def escalation_rate(self) -> float:
+        total = self.agreed + self.escalated
+        return self.escalated / total if total > 0 else 0.0
+
+    def summary(self) -> dict:
+        costs = self.costs.summary()
+        return {"citations": self.agreed + self.escalated, "escalation_rate": self.escalation_rate(), "usd": sum(stats["usd"] for stats in costs.values()), "models": costs}
+
+    @staticmethod
+    def report(cheap_models: list, strong_model: str, context_tokens: int = 60) -> dict:
+        # escalation rate, accuracy and cost on the human annotations, from the labels each model already produced (see evaluate.py)
+        gold = read_annotations()
+        predictions = {model: read_llm_annotations(model) for model in [*cheap_models, strong_model]}
+        ids = [c_id for c_id in gold if all(c_id in labels for labels in predictions.values())]
+        first, second, strong = (predictions[model] for model in [*cheap_models, strong_model])
+
+        agree = [c_id for c_id in ids if first[c_id] == second[c_id]]
+        ensemble = {c_id: first[c_id] if first[c_id] == second[c_id] else strong[c_id] for c_id in ids}
+        accuracy = lambda labels, subset: sum(labels[c_id] == gold[c_id] for c_id in subset) / len(subset) if subset else float("nan")
+
+        context = "x" * 4 * context_tokens  # stand-in of the typical context length, see `estimate_tokens`
+        cost = {model: estimate_cost(model, estimate_prompt_tokens(model, context)) for model in [*cheap_models, strong_model]}
+        escalation_rate = 1 - len(agree) / len(ids) if ids else float("nan")
+        row = {
+            "citations": len(ids),
+            "escalation_rate": escalation_rate,
+            "agreement_accuracy": accuracy(first, agree),
+            "ensemble_accuracy": accuracy(ensemble, ids),
+            **{f"{model}_accuracy": accuracy(predictions[model], ids) for model in [*cheap_models, strong_model]},
+            "ensemble_usd_per_1k": 1000 * (cost[cheap_models[0]] + cost[cheap_models[1]] + escalation_rate * cost[strong_model]),
+            f"{strong_model}_usd_per_1k": 1000 * cost[strong_model],
+        }
+        LOG.info(f"{len(ids)} annotated citations, ensemble {'+'.join(cheap_models)} > {strong_model}")
+        LOG.info(f"\tescalation rate: {row['escalation_rate']:.2%}, accuracy when the cheap models agree: {row['agreement_accuracy']:.2%}")
+        for model in [*cheap_models, strong_model]:
+            LOG.info(f"\t{model:>8} alone: {row[f'{model}_accuracy']:.2%}")
+        LOG.info(f"\tensemble: {row['ensemble_accuracy']:.2%}")
+        LOG.info(f"\test. cost per 1k citations: ensemble ${row['ensemble_usd_per_1k']:.2f}, {strong_model} alone ${row[f'{strong_model}_usd_per_1k']:.2f}")
+        return row
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="escalation rate and accuracy of the ensemble on citations_annotated.csv")
+    parser.add_argument("--cheap", nargs=2, type=str, default=["mistral", "llama"])
+    parser.add_argument("--strong", type=str, default="gpt4")
+    args = parser.parse_args()
+    EnsembleClassifier.report(args.cheap, args.strong)
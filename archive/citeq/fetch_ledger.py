@@ -0,0 +1,73 @@
+import threading
+from concurrent.futures import Future
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+from db import FetchLedgerEntry, create_missing_tables
+
+# two layers that keep the same api resource from being fetched twice:
+#
+#   SingleFlight   concurrent calls with the same key share one http request (in-process, e.g. threads of the pdf pipeline)
+#   FetchLedger    persistent record of (resource, fields) already fetched into this database, so researchers that share
+#                  papers or co-authors don't fetch them again – neither later in the same run nor in the next one.
+#
+# see: https://pkg.go.dev/golang.org/x/sync/singleflight
+
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.stats = {"calls": 0, "coalesced": 0}
+
+    def do(self, key, fn):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.calls[key] = future
+                self.stats["calls"] += 1
+            else:
+                self.stats["coalesced"] += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+class FetchLedger:
+    stats = {"fetched": 0, "skipped": 0}
+
+    @staticmethod
+    def ensure_schema():
+        create_missing_tables(FetchLedgerEntry)
+
+    @staticmethod
+    def missing(session: Session, resources: list, fields: str) -> list:
+        # the resources (in their original order) that haven't been fetched with these fields yet
+        done = set()
+        unique = list(dict.fromkeys(resources))
+        for i in range(0, len(unique), 900):
+            query = session.query(FetchLedgerEntry.resource).filter(FetchLedgerEntry.fields == fields, FetchLedgerEntry.resource.in_(unique[i : i + 900]))
+            done.update(row[0] for row in query.all())
+        FetchLedger.stats["skipped"] += len(done)
+        return [resource for resource in unique if resource not in done]
+
+    @staticmethod
+    def record(session: Session, resources: list, fields: str, status: int = 200):
+        if not resources:
+            return
+        rows = [{"resource": resource, "fields": fields, "status": status} for resource in dict.fromkeys(resources)]
+        session.execute(insert(FetchLedgerEntry).prefix_with("OR IGNORE"), rows)
+        session.commit()
+        FetchLedger.stats["fetched"] += len(rows)
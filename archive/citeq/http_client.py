@@ -0,0 +1,33 @@
+import json as jsonlib
+
+from rate_limiter import RateController
+from fetch_ledger import SingleFlight
+from logger import LOG_SINGLETON as LOG
+
+# all api calls go through the rate controller, which also retries 429s and server errors (see rate_limiter.py).
+# identical requests that are in flight at the same time share one response.
+IN_FLIGHT = SingleFlight()
+
+
+def get_url(url, headers=None):
+    r = IN_FLIGHT.do(("GET", url), lambda: RateController.request("GET", url, headers=headers))
+
+    if r.status_code == 404:
+        LOG.warning(f"could not find resource at {url}")
+        return r
+    if r.status_code != 200:
+        LOG.warning(f"request failed with status code {r.status_code}")
+        r.raise_for_status()
+
+    return r
+
+
+def post_url(url, params, json):
+    key = ("POST", url, jsonlib.dumps(params, sort_keys=True), jsonlib.dumps(json, sort_keys=True))
+    r = IN_FLIGHT.do(key, lambda: RateController.request("POST", url, retry_404=True, params=params, json=json))
+
+    if r.status_code != 200:
+        LOG.warning(f"request failed with status code {r.status_code}")
+        r.raise_for_status()
+
+    return r
@@ -0,0 +1,87 @@
+import argparse
+from sqlalchemy import text, insert
+from sqlalchemy.orm import Session
+
+from db import LabelProvenance, engine, create_missing_tables
+from logger import LOG_SINGLETON as LOG
+
+# records which model and prompt produced each label, so a prompt change only requires reclassifying the affected citations.
+# `current_labels` resolves the latest label of every citation. labels written before provenance was tracked
+# (e.g. imported with insert_llm_out.py) fall back to `citations.llm_purpose` with an unknown model and prompt.
+
+CURRENT_LABELS_VIEW = """
+CREATE VIEW IF NOT EXISTS current_labels AS
+SELECT c.id AS citation_id, COALESCE(lp.label, c.llm_purpose) AS label, lp.model, lp.prompt_fingerprint, lp.created_at
+FROM citations c
+LEFT JOIN (SELECT citation_id, MAX(id) AS id FROM label_provenance GROUP BY citation_id) latest ON latest.citation_id = c.id
+LEFT JOIN label_provenance lp ON lp.id = latest.id
+"""
+
+
+class LabelProvenanceStore:
+    @staticmethod
+    def ensure_schema():
+        create_missing_tables(LabelProvenance)
+        with engine.begin() as connection:
+            connection.execute(text(CURRENT_LABELS_VIEW))
+
+    @staticmethod
+    def record(session: Session, labels: list, model: str, prompt_fingerprint: str, update_citations: bool = True):
+        # labels: [(citation id, label name)], written in one transaction
+        if not labels:
+            return
+        session.execute(insert(LabelProvenance), [{"citation_id": c_id, "model": model, "prompt_fingerprint": prompt_fingerprint, "label": label} for c_id, label in labels])
+        if update_citations:
+            # keep the plain column in sync for code that reads it directly
+            session.execute(text("UPDATE citations SET llm_purpose = :label WHERE id = :id"), [{"id": c_id, "label": label} for c_id, label in labels])
+        session.commit()
+
+    @staticmethod
+    def stale_citation_ids(session: Session, model: str, prompt_fingerprint: str) -> list[int]:
+        # unlabelled, labelled by another model or prompt, or labelled before provenance was tracked
+        query = """
+            SELECT citation_id FROM current_labels
+            WHERE label IS NULL OR model IS NULL OR model != :model OR prompt_fingerprint != :fingerprint
+            ORDER BY citation_id
+        """
+        return session.execute(text(query), {"model": model, "fingerprint": prompt_fingerprint}).scalars().all()
+
+    @staticmethod
+    def adopt_legacy_labels(session: Session, model: str, prompt_fingerprint: str) -> int:
+        # attributes labels without provenance to the given model and prompt, e.g. after importing csv shards of a known run
+        result = session.execute(
+            text(
+                """
+                INSERT INTO label_provenance (citation_id, model, prompt_fingerprint, label, created_at)
+                SELECT citation_id, :model, :fingerprint, label, CURRENT_TIMESTAMP FROM current_labels
+                WHERE label IS NOT NULL AND model IS NULL
+                """
+            ),
+            {"model": model, "fingerprint": prompt_fingerprint},
+        )
+        session.commit()
+        return result.rowcount
+
+    @staticmethod
+    def summary(session: Session) -> list:
+        query = "SELECT model, prompt_fingerprint, COUNT(*) FROM current_labels WHERE label IS NOT NULL GROUP BY model, prompt_fingerprint ORDER BY COUNT(*) DESC"
+        return session.execute(text(query)).fetchall()
+
+
+if __name__ == "__main__":
+    from llm_classifier import LlmClassifier
+
+    parser = argparse.ArgumentParser(description="inspect label provenance")
+    parser.add_argument("--llm", type=str, default="mistral")
+    parser.add_argument("--adopt-legacy", help="attribute labels without provenance to the current model and prompt of --llm", action="store_true")
+    args = parser.parse_args()
+
+    LabelProvenanceStore.ensure_schema()
+    session = Session(engine)
+    model, fingerprint = LlmClassifier.get_model_name(args.llm), LlmClassifier.get_prompt_fingerprint(args.llm)
+    if args.adopt_legacy:
+        LOG.info(f"attributed {LabelProvenanceStore.adopt_legacy_labels(session, model, fingerprint)} legacy labels to {model} ({fingerprint[:12]})")
+    for row_model, row_fingerprint, count in LabelProvenanceStore.summary(session):
+        print(f"{row_model or 'unknown':>20} {(row_fingerprint or 'unknown')[:12]:>12} {count:>8}")
+    print(f"{len(LabelProvenanceStore.stale_citation_ids(session, model, fingerprint))} citations are stale for {model} ({fingerprint[:12]})")
+    session.close()
@@ -1,6 +1,13 @@
 from enum import Enum
+import json
+import re
+import hashlib
+import time
+import threading
 
 from logger import LOG_SINGLETON as LOG, trace
+from ollama_client import OllamaClient
+from ollama_pool import PooledOllamaClient
 
 from thefuzz import fuzz
 from langchain.llms import Ollama
@@ -142,6 +149,14 @@ Classify the following in text citation into one of these categories. First, typ
 
 """
 
+# same categories as `PROMPT_2`, but the model has to answer with a json object instead of free text
+PROMPT_JSON = (
+    PROMPT_2.split("Classify the following")[0]
+    + """Classify the following in text citation into one of these categories. Respond only with a JSON object of the form {"answer": "<category>"} where <category> is one of "positive", "negative", "neutral" or "bad context".
+
+"""
+)
+
 
 # class SentimentClass(Enum):
 #     CRITICIZING = 0
@@ -169,29 +184,223 @@ class SentimentClass(Enum):
     BAD_CONTEXT = 3
 
 
+ANSWER_LABELS = {
+    "positive": SentimentClass.POSITIVE,
+    "negative": SentimentClass.NEGATIVE,
+    "neutral": SentimentClass.NEUTRAL,
+    "bad context": SentimentClass.BAD_CONTEXT,
+    "bad": SentimentClass.BAD_CONTEXT,
+}
+
+STREAMED_ANSWER_REGEX = re.compile(r"ANSWER:\W*(positive|negative|neutral|bad context|bad)\b(?=\W)", re.IGNORECASE)
+
+
+class ClassificationStats:
+    def __init__(self, tokens_path: str = None):
+        self.tokens_path = tokens_path  # optional csv of "<citation id>,<generated tokens>,<retries>", the token count is empty if unknown
+        self.lock = threading.Lock()  # classification can run in several threads against a host pool
+        self.calls = 0
+        self.retries = 0
+        self.skipped = 0  # garbage contexts labelled without an llm call
+        self.input_chars = 0
+        self.preprocessed_chars = 0
+        self.fallbacks = 0
+        self.generated_tokens = 0
+        self.counted_calls = 0  # calls with a known number of generated tokens
+        self.last_generated_tokens = None
+        self.streamed_calls = 0
+        self.early_exits = 0
+        self.stream_seconds = 0.0
+        self.tail_samples = []  # seconds between a valid answer and the end of generation, measured on calibration calls
+
+    def record(self, citation_id: int, generated_tokens: int | None, retries: int, fallback: bool):
+        with self.lock:
+            self.calls += 1
+            self.retries += retries
+            self.fallbacks += int(fallback)
+            if generated_tokens is not None:
+                self.generated_tokens += generated_tokens
+                self.counted_calls += 1
+            self.last_generated_tokens = generated_tokens
+            if self.tokens_path is not None and citation_id is not None:
+                with open(self.tokens_path, "a") as f:
+                    f.write(f"{citation_id},{'' if generated_tokens is None else generated_tokens},{retries}\n")
+
+    def record_preprocessing(self, input_chars: int, preprocessed_chars: int, skipped: bool):
+        with self.lock:
+            self.input_chars += input_chars
+            self.preprocessed_chars += preprocessed_chars
+            self.skipped += int(skipped)
+
+    def record_stream(self, seconds: float, early_exit: bool, tail_seconds: float = None):
+        with self.lock:
+            self.streamed_calls += 1
+            self.early_exits += int(early_exit)
+            self.stream_seconds += seconds
+            if tail_seconds is not None:
+                self.tail_samples.append(tail_seconds)
+
+    def summary(self) -> dict:
+        summary = {
+            "calls": self.calls,
+            "retries": self.retries,
+            "fallbacks": self.fallbacks,
+            "generated_tokens": self.generated_tokens,
+            "tokens_per_call": self.generated_tokens / self.counted_calls if self.counted_calls > 0 else None,
+        }
+        if self.input_chars > 0:
+            summary["skipped"] = self.skipped
+            summary["context_chars_saved"] = 1 - self.preprocessed_chars / self.input_chars
+        if self.streamed_calls > 0:
+            # the saved latency is estimated from calibration calls that were allowed to run to completion
+            saved_per_exit = sum(self.tail_samples) / len(self.tail_samples) if self.tail_samples else None
+            summary["streamed_calls"] = self.streamed_calls
+            summary["early_exits"] = self.early_exits
+            summary["seconds_per_streamed_call"] = self.stream_seconds / self.streamed_calls
+            summary["est_saved_seconds_per_citation"] = None if saved_per_exit is None else saved_per_exit * self.early_exits / self.streamed_calls
+            summary["est_saved_seconds_total"] = None if saved_per_exit is None else saved_per_exit * self.early_exits
+        return summary
+
+
 class LlmClassifier:
     llm_mistral = Ollama(model="mistral")
     llm_llama = Ollama(model="llama2")
     llm_gpt = None  # normalize_gpt(ChatOpenAI(model="gpt-3.5-turbo-1106"))
     llm_gpt4 = None  # normalize_gpt(ChatOpenAI(model="gpt-4"))
     LLM = {"mistral": llm_mistral, "gpt3": llm_gpt, "gpt4": llm_gpt4, "llama": llm_llama}
+    OLLAMA_MODELS = {"mistral": "mistral", "llama": "llama2"}
     promt_printed = False
+    stats = ClassificationStats()
+    pool = None  # optional `ollama_pool.OllamaHostPool`, otherwise the default ollama host is used
+
+    # streaming mode: parse the answer while it is generated and cancel as soon as a label follows "ANSWER:".
+    # every `calibration_every`-th call runs to completion to measure how much time the early exit saves.
+    streaming = False
+    calibration_every = 20
+
+    # constrained mode: json output, stop sequences and a token budget with a bounded number of retries
+    constrained = False
+    max_tokens = 32
+    max_retries = 3
+    fallback_label = SentimentClass.BAD_CONTEXT
+    example_selector = None  # optional `context_index.FewShotSelector` for retrieved examples
+    preprocessor = None  # optional `context_preprocessing.ContextPreprocessor`
+
+    # prefix reuse: keep the model loaded and send the shared instruction block as pre-evaluated context tokens,
+    # so the server can reuse its kv cache for it and only has to process the citation.
+    # only prompts that already contain the chat template can be sent in raw mode, all others just get `keep_alive`.
+    # raw mode skips the template ollama would put around the prompt, so it is part of the prompt fingerprint.
+    # see: https://github.com/ollama/ollama/blob/main/docs/api.md#parameters
+    prefix_reuse = False
+    keep_alive = "30m"
+    REUSABLE_PREFIXES = [PROMPT_2_INST]
+    prefix_tokens = {}
+    prefix_lock = threading.Lock()
+
+    @staticmethod
+    def get_client(llm_type: str):
+        model = LlmClassifier.OLLAMA_MODELS[llm_type]
+        return PooledOllamaClient(model, LlmClassifier.pool) if LlmClassifier.pool is not None else OllamaClient(model)
+
+    @staticmethod
+    def get_prefix_tokens(prefix: str, llm_type: str) -> list:
+        model = LlmClassifier.OLLAMA_MODELS[llm_type]
+        with LlmClassifier.prefix_lock:
+            if (model, prefix) not in LlmClassifier.prefix_tokens:
+                # evaluate the prefix once, the returned context also contains the single generated token which is dropped
+                response = LlmClassifier.get_client(llm_type).generate(prefix, options={"num_predict": 1}, raw=True, keep_alive=LlmClassifier.keep_alive)
+                context = response["context"]
+                LlmClassifier.prefix_tokens[(model, prefix)] = context[: len(context) - response.get("eval_count", 0)]
+                LOG.info(f"cached {len(LlmClassifier.prefix_tokens[(model, prefix)])} prefix tokens for {model}")
+            return LlmClassifier.prefix_tokens[(model, prefix)]
+
+    @staticmethod
+    def split_prefix(prompt: str, llm_type: str) -> tuple[str, dict]:
+        # returns the part of the prompt that still has to be sent and the extra request parameters
+        if not LlmClassifier.prefix_reuse:
+            return prompt, {}
+        for prefix in LlmClassifier.REUSABLE_PREFIXES:
+            if llm_type == "mistral" and prompt.startswith(prefix):
+                return prompt[len(prefix) :], {"context": LlmClassifier.get_prefix_tokens(prefix, llm_type), "raw": True, "keep_alive": LlmClassifier.keep_alive}
+        return prompt, {"keep_alive": LlmClassifier.keep_alive}
+
+    @staticmethod
+    def complete(prompt: str, llm_type: str) -> tuple[str, int | None]:
+        # response and number of generated tokens, langchain only returns the text so the count is unknown (None) there
+        if (LlmClassifier.pool is not None or LlmClassifier.prefix_reuse) and llm_type in LlmClassifier.OLLAMA_MODELS:
+            prompt, kwargs = LlmClassifier.split_prefix(prompt, llm_type)
+            response = LlmClassifier.get_client(llm_type).generate(prompt, **kwargs)
+            return response["response"], response.get("eval_count")
+        return LlmClassifier.LLM[llm_type](prompt), None
+
+    @staticmethod
+    def get_model_name(llm_type: str) -> str:
+        return LlmClassifier.OLLAMA_MODELS.get(llm_type, llm_type)
+
+    @staticmethod
+    def get_prompt_fingerprint(llm_type: str) -> str:
+        # identifies the prompt template and the settings that change the answer, stored with every label (see label_provenance.py).
+        # streaming and `keep_alive` only change how the answer is obtained, not the answer, so they are left out.
+        if LlmClassifier.constrained and llm_type in LlmClassifier.OLLAMA_MODELS:
+            template = PROMPT_JSON + "{citation}" + json.dumps({"format": "json", "num_predict": LlmClassifier.max_tokens})
+        else:
+            template = PROMPT_2_INST + "{citation}[/INST]" if llm_type == "mistral" else PROMPT_2 + "{citation}"
+            if LlmClassifier.prefix_reuse and any(template.startswith(prefix) for prefix in LlmClassifier.REUSABLE_PREFIXES):
+                # sent in raw mode (see `split_prefix`), the model doesn't get ollama's chat template around the prompt
+                template += "\nraw"
+        if LlmClassifier.example_selector is not None:
+            template += "\nfew-shot examples"
+        if LlmClassifier.preprocessor is not None:
+            template += "\npreprocessed " + LlmClassifier.preprocessor.fingerprint()
+        return hashlib.sha256(template.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def build_prompt(citation: str, llm_type: str, citation_id: int = None) -> str:
+        examples = ""
+        if LlmClassifier.example_selector is not None:
+            similar = LlmClassifier.example_selector.select(citation, citation_id=citation_id)
+            if similar:
+                examples = "Here are some similar in text citations and their categories:\n"
+                examples += "".join(f"Citation: {context}\nCategory: {label}\n\n" for context, label in similar)
+                examples += "Citation to classify:\n"
+        return PROMPT_2_INST + examples + citation + "[/INST]" if llm_type == "mistral" else PROMPT_2 + examples + citation
 
     @staticmethod
-    def get_sentiment_class(citation: str, llm_type: str) -> SentimentClass:
+    def get_sentiment_class(citation: str, llm_type: str, citation_id: int = None) -> SentimentClass:
+        if LlmClassifier.preprocessor is not None:
+            original_length = len(citation or "")
+            citation, garbage = LlmClassifier.preprocessor.preprocess(citation)
+            LlmClassifier.stats.record_preprocessing(original_length, 0 if garbage else len(citation), garbage)
+            if garbage:
+                return SentimentClass.BAD_CONTEXT
+
         if llm_type == "random":
             return SentimentClass(random.randint(0, 3))
 
-        prompt = PROMPT_2_INST + citation + "[/INST]" if llm_type == "mistral" else PROMPT_2 + citation
+        if LlmClassifier.constrained and llm_type in LlmClassifier.OLLAMA_MODELS:
+            return LlmClassifier.get_sentiment_class_constrained(citation, llm_type, citation_id)
+
+        prompt = LlmClassifier.build_prompt(citation, llm_type, citation_id)
         if not LlmClassifier.promt_printed:
             print(prompt)
             LlmClassifier.promt_printed = True
 
-        response: str = LlmClassifier.LLM[llm_type](prompt)
+        if LlmClassifier.streaming and llm_type in LlmClassifier.OLLAMA_MODELS:
+            return LlmClassifier.get_sentiment_class_streaming(prompt, llm_type, citation_id)
+
+        response, generated_tokens = LlmClassifier.complete(prompt, llm_type)
 
+        retries = 0
         while "ANSWER:" not in response:
+            if retries >= LlmClassifier.max_retries:
+                LOG.warning(f"no answer after {retries} retries, falling back to {LlmClassifier.fallback_label.name}")
+                LlmClassifier.stats.record(citation_id, generated_tokens, retries, fallback=True)
+                return LlmClassifier.fallback_label
             LOG.info(f"trying again: '{response}'")
-            response = LlmClassifier.LLM[llm_type](prompt)
+            response, tokens = LlmClassifier.complete(prompt, llm_type)
+            generated_tokens = None if generated_tokens is None or tokens is None else generated_tokens + tokens
+            retries += 1
+        LlmClassifier.stats.record(citation_id, generated_tokens, retries, fallback=False)
 
         answer = response.split("ANSWER:")[1].strip().lower()
 
@@ -204,3 +413,82 @@ class LlmClassifier:
         enum_match = max(match, key=lambda x: x[1])[0]
         # LOG.info(f"llm result: '{response}' → '{enum_match}', citation: '{citation}'")
         return enum_match
+
+    @staticmethod
+    def parse_streamed_answer(response: str) -> SentimentClass | None:
+        # a label only counts once it is followed by a word boundary, e.g. "neg" could still become "negative"
+        match = STREAMED_ANSWER_REGEX.search(response)
+        return ANSWER_LABELS[match.group(1).lower()] if match else None
+
+    @staticmethod
+    def get_sentiment_class_streaming(prompt: str, llm_type: str, citation_id: int = None) -> SentimentClass:
+        client = LlmClassifier.get_client(llm_type)
+        prompt, kwargs = LlmClassifier.split_prefix(prompt, llm_type)
+        generated_tokens = 0
+        for attempt in range(LlmClassifier.max_retries + 1):
+            calibrate = (LlmClassifier.stats.streamed_calls + 1) % LlmClassifier.calibration_every == 0
+            start = time.perf_counter()
+            answered_at = None
+            label = None
+            response = ""
+
+            stream = client.generate_stream(prompt, **kwargs)
+            for chunk in stream:
+                response += chunk.get("response", "")
+                generated_tokens += 1 if not chunk.get("done") else 0
+                if label is None:
+                    label = LlmClassifier.parse_streamed_answer(response)
+                    if label is not None:
+                        answered_at = time.perf_counter()
+                        if not calibrate:
+                            stream.close()  # cancels the generation
+                            break
+                if chunk.get("done"):
+                    label = label or LlmClassifier.parse_streamed_answer(response + " ")
+                    break
+
+            end = time.perf_counter()
+            early_exit = label is not None and not calibrate
+            tail_seconds = end - answered_at if calibrate and answered_at is not None else None
+            LlmClassifier.stats.record_stream(end - start, early_exit, tail_seconds)
+            if label is not None:
+                LlmClassifier.stats.record(citation_id, generated_tokens, attempt, fallback=False)
+                return label
+            LOG.info(f"trying again: '{response}'")
+
+        LOG.warning(f"no answer after {LlmClassifier.max_retries} retries, falling back to {LlmClassifier.fallback_label.name}")
+        LlmClassifier.stats.record(citation_id, generated_tokens, LlmClassifier.max_retries, fallback=True)
+        return LlmClassifier.fallback_label
+
+    @staticmethod
+    def parse_json_answer(response: str) -> SentimentClass | None:
+        # the output is grammar constrained to json, but it can still be cut off by the token budget
+        try:
+            answer = json.loads(response).get("answer", "")
+        except (json.JSONDecodeError, AttributeError):
+            match = re.search(r'"answer"\s*:\s*"([^"]*)', response)
+            answer = match.group(1) if match else ""
+        return ANSWER_LABELS.get(str(answer).strip().lower())
+
+    @staticmethod
+    def get_sentiment_class_constrained(citation: str, llm_type: str, citation_id: int = None) -> SentimentClass:
+        # see: https://github.com/ollama/ollama/blob/main/docs/api.md#request-json-mode
+        client = LlmClassifier.get_client(llm_type)
+        prompt = PROMPT_JSON + citation
+        options = {"num_predict": LlmClassifier.max_tokens, "stop": ["}", "\n\n"], "temperature": 0}
+        kwargs = {"keep_alive": LlmClassifier.keep_alive} if LlmClassifier.prefix_reuse else {}
+
+        generated_tokens = 0
+        for attempt in range(LlmClassifier.max_retries + 1):
+            response = client.generate(prompt, options=options, format="json", **kwargs)
+            generated_tokens += response.get("eval_count", 0)
+            label = LlmClassifier.parse_json_answer(response.get("response", "") + "}")
+            if label is not None:
+                LlmClassifier.stats.record(citation_id, generated_tokens, attempt, fallback=False)
+                return label
+            LOG.info(f"trying again: '{response.get('response')}'")
+            options["temperature"] = 0.7  # a deterministic retry would give the same answer
+
+        LOG.warning(f"no valid answer after {LlmClassifier.max_retries} retries, falling back to {LlmClassifier.fallback_label.name}")
+        LlmClassifier.stats.record(citation_id, generated_tokens, LlmClassifier.max_retries, fallback=True)
+        return LlmClassifier.fallback_label
@@ -0,0 +1,37 @@
+import gc
+import os
+import sys
+import resource
+
+from logger import LOG_SINGLETON as LOG
+
+
+def current_rss_mb() -> float:
+    # resident set size of this process. /proc is linux only, elsewhere the peak is the best we get without extra dependencies
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if sys.platform == "darwin" else peak / 2**10  # bytes on macos, kilobytes on linux
+
+
+class MemoryGuard:
+    # checked between batches of the ingestion. above the ceiling the session is recycled and garbage collected first,
+    # if that doesn't help the run stops – progress flags are committed per paper, so it can be resumed.
+
+    def __init__(self, max_memory_mb: float = None):
+        self.max_memory_mb = max_memory_mb
+        self.peak_mb = 0.0
+
+    def check(self, db):
+        rss = current_rss_mb()
+        self.peak_mb = max(self.peak_mb, rss)
+        if self.max_memory_mb is None or rss <= self.max_memory_mb:
+            return
+        db.recycle_session()
+        gc.collect()
+        rss = current_rss_mb()
+        if rss > self.max_memory_mb:
+            raise MemoryError(f"memory usage {rss:.0f} MB exceeds --max-memory-mb {self.max_memory_mb:.0f} MB, rerun to resume")
+        LOG.info(f"recycled the database session to stay below {self.max_memory_mb:.0f} MB ({rss:.0f} MB)")
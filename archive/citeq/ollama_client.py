@@ -0,0 +1,36 @@
+import os
+import json
+import requests
+
+# see: https://github.com/ollama/ollama/blob/main/docs/api.md#generate-a-completion
+DEFAULT_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+
+
+class OllamaClient:
+    def __init__(self, model: str, host: str = DEFAULT_HOST, timeout: float = 300):
+        self.model = model
+        self.host = host.rstrip("/")
+        self.timeout = timeout
+
+    def generate(self, prompt: str, options: dict = None, format: str = None, **kwargs) -> dict:
+        body = {"model": self.model, "prompt": prompt, "stream": False, "options": options or {}}
+        if format is not None:
+            body["format"] = format
+        body.update(kwargs)
+        r = requests.post(f"{self.host}/api/generate", json=body, timeout=self.timeout)
+        r.raise_for_status()
+        return r.json()
+
+    def generate_stream(self, prompt: str, options: dict = None, **kwargs):
+        # yields the json chunks as they arrive. closing the generator closes the connection, which makes ollama stop generating.
+        # see: https://github.com/ollama/ollama/blob/main/docs/api.md#response
+        body = {"model": self.model, "prompt": prompt, "stream": True, "options": options or {}}
+        body.update(kwargs)
+        r = requests.post(f"{self.host}/api/generate", json=body, stream=True, timeout=self.timeout)
+        try:
+            r.raise_for_status()
+            for line in r.iter_lines():
+                if line:
+                    yield json.loads(line)
+        finally:
+            r.close()
@@ -0,0 +1,149 @@
+import os
+import threading
+import time
+import requests
+
+from logger import LOG_SINGLETON as LOG
+from ollama_client import OllamaClient
+
+# errors after which a host is considered dead and the request is retried elsewhere
+FAILOVER_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+class OllamaHost:
+    def __init__(self, url: str, max_concurrency: int):
+        self.url = url.rstrip("/")
+        self.max_concurrency = max_concurrency
+        self.outstanding = 0
+        self.healthy = True
+        self.completed = 0
+        self.failures = 0
+
+    def __repr__(self):
+        return f"OllamaHost({self.url}, outstanding={self.outstanding}, healthy={self.healthy})"
+
+
+class OllamaHostPool:
+    # spreads requests over several ollama servers.
+    # scheduling picks the healthy host with the fewest outstanding requests, each host is capped at `max_concurrency` requests.
+    # a host that fails is marked unhealthy and the request is retried on another one, a background thread brings it back once it responds again.
+
+    def __init__(self, urls: list, max_concurrency: int = 2, health_interval: float = 15, health_timeout: float = 2):
+        assert len(urls) > 0, "no ollama hosts configured"
+        self.hosts = [OllamaHost(url, max_concurrency) for url in urls]
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.condition = threading.Condition()
+        self.closed = False
+        self.check_health()
+        self.health_thread = threading.Thread(target=self.health_loop, daemon=True)
+        self.health_thread.start()
+
+    @staticmethod
+    def from_env(max_concurrency: int = 2) -> "OllamaHostPool | None":
+        urls = [url.strip() for url in os.getenv("OLLAMA_HOSTS", "").split(",") if url.strip()]
+        return OllamaHostPool(urls, max_concurrency) if urls else None
+
+    def is_alive(self, host: OllamaHost) -> bool:
+        # see: https://github.com/ollama/ollama/blob/main/docs/api.md#list-local-models
+        try:
+            return requests.get(f"{host.url}/api/tags", timeout=self.health_timeout).status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+
+    def check_health(self):
+        for host in self.hosts:
+            alive = self.is_alive(host)
+            with self.condition:
+                if alive != host.healthy:
+                    LOG.warning(f"ollama host {host.url} is {'back up' if alive else 'down'}")
+                host.healthy = alive
+                self.condition.notify_all()
+
+    def health_loop(self):
+        while not self.closed:
+            time.sleep(self.health_interval)
+            self.check_health()
+
+    def acquire(self, exclude: set = (), timeout: float = 300) -> OllamaHost:
+        # blocks while all hosts are busy or down, dead hosts may come back through the health checks
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                if all(host.url in exclude for host in self.hosts):
+                    raise requests.exceptions.ConnectionError("all ollama hosts failed")
+                candidates = [host for host in self.hosts if host.healthy and host.url not in exclude and host.outstanding < host.max_concurrency]
+                if candidates:
+                    host = min(candidates, key=lambda host: host.outstanding)
+                    host.outstanding += 1
+                    return host
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise requests.exceptions.ConnectionError("timed out waiting for an ollama host")
+                self.condition.wait(timeout=min(remaining, self.health_interval))
+
+    def release(self, host: OllamaHost, failed: bool = False):
+        with self.condition:
+            host.outstanding -= 1
+            if failed:
+                host.failures += 1
+                host.healthy = False
+            else:
+                host.completed += 1
+            self.condition.notify_all()
+
+    def run(self, request):
+        # `request(host)` is retried on another host if the current one dies
+        tried = set()
+        while True:
+            host = self.acquire(exclude=tried)
+            try:
+                result = request(host)
+            except FAILOVER_ERRORS as e:
+                self.release(host, failed=True)
+                tried.add(host.url)
+                LOG.warning(f"ollama host {host.url} failed ({type(e).__name__}), failing over")
+                continue
+            self.release(host)
+            return result
+
+    def stats(self) -> list:
+        with self.condition:
+            return [{"host": host.url, "healthy": host.healthy, "outstanding": host.outstanding, "completed": host.completed, "failures": host.failures} for host in self.hosts]
+
+    def close(self):
+        self.closed = True
+
+
+class PooledOllamaClient:
+    # drop-in replacement for `OllamaClient` that routes every request through a `OllamaHostPool`
+
+    def __init__(self, model: str, pool: OllamaHostPool, timeout: float = 300):
+        self.model = model
+        self.pool = pool
+        self.timeout = timeout
+
+    def generate(self, prompt: str, options: dict = None, format: str = None, **kwargs) -> dict:
+        return self.pool.run(lambda host: OllamaClient(self.model, host.url, self.timeout).generate(prompt, options, format, **kwargs))
+
+    def generate_stream(self, prompt: str, options: dict = None, **kwargs):
+        # a stream can only fail over before its first chunk, after that the caller has already consumed partial output
+        tried = set()
+        while True:
+            host = self.pool.acquire(exclude=tried)
+            received = False
+            failed = False
+            try:
+                for chunk in OllamaClient(self.model, host.url, self.timeout).generate_stream(prompt, options, **kwargs):
+                    received = True
+                    yield chunk
+            except FAILOVER_ERRORS:
+                failed = True
+                tried.add(host.url)
+                if received:
+                    raise
+                LOG.warning(f"ollama host {host.url} failed before streaming, failing over")
+                continue
+            finally:
+                self.pool.release(host, failed=failed)
+            return
@@ -0,0 +1,200 @@
+import os
+import json
+import hashlib
+import shutil
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import requests
+from PyPDF2 import PdfReader
+
+from logger import LOG_SINGLETON as LOG
+from http_client import post_url
+
+STORE_DIR = os.path.join(os.getcwd(), ".cache", "pdfs")
+CHUNK_SIZE = 1 << 16
+
+
+def extract_text(pdf_path: str) -> str | None:
+    # runs in a worker process, pypdf2 is pure python and cpu bound. returns the path of the text file, none if the pdf can't be read
+    txt_path = pdf_path[: -len(".pdf")] + ".txt"
+    if os.path.exists(txt_path):
+        return txt_path
+    try:
+        text = "\n".join(page.extract_text() or "" for page in PdfReader(pdf_path).pages)
+    except Exception as e:
+        LOG.warning(f"could not extract text from {pdf_path}: {e}")
+        return None
+    with open(txt_path + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(txt_path + ".tmp", txt_path)
+    return txt_path
+
+
+class PdfStore:
+    # content addressed: every pdf is stored once under its sha-256, e.g. `.cache/pdfs/ab/ab12….pdf`.
+    # `index.jsonl` maps semantic scholar paper ids to hashes, several papers can point to the same file.
+
+    def __init__(self, root: str = STORE_DIR):
+        self.root = root
+        self.partial_dir = os.path.join(root, "partial")
+        os.makedirs(self.partial_dir, exist_ok=True)
+        self.index_path = os.path.join(root, "index.jsonl")
+        self.index_lock = threading.Lock()
+        self.index = {}
+        if os.path.exists(self.index_path):
+            for line in open(self.index_path, "r"):
+                entry = json.loads(line)
+                self.index[entry["paper_id"]] = entry
+
+    def path_for(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256 + ".pdf")
+
+    def partial_path_for(self, url: str) -> str:
+        return os.path.join(self.partial_dir, hashlib.sha1(url.encode()).hexdigest() + ".part")
+
+    def put(self, tmp_path: str) -> str:
+        sha = hashlib.sha256()
+        with open(tmp_path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                sha.update(chunk)
+        sha256 = sha.hexdigest()
+        path = self.path_for(sha256)
+        if os.path.exists(path):
+            os.remove(tmp_path)  # dedup
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.move(tmp_path, path)
+        return sha256
+
+    def add_to_index(self, paper_id: str, url: str, sha256: str):
+        entry = {"paper_id": paper_id, "url": url, "sha256": sha256}
+        with self.index_lock:
+            self.index[paper_id] = entry
+            with open(self.index_path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def has(self, paper_id: str) -> bool:
+        return paper_id in self.index and os.path.exists(self.path_for(self.index[paper_id]["sha256"]))
+
+
+class PdfPipeline:
+    # resolves open access pdf urls of papers, downloads them concurrently and extracts their text in a process pool.
+    # every `start` runs in its own background thread, so the metadata ingestion doesn't have to wait for it.
+    # downloads are shared between these threads by url, so two runs never write the same partial file.
+
+    def __init__(self, store: PdfStore = None, max_downloads: int = 16, max_per_host: int = 2, max_extractors: int = None):
+        self.store = store or PdfStore()
+        self.max_per_host = max_per_host
+        self.host_limits = {}
+        self.host_limits_lock = threading.Lock()
+        self.downloads = ThreadPoolExecutor(max_workers=max_downloads)
+        self.extractors = ProcessPoolExecutor(max_workers=max_extractors)
+        self.threads = []
+        self.lock = threading.Lock()  # guards `in_flight` and `stats`
+        self.in_flight = {}  # url -> future of its download, kept after completion so later runs reuse the result
+        self.stats = {"resolved": 0, "downloaded": 0, "deduplicated": 0, "failed": 0, "extracted": 0}
+
+    def count(self, key: str, n: int = 1):
+        with self.lock:
+            self.stats[key] += n
+
+    def host_limit(self, url: str) -> threading.Semaphore:
+        host = urlparse(url).netloc
+        with self.host_limits_lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = threading.Semaphore(self.max_per_host)
+            return self.host_limits[host]
+
+    @staticmethod
+    def resolve_urls(paper_ids: list) -> dict:
+        # see: https://api.semanticscholar.org/api-docs/graph#tag/Paper-Data/operation/post_graph_get_papers
+        urls = {}
+        for i in range(0, len(paper_ids), 400):
+            batch = paper_ids[i : i + 400]
+            papers = post_url("https://api.semanticscholar.org/graph/v1/paper/batch", params={"fields": "openAccessPdf"}, json={"ids": batch}).json()
+            for paper_id, paper in zip(batch, papers):
+                if paper is not None and paper.get("openAccessPdf") and paper["openAccessPdf"].get("url"):
+                    urls[paper_id] = paper["openAccessPdf"]["url"]
+        return urls
+
+    def download(self, url: str) -> str | None:
+        # resumable: a partial file is continued with a range request, servers that ignore the range send the whole file again
+        partial_path = self.store.partial_path_for(url)
+        with self.host_limit(url):
+            offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+            headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+            with requests.get(url, headers=headers, stream=True, timeout=60) as r:
+                if r.status_code == 416:  # already complete
+                    pass
+                elif r.status_code in (200, 206):
+                    mode = "ab" if r.status_code == 206 else "wb"
+                    with open(partial_path, mode) as f:
+                        for chunk in r.iter_content(CHUNK_SIZE):
+                            f.write(chunk)
+                else:
+                    LOG.warning(f"could not download pdf from {url}: {r.status_code}")
+                    return None
+
+        with open(partial_path, "rb") as f:
+            if f.read(5) != b"%PDF-":
+                LOG.warning(f"not a pdf: {url}")
+                os.remove(partial_path)
+                return None
+        return self.store.put(partial_path)
+
+    def run(self, paper_ids: list):
+        paper_ids = [paper_id for paper_id in paper_ids if not self.store.has(paper_id)]
+        urls = PdfPipeline.resolve_urls(paper_ids)
+        self.count("resolved", len(urls))
+        LOG.info(f"found {len(urls)} open access pdfs for {len(paper_ids)} papers")
+
+        # several papers can share a url, only download it once, also across runs
+        papers_of_url = {}
+        for paper_id, url in urls.items():
+            papers_of_url.setdefault(url, []).append(paper_id)
+        downloads, started = {}, set()
+        with self.lock:
+            for url in papers_of_url:
+                if url not in self.in_flight:
+                    self.in_flight[url] = self.downloads.submit(self.download, url)
+                    started.add(url)
+                downloads[url] = self.in_flight[url]
+
+        extractions = {}
+        for url, future in downloads.items():
+            try:
+                sha256 = future.result()
+            except Exception as e:
+                LOG.warning(f"download failed: {url} ({e})")
+                sha256 = None
+            if sha256 is None:
+                self.count("failed")
+                continue
+            for paper_id in papers_of_url[url]:
+                self.store.add_to_index(paper_id, url, sha256)
+            # the first paper of a url downloaded it, unless another run did
+            self.count("downloaded", 1 if url in started else 0)
+            self.count("deduplicated", len(papers_of_url[url]) - (1 if url in started else 0))
+            if sha256 not in extractions:  # different urls can serve the same file
+                extractions[sha256] = self.extractors.submit(extract_text, self.store.path_for(sha256))
+
+        for future in as_completed(extractions.values()):
+            try:
+                extracted = future.result() is not None
+            except Exception as e:
+                LOG.warning(f"text extraction failed: {e}")
+                extracted = False
+            self.count("extracted" if extracted else "failed")
+        LOG.info(f"pdf pipeline: {self.stats}")
+
+    def start(self, paper_ids: list):
+        thread = threading.Thread(target=self.run, args=(list(paper_ids),), daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+        self.downloads.shutdown()
+        self.extractors.shutdown()
@@ -0,0 +1,124 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+from collections import Counter, defaultdict
+
+from logger import LOG_SINGLETON as LOG
+
+# `--profile`: wall and cpu time per pipeline stage plus a sampling profiler.
+# the sampler reads the stacks of all threads every `interval` seconds from a background thread (like py-spy, but in-process),
+# so the pipeline itself isn't instrumented and the overhead stays at a few percent – unlike cProfile, which hooks every call.
+#
+# writes to profiles/<timestamp>/:
+#   stages.json        {stage: {calls, wall, cpu, samples by category}}
+#   stacks.collapsed   "stage;thread;frame;frame;... count" per line, for flamegraph.pl, speedscope or inferno
+#
+# see: https://www.brendangregg.com/flamegraphs.html and https://www.speedscope.app
+
+PROFILE_DIR = os.path.join(os.getcwd(), "profiles")
+
+# where the main thread spends its time, decided by the innermost matching file of a sampled stack
+CATEGORIES = [
+    ("llm", ("ollama_client", "llm_classifier", "ollama_pool", "openai")),
+    ("fuzzy matching", ("thefuzz", "rapidfuzz", "fuzzywuzzy")),
+    ("sqlite", ("sqlalchemy", "sqlite3")),
+    ("network", ("requests", "urllib3", "http/client", "socket", "ssl")),
+]
+
+
+def frame_name(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def categorize(codes: list) -> str:
+    # innermost first
+    for code in codes:
+        filename = code.co_filename
+        for category, patterns in CATEGORIES:
+            if any(pattern in filename for pattern in patterns):
+                return category
+    return "python"
+
+
+class Profiler:
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.enabled = False
+        self.stages = defaultdict(lambda: {"calls": 0, "wall": 0.0, "cpu": 0.0, "samples": Counter()})
+        self.stack = []  # stages of the main thread, innermost last
+        self.samples = Counter()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.main_thread_id = threading.main_thread().ident
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        self.stack.append(name)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            stats = self.stages[name]
+            stats["calls"] += 1
+            stats["wall"] += time.perf_counter() - wall
+            stats["cpu"] += time.process_time() - cpu  # all threads of the process, e.g. the pdf pipeline
+            self.stack.pop()
+
+    def start(self):
+        self.enabled = True
+        self.started = time.time()
+        self.thread = threading.Thread(target=self.sample_loop, name="profiler", daemon=True)
+        self.thread.start()
+
+    def sample_loop(self):
+        names = {}
+        while not self.stop_event.wait(self.interval):
+            stage = self.stack[-1] if self.stack else "other"
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.thread.ident:
+                    continue
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                # code objects are hashable, the stacks are only formatted once when writing
+                self.samples[(stage, names.get(thread_id, str(thread_id)), tuple(codes))] += 1
+                if thread_id == self.main_thread_id:
+                    self.stages[stage]["samples"][categorize(codes)] += 1
+
+    def stop(self) -> str:
+        if not self.enabled:
+            return None
+        self.stop_event.set()
+        self.thread.join()
+        self.enabled = False
+
+        path = os.path.join(PROFILE_DIR, time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started)))
+        os.makedirs(path, exist_ok=True)
+        stages = {name: {**stats, "samples": dict(stats["samples"])} for name, stats in self.stages.items()}
+        json.dump({"interval": self.interval, "stages": stages}, open(os.path.join(path, "stages.json"), "w"), indent=4)
+        with open(os.path.join(path, "stacks.collapsed"), "w") as f:
+            for (stage, thread, codes), count in self.samples.most_common():
+                stack = ";".join([stage, thread] + [frame_name(code) for code in reversed(codes)])
+                f.write(f"{stack.replace(' ', '_')} {count}\n")
+
+        LOG.info(f"{'stage':>12} {'calls':>6} {'wall s':>9} {'cpu s':>9} {'cpu/wall':>8}  main thread samples")
+        for name, stats in stages.items():
+            if stats["calls"] == 0:
+                continue
+            total = sum(stats["samples"].values()) or 1
+            breakdown = ", ".join(f"{category} {count / total:.0%}" for category, count in sorted(stats["samples"].items(), key=lambda item: -item[1]))
+            LOG.info(f"{name:>12} {stats['calls']:>6} {stats['wall']:>9.2f} {stats['cpu']:>9.2f} {stats['cpu'] / max(stats['wall'], 1e-9):>8.0%}  {breakdown}")
+        LOG.info(f"profile written to '{path}'")
+        return path
+
+
+PROFILER = Profiler()
@@ -0,0 +1,273 @@
+import asyncio
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from sqlalchemy import create_engine, text
+
+from db import get_dataset_version
+from s2_ids import S2Ids
+from citation_metrics import LABELS
+from logger import LOG_SINGLETON as LOG
+
+# read-only http api over the sentiment labels, replaces re-running the notebook joins (`get_numbers_by_author`) for dashboards.
+#
+#   GET /researchers                      all researchers with their sentiment breakdown (paginated)
+#   GET /researchers/{semantic_scholar_id} breakdown of one researcher, total and per year
+#   GET /researchers/{semantic_scholar_id}/papers
+#   GET /papers/{semantic_scholar_id}
+#   GET /venues, /years
+#   GET /stats                            cache statistics
+#
+# paginated endpoints take `?offset=&limit=` and return `next_offset` (null on the last page).
+# all endpoints take `?self_citations=include|exclude|only`, see self_citations.py. unknown authorships count as independent.
+# every aggregate is computed once per dataset version and then served from an in-process lru cache.
+
+MAX_PAGE_SIZE = 1000
+DEFAULT_PAGE_SIZE = 100
+
+# a citation belongs to the researcher whose paper is cited, see `get_citations` in __main__.py
+SENTIMENT_COLUMNS = ", ".join([f"COALESCE(SUM(c.llm_purpose = '{label}'), 0) AS {label.lower()}" for label in LABELS] + ["COUNT(c.id) - COUNT(c.llm_purpose) AS unlabelled"])
+
+SELF_CITATION_FILTERS = {"include": "", "exclude": " AND c.self_citation IS NOT 1", "only": " AND c.self_citation = 1"}
+
+QUERIES = {
+    "researchers": f"""
+        SELECT r.semantic_scholar_id, r.name, r.h_index, r.institution, COUNT(DISTINCT p.id) AS paper_count, {SENTIMENT_COLUMNS}
+        FROM researchers r
+        LEFT JOIN authorships a ON a.researcher_id = r.id
+        LEFT JOIN papers p ON p.id = a.paper_id
+        LEFT JOIN citations c ON c.cited_paper_id = p.{{paper_key}}{{self_citations}}
+        GROUP BY r.id
+        ORDER BY r.name, r.id
+    """,
+    "researcher": f"""
+        SELECT r.semantic_scholar_id, r.name, r.h_index, r.institution, COUNT(DISTINCT p.id) AS paper_count, {SENTIMENT_COLUMNS}
+        FROM researchers r
+        LEFT JOIN authorships a ON a.researcher_id = r.id
+        LEFT JOIN papers p ON p.id = a.paper_id
+        LEFT JOIN citations c ON c.cited_paper_id = p.{{paper_key}}{{self_citations}}
+        WHERE r.semantic_scholar_id = :key
+        GROUP BY r.id
+    """,
+    "researcher_years": f"""
+        SELECT p.year, COUNT(DISTINCT p.id) AS paper_count, {SENTIMENT_COLUMNS}
+        FROM researchers r
+        JOIN authorships a ON a.researcher_id = r.id
+        JOIN papers p ON p.id = a.paper_id
+        LEFT JOIN citations c ON c.cited_paper_id = p.{{paper_key}}{{self_citations}}
+        WHERE r.semantic_scholar_id = :key
+        GROUP BY p.year
+        ORDER BY p.year
+    """,
+    "researcher_papers": f"""
+        SELECT p.semantic_scholar_id, p.title, p.year, p.venue, a.author_order, {SENTIMENT_COLUMNS}
+        FROM researchers r
+        JOIN authorships a ON a.researcher_id = r.id
+        JOIN papers p ON p.id = a.paper_id
+        LEFT JOIN citations c ON c.cited_paper_id = p.{{paper_key}}{{self_citations}}
+        WHERE r.semantic_scholar_id = :key
+        GROUP BY p.id
+        ORDER BY p.year DESC, p.id
+    """,
+    "paper": f"""
+        SELECT p.semantic_scholar_id, p.title, p.year, p.venue, p.citation_count, {SENTIMENT_COLUMNS}
+        FROM papers p
+        LEFT JOIN citations c ON c.cited_paper_id = p.{{paper_key}}{{self_citations}}
+        WHERE p.semantic_scholar_id = :key
+        GROUP BY p.id
+    """,
+    "venues": f"""
+        SELECT p.venue, COUNT(DISTINCT p.id) AS paper_count, {SENTIMENT_COLUMNS}
+        FROM papers p
+        LEFT JOIN citations c ON c.cited_paper_id = p.{{paper_key}}{{self_citations}}
+        WHERE p.venue IS NOT NULL AND p.venue != ''
+        GROUP BY p.venue
+        ORDER BY paper_count DESC, p.venue
+    """,
+    "years": f"""
+        SELECT p.year, COUNT(DISTINCT p.id) AS paper_count, {SENTIMENT_COLUMNS}
+        FROM papers p
+        LEFT JOIN citations c ON c.cited_paper_id = p.{{paper_key}}{{self_citations}}
+        GROUP BY p.year
+        ORDER BY p.year
+    """,
+}
+
+
+def read_only_engine(db_path: str):
+    # `mode=ro` makes sqlite refuse writes, so the service can run next to a crawl or classification job
+    # see: https://www.sqlite.org/uri.html
+    return create_engine(f"sqlite+pysqlite:///file:{db_path}?mode=ro&uri=true")
+
+
+class QueryCache:
+    # lru cache of computed results. entries are tagged with the dataset version they were computed for,
+    # so a new version simply stops matching and old entries age out.
+    # concurrent misses for the same key share one pending computation.
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: tuple, compute):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return await asyncio.shield(entry)
+
+        self.misses += 1
+        entry = asyncio.ensure_future(compute())
+        self.entries[key] = entry
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        try:
+            return await asyncio.shield(entry)
+        except Exception:
+            self.entries.pop(key, None)  # don't cache failures
+            raise
+
+    def clear(self):
+        self.entries.clear()
+
+
+class QueryService:
+    def __init__(self, db_path: str = "./citeQ.db", cache_size: int = 1024, threads: int = 8, version_poll_seconds: float = 1.0):
+        self.engine = read_only_engine(db_path)
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.cache = QueryCache(cache_size)
+        self.version_poll_seconds = version_poll_seconds
+        self.dataset_version = None
+        self.data_version = None
+
+    def run_query(self, name: str, self_citations: str, params: dict) -> list[dict]:
+        with self.engine.connect() as connection:
+            query = QUERIES[name].format(self_citations=SELF_CITATION_FILTERS[self_citations], paper_key=S2Ids.paper_key(connection))
+            return [dict(row._mapping) for row in connection.execute(text(query), params)]
+
+    async def query(self, name: str, self_citations: str = "include", **params) -> list[dict]:
+        key = (self.dataset_version, name, self_citations, tuple(sorted(params.items())))
+        loop = asyncio.get_running_loop()
+        return await self.cache.get(key, lambda: loop.run_in_executor(self.executor, self.run_query, name, self_citations, params))
+
+    @staticmethod
+    def get_self_citations(request) -> str:
+        self_citations = request.query.get("self_citations", "include")
+        if self_citations not in SELF_CITATION_FILTERS:
+            raise web.HTTPBadRequest(text=f"self_citations must be one of {', '.join(SELF_CITATION_FILTERS)}")
+        return self_citations
+
+    def check_version(self, connection) -> bool:
+        # `PRAGMA data_version` is free and changes whenever another connection commits,
+        # only then the (more expensive) dataset version stamp is recomputed.
+        # see: https://www.sqlite.org/pragma.html#pragma_data_version
+        data_version = connection.execute(text("PRAGMA data_version")).scalar()
+        if data_version == self.data_version:
+            connection.rollback()
+            return False
+        self.data_version = data_version
+        dataset_version = get_dataset_version(connection)
+        connection.rollback()  # don't hold on to a read snapshot between polls
+        changed = dataset_version != self.dataset_version
+        self.dataset_version = dataset_version
+        return changed
+
+    async def watch_version(self, app):
+        loop = asyncio.get_running_loop()
+        connection = self.engine.connect()  # data_version is per connection, keep the same one
+        try:
+            while True:
+                if await loop.run_in_executor(self.executor, self.check_version, connection):
+                    LOG.info(f"dataset version is now {self.dataset_version}, cache invalidated")
+                    self.cache.clear()
+                await asyncio.sleep(self.version_poll_seconds)
+        finally:
+            connection.close()
+
+    @staticmethod
+    def get_page(request) -> tuple[int, int]:
+        try:
+            offset = max(0, int(request.query.get("offset", 0)))
+            limit = min(MAX_PAGE_SIZE, max(1, int(request.query.get("limit", DEFAULT_PAGE_SIZE))))
+        except ValueError:
+            raise web.HTTPBadRequest(text="offset and limit must be integers")
+        return offset, limit
+
+    def paginate(self, request, rows: list) -> web.Response:
+        offset, limit = QueryService.get_page(request)
+        next_offset = offset + limit if offset + limit < len(rows) else None
+        return web.json_response({"dataset_version": self.dataset_version, "total": len(rows), "offset": offset, "next_offset": next_offset, "items": rows[offset : offset + limit]})
+
+    async def researchers(self, request):
+        return self.paginate(request, await self.query("researchers", self.get_self_citations(request)))
+
+    async def researcher(self, request):
+        key, self_citations = request.match_info["id"], self.get_self_citations(request)
+        rows = await self.query("researcher", self_citations, key=key)
+        if not rows:
+            raise web.HTTPNotFound(text=f"researcher '{key}' not found")
+        return web.json_response({"dataset_version": self.dataset_version, **rows[0], "years": await self.query("researcher_years", self_citations, key=key)})
+
+    async def researcher_papers(self, request):
+        key, self_citations = request.match_info["id"], self.get_self_citations(request)
+        if not await self.query("researcher", self_citations, key=key):
+            raise web.HTTPNotFound(text=f"researcher '{key}' not found")
+        return self.paginate(request, await self.query("researcher_papers", self_citations, key=key))
+
+    async def paper(self, request):
+        key = request.match_info["id"]
+        rows = await self.query("paper", self.get_self_citations(request), key=key)
+        if not rows:
+            raise web.HTTPNotFound(text=f"paper '{key}' not found")
+        return web.json_response({"dataset_version": self.dataset_version, **rows[0]})
+
+    async def venues(self, request):
+        return self.paginate(request, await self.query("venues", self.get_self_citations(request)))
+
+    async def years(self, request):
+        return self.paginate(request, await self.query("years", self.get_self_citations(request)))
+
+    async def stats(self, request):
+        return web.json_response({"dataset_version": self.dataset_version, "cache_entries": len(self.cache.entries), "cache_hits": self.cache.hits, "cache_misses": self.cache.misses})
+
+    async def start_background_tasks(self, app):
+        with self.engine.connect() as connection:
+            self.dataset_version = get_dataset_version(connection)
+        app["version_watcher"] = asyncio.create_task(self.watch_version(app))
+
+    async def stop_background_tasks(self, app):
+        app["version_watcher"].cancel()
+        self.executor.shutdown(wait=False)
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes(
+            [
+                web.get("/researchers", self.researchers),
+                web.get("/researchers/{id}", self.researcher),
+                web.get("/researchers/{id}/papers", self.researcher_papers),
+                web.get("/papers/{id}", self.paper),
+                web.get("/venues", self.venues),
+                web.get("/years", self.years),
+                web.get("/stats", self.stats),
+            ]
+        )
+        app.on_startup.append(self.start_background_tasks)
+        app.on_cleanup.append(self.stop_background_tasks)
+        return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="serve sentiment statistics from a read-only connection to the database")
+    parser.add_argument("--db", type=str, default="./citeQ.db")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--cache-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    service = QueryService(args.db, cache_size=args.cache_size)
+    LOG.info(f"serving '{args.db}' on http://{args.host}:{args.port}")
+    web.run_app(service.make_app(), host=args.host, port=args.port, print=None, access_log=None)
@@ -0,0 +1,212 @@
+import os
+import time
+import random
+import threading
+import email.utils
+from urllib.parse import urlparse
+import requests
+
+from logger import LOG_SINGLETON as LOG
+
+# central rate control for the apis we crawl. every request to a known api goes through its `ApiLimiter`:
+#
+#   token bucket     requests per second, starts at the documented quota
+#   pause            `Retry-After` and exhausted `X-RateLimit-*` headers stop all requests to the api until the given time
+#   aimd             concurrency (and the bucket rate) are halved on 429s or when latency degrades, and grow back additively
+#
+# see: https://www.semanticscholar.org/product/api#api-key and https://docs.openalex.org/how-to-use-the-api/rate-limits-and-authentication
+# quotas can be overridden with S2_RATE_LIMIT / OPENALEX_RATE_LIMIT (requests per second).
+
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        # seconds until a token is available, takes it if there is one
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class ApiLimiter:
+    def __init__(self, name: str, rate: float, burst: float = None, max_concurrency: int = 8, latency_threshold: float = 10.0):
+        self.name = name
+        self.max_rate = rate
+        self.bucket = TokenBucket(rate, burst if burst is not None else max(1.0, rate))
+        self.max_concurrency = max_concurrency
+        self.concurrency = max(1.0, max_concurrency / 2)  # aimd window, fractional so it can grow by 1/window per success
+        self.latency_threshold = latency_threshold  # seconds, slower responses count as congestion
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.metrics = {"requests": 0, "retries": 0, "throttled": 0, "throttled_seconds": 0.0, "pauses": 0, "paused_seconds": 0.0, "429": 0, "errors": 0, "decreases": 0, "latency_ewma": None}
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.concurrency):
+                self.condition.wait()
+            self.in_flight += 1
+            start = time.monotonic()
+            while True:
+                now = time.monotonic()
+                delay = max(self.paused_until - now, 0.0) or self.bucket.wait_time(now)
+                if delay <= 0:
+                    break
+                self.condition.wait(delay)  # releases the lock while sleeping
+            waited = time.monotonic() - start
+            if waited > 0.001:
+                self.metrics["throttled"] += 1
+                self.metrics["throttled_seconds"] += waited
+
+    def release(self, latency: float = None, congested: bool = False):
+        with self.condition:
+            self.in_flight -= 1
+            self.metrics["requests"] += 1
+            if latency is not None:
+                ewma = self.metrics["latency_ewma"]
+                self.metrics["latency_ewma"] = latency if ewma is None else 0.8 * ewma + 0.2 * latency
+            if congested or (latency is not None and latency > self.latency_threshold):
+                self.decrease()
+            else:
+                # additive increase: +1 per window of successful requests, the rate recovers by 5% of the quota
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+                self.bucket.rate = min(self.max_rate, self.bucket.rate + 0.05 * self.max_rate / max(self.concurrency, 1))
+            self.condition.notify_all()
+
+    def decrease(self):
+        # multiplicative decrease, at most once per second so a burst of 429s from one window only counts once
+        now = time.monotonic()
+        if now - self.last_decrease < 1.0:
+            return
+        self.last_decrease = now
+        self.concurrency = max(1.0, self.concurrency / 2)
+        self.bucket.rate = max(self.max_rate / 16, self.bucket.rate / 2)
+        self.metrics["decreases"] += 1
+
+    def pause(self, seconds: float, reason: str):
+        with self.condition:
+            until = time.monotonic() + seconds
+            if until > self.paused_until:
+                self.metrics["pauses"] += 1
+                self.metrics["paused_seconds"] += until - max(self.paused_until, time.monotonic())
+                self.paused_until = until
+                LOG.warning(f"{self.name}: pausing requests for {seconds:.1f}s ({reason})")
+
+    def observe_headers(self, headers):
+        retry_after = parse_retry_after(headers.get("Retry-After"))
+        if retry_after is not None:
+            self.pause(retry_after, "Retry-After")
+            return
+        remaining = headers.get("X-RateLimit-Remaining") or headers.get("RateLimit-Remaining")
+        reset = headers.get("X-RateLimit-Reset") or headers.get("RateLimit-Reset")
+        if remaining is not None and reset is not None:
+            try:
+                remaining, reset = float(remaining), float(reset)
+            except ValueError:
+                return
+            if remaining <= 0:
+                # reset is either a unix timestamp or a number of seconds
+                self.pause(max(0.0, reset - time.time()) if reset > 1e9 else reset, "rate limit exhausted")
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {**self.metrics, "rate": round(self.bucket.rate, 3), "concurrency": round(self.concurrency, 2), "in_flight": self.in_flight}
+
+
+def parse_retry_after(value) -> float | None:
+    # either delay-seconds or an http date, see: https://www.rfc-editor.org/rfc/rfc9110#field.retry-after
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateController:
+    limiters = {}
+    lock = threading.Lock()
+    max_tries = 8
+    timeout = 60
+
+    @staticmethod
+    def get_limiter(url: str) -> ApiLimiter | None:
+        host = urlparse(url).hostname or ""
+        if host.endswith("semanticscholar.org"):
+            name = "s2-keyed" if os.getenv("S2_API_KEY") else "s2"
+            # keyed: 1 request per second for introductory keys. unkeyed: a pool shared by everyone, so stay well below it
+            rate, concurrency = float(os.getenv("S2_RATE_LIMIT", 1.0 if os.getenv("S2_API_KEY") else 0.5)), 4
+        elif host.endswith("openalex.org"):
+            name, rate, concurrency = "openalex", float(os.getenv("OPENALEX_RATE_LIMIT", 10.0)), 10
+        else:
+            return None
+        with RateController.lock:
+            if name not in RateController.limiters:
+                RateController.limiters[name] = ApiLimiter(name, rate, max_concurrency=concurrency)
+            return RateController.limiters[name]
+
+    @staticmethod
+    def request(method: str, url: str, retry_404: bool = False, **kwargs) -> requests.Response:
+        limiter = RateController.get_limiter(url)
+        if limiter is not None and limiter.name == "s2-keyed":
+            kwargs["headers"] = {"x-api-key": os.getenv("S2_API_KEY"), **(kwargs.get("headers") or {})}
+        kwargs.setdefault("timeout", RateController.timeout)
+
+        for attempt in range(RateController.max_tries):
+            if limiter is not None:
+                limiter.acquire()
+            start = time.monotonic()
+            try:
+                r = requests.request(method, url, **kwargs)
+            except requests.exceptions.RequestException as e:
+                if limiter is not None:
+                    with limiter.condition:
+                        limiter.metrics["errors"] += 1
+                    limiter.release(congested=True)
+                LOG.warning(f"request failed ({type(e).__name__}) - retrying")
+                time.sleep(min(60, 2**attempt) * random.uniform(0.5, 1.0))
+                continue
+
+            latency = time.monotonic() - start
+            if limiter is not None:
+                limiter.observe_headers(r.headers)
+                if r.status_code == 429:
+                    with limiter.condition:
+                        limiter.metrics["429"] += 1
+                limiter.release(latency, congested=r.status_code in RETRY_STATUS_CODES)
+
+            if r.status_code in RETRY_STATUS_CODES or (r.status_code == 404 and retry_404):
+                LOG.warning(f"request failed with status code {r.status_code} - retrying")
+                if limiter is not None:
+                    with limiter.condition:
+                        limiter.metrics["retries"] += 1
+                    if r.status_code != 429 or parse_retry_after(r.headers.get("Retry-After")) is None:
+                        limiter.pause(min(60, 2**attempt) * random.uniform(0.5, 1.0), f"status {r.status_code}")
+                else:
+                    time.sleep(min(60, 2**attempt) * random.uniform(0.5, 1.0))
+                continue
+            return r
+        raise requests.exceptions.RetryError(f"giving up on {url} after {RateController.max_tries} tries")
+
+    @staticmethod
+    def stats() -> dict:
+        with RateController.lock:
+            limiters = list(RateController.limiters.values())
+        return {limiter.name: limiter.stats() for limiter in limiters}
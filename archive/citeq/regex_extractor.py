@@ -1,106 +1,151 @@
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from unstructured.partition.pdf import partition_pdf
 from nltk.tokenize import sent_tokenize
-import re
 
-# this class is unused because it is not robust enough to handle all the different
-# kinds of pdfs that are out there. it is kept here for reference purposes only.
+from logger import LOG_SINGLETON as LOG
+
+# extracts (reference, citing sentence) pairs from a pdf in a single pass over its partitioned elements.
+# supports numeric ("[3]", "[1, 4-6]") and author-year ("(Och and Ney, 2000; Chiang 2005)", "Chiang (2005)") citation styles.
+# citations that can't be matched to a reference are skipped instead of raising.
+
+REFERENCES_HEADING_REGEX = re.compile(r"^\s*(?:\d+\.?\s*)?(?:references|bibliography|literature cited)\s*$", re.IGNORECASE)
+NUMERIC_REFERENCE_REGEX = re.compile(r"\[(\d+)\]")
+NUMERIC_CITATION_REGEX = re.compile(r"\[(\d+(?:\s*[-–,]\s*\d+)*)\]")
+PARENTHETICAL_CITATION_REGEX = re.compile(r"\(([^()]*?(?:1[89]|20)\d{2}[a-z]?)\)")
+NARRATIVE_CITATION_REGEX = re.compile(r"\b([A-Z][\w'-]+)(?:\s+et\s+al\.?|\s+(?:and|&)\s+[A-Z][\w'-]+)?,?\s+\(((?:1[89]|20)\d{2}[a-z]?)\)")
+AUTHOR_YEAR_REGEX = re.compile(r"([A-Z][\w'-]+)[^;]*?((?:1[89]|20)\d{2}[a-z]?)")
+REFERENCE_AUTHOR_YEAR_REGEX = re.compile(r"^\W*([A-Z][\w'-]+)[\s\S]*?\b((?:1[89]|20)\d{2}[a-z]?)\b")
 
 
-class RegexCitationExtractor:
+class StreamingCitationExtractor:
     @staticmethod
     def read_file(file_path):
         return partition_pdf(file_path, url=None)
 
     @staticmethod
-    def find_bibliography(file):
-        # find the bibliography section
-        for i, element in enumerate(file):
-            if element.category == "Title":
-                if "REFERENCES" in element.text:
-                    return i
-
-        for i, element in enumerate(file):
-            if "REFERENCES" in element.text:
-                return i
-
-        raise Exception("No bibliography found")
+    def is_references_heading(element) -> bool:
+        text = element.text.strip()
+        if element.category == "Title" and "REFERENCES" in text.upper() and len(text) < 40:
+            return True
+        return REFERENCES_HEADING_REGEX.match(text) is not None
 
     @staticmethod
-    def extract_references(file):
-        bib_start = RegexCitationExtractor.find_bibliography(file)
+    def split_document(elements) -> tuple[list, list]:
+        # one walk over the elements. if several headings match (e.g. a table of contents), the last one wins
+        # and everything collected as bibliography so far moves back into the body.
+        body, bibliography = [], []
+        in_bibliography = False
+        for element in elements:
+            if StreamingCitationExtractor.is_references_heading(element):
+                body.extend(bibliography)
+                bibliography = []
+                in_bibliography = True
+                continue
+            (bibliography if in_bibliography else body).append(element.text)
+        return body, bibliography
 
-        # extract the references
+    @staticmethod
+    def parse_numeric_references(bibliography: list) -> dict:
+        # entries start with "[n]" and may span several elements. more than 3 elements without an entry end the bibliography.
         references = {}
-        keys = []
-        reference_regex = re.compile(r"\[\d+\]")
+        current = None
         no_match_count = 0
-        double_entry = False
-        for i, element in enumerate(file[bib_start:]):
-            if no_match_count > 3 or double_entry:
+        for text in bibliography:
+            position = 0
+            matches = list(NUMERIC_REFERENCE_REGEX.finditer(text))
+            no_match_count = 0 if matches else no_match_count + 1
+            if no_match_count > 3:
                 break
+            for match in matches:
+                if current is not None:
+                    references[current] += text[position : match.start()]
+                current = int(match.group(1))
+                if current in references:  # numbering restarted, we are past the bibliography
+                    return references
+                references[current] = ""
+                position = match.end()
+            if current is not None:
+                references[current] += text[position:] + " "
+        return {number: " ".join(reference.split()) for number, reference in references.items()}
 
-            # find all the matches
-            matches = reference_regex.findall(element.text)
-
-            for j, match in enumerate(matches):
-                # extract the refenrece number
-                ref_num = int(match[1:-1])
-
-                if ref_num in references:
-                    double_entry = True
-                    break
-
-                # get the refenrece text
-                start = element.text.find(match) + len(match)
-                if i > 0 and (start > 2 + len(match)) and j == 0:
-                    references[keys[-1]]["ref"] += element.text[:start]
-
-                if j < len(matches) - 1:
-                    end = element.text.find(matches[j + 1])
-                else:
-                    end = len(element.text)
-                ref_text = element.text[start:end]
-                keys.append(ref_num)
-                references[ref_num] = {"idx": ref_num, "ref": ref_text, "citation": []}
-
-            if len(matches) == 0:
-                no_match_count += 1
-                references[keys[-1]]["ref"] += element.text
-            else:
-                no_match_count = 0
-
+    @staticmethod
+    def parse_author_year_references(bibliography: list) -> dict:
+        # each element is one entry, keyed by (first author surname, year)
+        references = {}
+        for text in bibliography:
+            match = REFERENCE_AUTHOR_YEAR_REGEX.match(text)
+            if match:
+                references.setdefault((match.group(1).lower(), match.group(2)), " ".join(text.split()))
         return references
 
     @staticmethod
-    def extract_citations(file):
-        references = RegexCitationExtractor.extract_references(file)
-        bib_start = RegexCitationExtractor.find_bibliography(file)
-
-        # extract the citations
-        citations = []
-        citation_regex = re.compile(r"\[\d+(?:,\s*\d+)*\]")
+    def expand_numbers(group: str) -> list[int]:
+        numbers = []
+        for part in group.split(","):
+            bounds = re.split(r"\s*[-–]\s*", part.strip())
+            if len(bounds) == 2 and bounds[0].isdigit() and bounds[1].isdigit() and int(bounds[1]) - int(bounds[0]) < 100:
+                numbers.extend(range(int(bounds[0]), int(bounds[1]) + 1))
+            elif bounds[0].isdigit():
+                numbers.append(int(bounds[0]))
+        return numbers
 
-        # concatanate the text before the bibliography
-        body_text = ""
-        for element in file[:bib_start]:
-            body_text += element.text + " "
-
-        # tokenize the text into sentences
-        sentences = sent_tokenize(body_text)
+    @staticmethod
+    def cited_keys(sentence: str) -> list:
+        keys = []
+        for match in NUMERIC_CITATION_REGEX.finditer(sentence):
+            keys.extend(StreamingCitationExtractor.expand_numbers(match.group(1)))
+        for match in PARENTHETICAL_CITATION_REGEX.finditer(sentence):
+            for part in match.group(1).split(";"):
+                author_year = AUTHOR_YEAR_REGEX.search(part)
+                if author_year:
+                    keys.append((author_year.group(1).lower(), author_year.group(2)))
+        for match in NARRATIVE_CITATION_REGEX.finditer(sentence):
+            keys.append((match.group(1).lower(), match.group(2)))
+        return keys
 
-        # find the sentences with the citations
-        for sentence in sentences:
-            # find all the matches
-            matches = citation_regex.findall(sentence)
+    @staticmethod
+    def extract_citations(elements):
+        # generator of (reference text, citing sentence) pairs
+        body, bibliography = StreamingCitationExtractor.split_document(elements)
+        references = StreamingCitationExtractor.parse_numeric_references(bibliography)
+        references.update(StreamingCitationExtractor.parse_author_year_references(bibliography))
+        if not references:
+            return
+
+        for sentence in sent_tokenize(" ".join(body)):
+            seen = set()
+            for key in StreamingCitationExtractor.cited_keys(sentence):
+                if key in references and key not in seen:
+                    seen.add(key)
+                    yield references[key], sentence
 
-            for match in matches:
-                # extract the refenrece number
-                ref_nums = [int(num) for num in match[1:-1].split(",")]
-                citations.append({"idx": ref_nums, "ref": sentence})
+    @staticmethod
+    def extract_file(file_path: str) -> list[tuple[str, str]]:
+        return list(StreamingCitationExtractor.extract_citations(StreamingCitationExtractor.read_file(file_path)))
 
-        # combine the citations with the references
-        for citation in citations:
-            for ref_num in citation["idx"]:
-                references[ref_num]["citation"].append(citation["ref"])
+    @staticmethod
+    def citation_rows(file_path: str, citing_paper_id: str, resolve_reference):
+        # rows that can be passed to `DatabaseClient.add_citation(*row)`.
+        # `resolve_reference(reference_text)` maps a bibliography entry to a semantic scholar id or None.
+        for reference, sentence in StreamingCitationExtractor.extract_citations(StreamingCitationExtractor.read_file(file_path)):
+            cited_paper_id = resolve_reference(reference)
+            if cited_paper_id is not None:
+                yield citing_paper_id, cited_paper_id, sentence, None
 
-        return references
+    @staticmethod
+    def extract_directory(directory: str, max_workers: int = None):
+        # partitioning is cpu bound, so pdfs are processed in parallel across cores. yields (path, reference, sentence).
+        paths = [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.lower().endswith(".pdf")]
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(StreamingCitationExtractor.extract_file, path): path for path in paths}
+            for future in as_completed(futures):
+                try:
+                    citations = future.result()
+                except Exception as e:
+                    # e.g. a corrupt or encrypted pdf, the rest of the directory is still processed
+                    LOG.error(f"could not extract citations from {futures[future]}: {e}")
+                    continue
+                for reference, sentence in citations:
+                    yield futures[future], reference, sentence
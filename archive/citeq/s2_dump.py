@@ -0,0 +1,284 @@
+import os
+import gzip
+import glob
+import json
+import random
+import argparse
+from sqlalchemy import text, insert
+from sqlalchemy.orm import Session
+
+from db import Researcher, Paper, Authorship, Citation, engine
+from s2_ids import S2Ids
+from logger import LOG_SINGLETON as LOG
+
+# offline alternative to the per-paper `/citations` and `/references` api calls: streams a local copy of the
+# semantic scholar datasets (gzipped jsonl, one directory per dataset) and loads the rows relevant to a set of
+# target researchers or papers into the existing schema.
+#
+#   <dump>/papers/*.jsonl.gz      {"corpusid", "url", "title", "authors": [{"authorId", "name"}], "venue", "year", "citationcount", "externalids"}
+#   <dump>/authors/*.jsonl.gz     {"authorid", "name", "hindex", "affiliations"}
+#   <dump>/citations/*.jsonl.gz   {"citingcorpusid", "citedcorpusid", "contexts", "intents"}
+#
+# see: https://api.semanticscholar.org/api-docs/datasets
+#
+# the dumps key papers by corpus id, the api (and therefore this database) by paper sha. the sha of a target paper is part
+# of its url. papers on the other side of a citation are only resolved in a second, filter-only pass over the papers dump,
+# until then (or with `resolve=False`) they are stored as "CorpusId:<n>", which the api accepts as a paper id as well.
+# memory is bounded by the size of the result (target papers and the corpus ids they are linked to), never by the dump.
+
+BATCH_SIZE = 5000
+
+
+def read_jsonl(directory: str):
+    paths = sorted(glob.glob(os.path.join(directory, "*.jsonl.gz")) + glob.glob(os.path.join(directory, "*.jsonl")))
+    for path in paths:
+        with (gzip.open(path, "rt", encoding="utf-8") if path.endswith(".gz") else open(path, "r", encoding="utf-8")) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def corpus_key(corpus_id: int) -> str:
+    return f"CorpusId:{corpus_id}"
+
+
+def paper_sha(row: dict) -> str:
+    url = row.get("url") or ""
+    return url.rstrip("/").rsplit("/", 1)[-1] if "/paper/" in url else corpus_key(row["corpusid"])
+
+
+def first_intent(intents) -> str | None:
+    # the api path stores the first intent of a citation for all of its contexts, intents may be nested per context in the dumps
+    for intent in intents or []:
+        if isinstance(intent, list):
+            intent = intent[0] if intent else None
+        if intent:
+            return intent
+    return None
+
+
+class S2DumpIngestor:
+    def __init__(self, dump_dir: str, author_ids: set = None, paper_ids: set = None, batch_size: int = BATCH_SIZE):
+        # targets: semantic scholar author ids and/or paper ids (sha or "CorpusId:<n>")
+        self.dump_dir = dump_dir
+        self.author_ids = {str(a) for a in author_ids or []}
+        self.paper_ids = {str(p) for p in paper_ids or []}
+        self.batch_size = batch_size
+        self.session = Session(engine)
+        self.target_corpus_ids = {}  # corpus id -> paper sha, only target papers
+        self.paper_authors = {}  # target paper sha -> author ids in order
+        self.needed_authors = set()
+        self.unresolved = set()  # corpus ids of non-target papers referenced by stored citations
+
+    def path(self, dataset: str) -> str:
+        return os.path.join(self.dump_dir, dataset)
+
+    def flush(self, model, rows: list, ignore_duplicates: bool = False):
+        if rows and model is Citation and S2Ids.is_enabled(self.session.connection()):
+            keys = S2Ids.intern(self.session.connection(), [row["citing_paper_id"] for row in rows] + [row["cited_paper_id"] for row in rows])
+            for row in rows:
+                row["citing_paper_id"], row["cited_paper_id"] = keys[row["citing_paper_id"]], keys[row["cited_paper_id"]]
+        if rows:
+            statement = insert(model).prefix_with("OR IGNORE") if ignore_duplicates else insert(model)
+            self.session.execute(statement, rows)
+            self.session.commit()
+            rows.clear()
+
+    def ingest_papers(self):
+        # pass 1: target papers, with their authorships once the researchers exist
+        rows = []
+        for row in read_jsonl(self.path("papers")):
+            authors = [a.get("authorId") for a in row.get("authors") or []]
+            sha = paper_sha(row)
+            is_target = sha in self.paper_ids or corpus_key(row["corpusid"]) in self.paper_ids or any(a in self.author_ids for a in authors if a)
+            if not is_target:
+                continue
+            self.target_corpus_ids[row["corpusid"]] = sha
+            self.paper_authors[sha] = authors
+            self.needed_authors.update(a for a in authors if a)
+            doi = (row.get("externalids") or {}).get("DOI")
+            rows.append({"semantic_scholar_id": sha, "title": row.get("title") or "", "year": row.get("year"), "venue": row.get("venue"), "citation_count": row.get("citationcount"), "doi": doi, "citations_added": False, "references_added": False})
+            if len(rows) >= self.batch_size:
+                self.flush(Paper, rows, ignore_duplicates=True)
+        self.flush(Paper, rows, ignore_duplicates=True)
+        LOG.info(f"papers: {len(self.target_corpus_ids)} target papers by {len(self.needed_authors)} authors")
+
+    def ingest_authors(self):
+        # pass 2: researcher rows for every author of a target paper, like `get_papers_of_researcher`
+        rows = []
+        found = 0
+        for row in read_jsonl(self.path("authors")):
+            author_id = str(row.get("authorid"))
+            if author_id not in self.needed_authors:
+                continue
+            found += 1
+            affiliations = row.get("affiliations") or []
+            rows.append({"semantic_scholar_id": author_id, "name": row.get("name") or "", "h_index": row.get("hindex"), "institution": affiliations[0] if affiliations else None})
+            if len(rows) >= self.batch_size:
+                self.flush(Researcher, rows, ignore_duplicates=True)
+        self.flush(Researcher, rows, ignore_duplicates=True)
+        LOG.info(f"authors: {found}/{len(self.needed_authors)} found in the dump")
+
+    def ingest_authorships(self):
+        shas = list(self.paper_authors)
+        paper_ids, researcher_ids = {}, {}
+        for i in range(0, len(shas), 900):
+            paper_ids.update(self.session.query(Paper.semantic_scholar_id, Paper.id).filter(Paper.semantic_scholar_id.in_(shas[i : i + 900])).all())
+        authors = list(self.needed_authors)
+        for i in range(0, len(authors), 900):
+            researcher_ids.update(self.session.query(Researcher.semantic_scholar_id, Researcher.id).filter(Researcher.semantic_scholar_id.in_(authors[i : i + 900])).all())
+        existing = set(self.session.query(Authorship.researcher_id, Authorship.paper_id).filter(Authorship.paper_id.in_(list(paper_ids.values()))).all()) if paper_ids else set()
+
+        rows = []
+        for sha, authors in self.paper_authors.items():
+            for order, author_id in enumerate(authors):
+                key = (researcher_ids.get(author_id), paper_ids.get(sha))
+                if None in key or key in existing:
+                    continue
+                existing.add(key)
+                rows.append({"researcher_id": key[0], "paper_id": key[1], "author_order": order})
+        self.flush(Authorship, rows)
+        LOG.info(f"authorships: {len(existing)}")
+
+    def ingest_citations(self):
+        # pass 3: citations and references of target papers. papers that already went through the api path are skipped.
+        done_citations = {sha for (sha,) in self.session.query(Paper.semantic_scholar_id).filter(Paper.citations_added == True)}
+        done_references = {sha for (sha,) in self.session.query(Paper.semantic_scholar_id).filter(Paper.references_added == True)}
+        self.session.execute(text("CREATE INDEX IF NOT EXISTS ix_citations_cited_paper_id ON citations (cited_paper_id)"))  # see `remove_duplicates`
+        self.first_citation_id = self.session.execute(text("SELECT COALESCE(MAX(id), 0) + 1 FROM citations")).scalar()
+        rows = []
+        count = 0
+        for row in read_jsonl(self.path("citations")):
+            citing, cited = row.get("citingcorpusid"), row.get("citedcorpusid")
+            cited_sha, citing_sha = self.target_corpus_ids.get(cited), self.target_corpus_ids.get(citing)
+            is_citation = cited_sha is not None and cited_sha not in done_citations
+            is_reference = citing_sha is not None and citing_sha not in done_references
+            if not (is_citation or is_reference) or citing is None or cited is None:
+                continue
+            intent = first_intent(row.get("intents"))
+            for context in row.get("contexts") or []:
+                rows.append({"citing_paper_id": citing_sha or corpus_key(citing), "cited_paper_id": cited_sha or corpus_key(cited), "context": context, "intent": intent, "llm_purpose": None, "sentiment": None})
+            for corpus_id, sha in ((citing, citing_sha), (cited, cited_sha)):
+                if sha is None:
+                    self.unresolved.add(corpus_id)
+            if len(rows) >= self.batch_size:
+                count += len(rows)
+                self.flush(Citation, rows)
+        count += len(rows)
+        self.flush(Citation, rows)
+
+        shas = list(self.target_corpus_ids.values())
+        for i in range(0, len(shas), 900):
+            self.session.query(Paper).filter(Paper.semantic_scholar_id.in_(shas[i : i + 900])).update({Paper.citations_added: True, Paper.references_added: True})
+        self.session.commit()
+        LOG.info(f"citations: {count} contexts, {len(self.unresolved)} linked papers outside the targets")
+
+    def resolve_corpus_ids(self):
+        # pass 4: only reads the papers dump to replace "CorpusId:<n>" placeholders with paper shas.
+        # the mapping goes into a temporary table, so the citations table is updated with a single scan.
+        self.session.execute(text("CREATE TEMP TABLE IF NOT EXISTS corpus_ids (key TEXT PRIMARY KEY, sha TEXT NOT NULL)"))
+        mapping = []
+        for row in read_jsonl(self.path("papers")):
+            if row["corpusid"] in self.unresolved:
+                mapping.append({"key": corpus_key(row["corpusid"]), "sha": paper_sha(row)})
+                if len(mapping) >= self.batch_size:
+                    self.session.execute(text("INSERT OR IGNORE INTO corpus_ids (key, sha) VALUES (:key, :sha)"), mapping)
+                    mapping.clear()
+        if mapping:
+            self.session.execute(text("INSERT OR IGNORE INTO corpus_ids (key, sha) VALUES (:key, :sha)"), mapping)
+
+        if S2Ids.is_enabled(self.session.connection()):
+            self.resolve_interned_corpus_ids()
+        else:
+            for column in ["citing_paper_id", "cited_paper_id"]:
+                self.session.execute(text(f"UPDATE citations SET {column} = (SELECT sha FROM corpus_ids WHERE key = citations.{column}) WHERE {column} IN (SELECT key FROM corpus_ids)"))
+        resolved = self.session.execute(text("SELECT COUNT(*) FROM corpus_ids")).scalar()
+        self.session.execute(text("DROP TABLE corpus_ids"))
+        self.session.commit()
+        LOG.info(f"resolved {resolved}/{len(self.unresolved)} corpus ids")
+
+    def resolve_interned_corpus_ids(self):
+        # with interned ids (see s2_ids.py) the placeholders are stub rows of `s2_ids`, which are renamed in place without touching
+        # the citations. only placeholders of papers whose sha already has a key are merged into that key.
+        merged = """
+            SELECT placeholder.id AS old_key, paper.id AS new_key
+            FROM corpus_ids m
+            JOIN s2_ids placeholder ON placeholder.semantic_scholar_id = m.key
+            JOIN s2_ids paper ON paper.semantic_scholar_id = m.sha
+        """
+        self.session.execute(text(f"CREATE TEMP TABLE merged_keys AS {merged}"))
+        for column in ["citing_paper_id", "cited_paper_id"]:
+            self.session.execute(text(f"UPDATE citations SET {column} = (SELECT new_key FROM merged_keys WHERE old_key = citations.{column}) WHERE {column} IN (SELECT old_key FROM merged_keys)"))
+        self.session.execute(text("DELETE FROM s2_ids WHERE id IN (SELECT old_key FROM merged_keys)"))
+        self.session.execute(text("DROP TABLE merged_keys"))
+        self.session.execute(text("UPDATE s2_ids SET semantic_scholar_id = (SELECT sha FROM corpus_ids WHERE key = s2_ids.semantic_scholar_id) WHERE semantic_scholar_id IN (SELECT key FROM corpus_ids)"))
+
+    def remove_duplicates(self):
+        # pass 5: the done flags are only set once the whole dump is read, so a re-run after an interruption inserts the committed
+        # batches again, and papers that are done on one side only were also fetched by the api path. placeholders only match
+        # after they are resolved, so duplicates are removed here instead of per batch: every citation of a paper that got new
+        # rows is compared to the older rows of the same pair, the oldest row (which may already be labelled) is kept.
+        query = """
+            DELETE FROM citations
+            WHERE cited_paper_id IN (SELECT cited_paper_id FROM citations WHERE id >= :first_id)
+            AND EXISTS (
+                SELECT 1 FROM citations old
+                WHERE old.cited_paper_id = citations.cited_paper_id AND old.citing_paper_id = citations.citing_paper_id AND old.id < citations.id
+                AND (old.context = citations.context OR context_text(old.context) = context_text(citations.context))
+            )
+        """
+        removed = self.session.execute(text(query), {"first_id": self.first_citation_id}).rowcount
+        self.session.commit()
+        LOG.info(f"removed {removed} duplicate citations")
+
+    def run(self, resolve: bool = True):
+        self.ingest_papers()
+        self.ingest_authors()
+        self.ingest_authorships()
+        self.ingest_citations()
+        if resolve and self.unresolved:
+            self.resolve_corpus_ids()
+        self.remove_duplicates()
+        self.session.close()
+
+
+def make_sample_dump(directory: str, num_papers: int = 2000, num_authors: int = 300, num_citations: int = 20_000, seed: int = 0):
+    # small synthetic dump in the same format, for trying the ingestion without downloading the datasets
+    rng = random.Random(seed)
+    for dataset in ["papers", "authors", "citations"]:
+        os.makedirs(os.path.join(directory, dataset), exist_ok=True)
+    intents = ["background", "methodology", "result"]
+    words = ["we", "use", "the", "method", "of", "prior", "work", "improves", "fails", "on", "benchmark", "results", "approach", "baseline", "model"]
+
+    with gzip.open(os.path.join(directory, "papers", "part-0.jsonl.gz"), "wt", encoding="utf-8") as f:
+        for corpus_id in range(1, num_papers + 1):
+            authors = [{"authorId": str(rng.randint(1, num_authors)), "name": None} for _ in range(rng.randint(1, 4))]
+            sha = f"{corpus_id:040x}"
+            paper = {"corpusid": corpus_id, "url": f"https://www.semanticscholar.org/paper/{sha}", "title": f"paper {corpus_id}", "authors": authors, "venue": rng.choice(["ACL", "NeurIPS", "ICML", ""]), "year": rng.randint(1995, 2023), "citationcount": rng.randint(0, 500), "externalids": {"DOI": f"10.0/{corpus_id}"}}
+            f.write(json.dumps(paper) + "\n")
+
+    with gzip.open(os.path.join(directory, "authors", "part-0.jsonl.gz"), "wt", encoding="utf-8") as f:
+        for author_id in range(1, num_authors + 1):
+            f.write(json.dumps({"authorid": str(author_id), "name": f"author {author_id}", "hindex": rng.randint(0, 60), "affiliations": [rng.choice(["TU Wien", "ETH", "MIT"])]}) + "\n")
+
+    with gzip.open(os.path.join(directory, "citations", "part-0.jsonl.gz"), "wt", encoding="utf-8") as f:
+        for citation_id in range(num_citations):
+            contexts = [" ".join(rng.choice(words) for _ in range(rng.randint(8, 30))) + " [1]." for _ in range(rng.randint(1, 3))]
+            row = {"citationid": citation_id, "citingcorpusid": rng.randint(1, num_papers), "citedcorpusid": rng.randint(1, num_papers), "isinfluential": False, "contexts": contexts, "intents": [[rng.choice(intents)] for _ in contexts]}
+            f.write(json.dumps(row) + "\n")
+    LOG.info(f"wrote a sample dump with {num_papers} papers, {num_authors} authors and {num_citations} citations to '{directory}'")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="load a local semantic scholar datasets dump")
+    parser.add_argument("dump", type=str, help="directory with papers/, authors/ and citations/")
+    parser.add_argument("--authors", nargs="+", help="semantic scholar ids of the target researchers", type=str, default=[])
+    parser.add_argument("--papers", nargs="+", help="target paper ids (sha or CorpusId:<n>)", type=str, default=[])
+    parser.add_argument("--no-resolve", help="keep CorpusId:<n> ids for papers outside the targets", action="store_true")
+    parser.add_argument("--make-sample", help="write a small synthetic dump to the directory instead", action="store_true")
+    args = parser.parse_args()
+
+    if args.make_sample:
+        make_sample_dump(args.dump)
+    else:
+        S2DumpIngestor(args.dump, author_ids=set(args.authors), paper_ids=set(args.papers)).run(resolve=not args.no_resolve)
@@ -0,0 +1,139 @@
+import json
+import sqlite3
+from sqlalchemy import text
+
+# optional storage mode for the citation endpoints: `citations.citing_paper_id` and `cited_paper_id` are annotated as integers,
+# but hold 40 character paper shas (`papers.semantic_scholar_id`), so every row carries two long strings and every join compares them.
+# in the interned mode every semantic scholar id gets an integer key and citations store the keys instead:
+#
+#   s2_ids          (id, semantic_scholar_id) of every paper on either side of a citation, including stub rows for citing
+#                   papers that aren't in `papers` (most of them, see `get_citations` in __main__.py)
+#   papers.s2_key   key of the paper, set by a trigger on insert, so a new paper picks up the stub row of earlier citations
+#
+# the mode is active once the migration below has rebuilt `citations` with integer endpoints.
+# queries join on `S2Ids.paper_key(connection)` instead of `semantic_scholar_id`, e.g. "JOIN papers p ON p.{key} = c.cited_paper_id",
+# and writers pass their rows through `S2Ids.encode`. the analysis notebooks expect shas, run them on a `--restore`d copy.
+# see: https://www.sqlite.org/datatype3.html
+
+ENDPOINTS = ["citing_paper_id", "cited_paper_id"]
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS s2_ids (id INTEGER PRIMARY KEY, semantic_scholar_id TEXT NOT NULL UNIQUE);
+    CREATE UNIQUE INDEX IF NOT EXISTS ix_papers_s2_key ON papers (s2_key);
+    CREATE TRIGGER IF NOT EXISTS papers_s2_key AFTER INSERT ON papers WHEN NEW.s2_key IS NULL
+    BEGIN
+        INSERT OR IGNORE INTO s2_ids (semantic_scholar_id) VALUES (NEW.semantic_scholar_id);
+        UPDATE papers SET s2_key = (SELECT id FROM s2_ids WHERE semantic_scholar_id = NEW.semantic_scholar_id) WHERE id = NEW.id;
+    END;
+"""
+
+
+class S2Ids:
+    @staticmethod
+    def is_enabled(connection) -> bool:
+        # the orm declares the endpoints with the type of `papers.semantic_scholar_id` (varchar), the migration rebuilds them as integers
+        return any(row[1] == "cited_paper_id" and row[2].upper() == "INTEGER" for row in connection.execute(text("PRAGMA table_info(citations)")))
+
+    @staticmethod
+    def paper_key(connection) -> str:
+        # column of `papers` that citation endpoints reference
+        return "s2_key" if S2Ids.is_enabled(connection) else "semantic_scholar_id"
+
+    @staticmethod
+    def endpoint(connection, column: str) -> str:
+        # sql expression for the semantic scholar id of a citation endpoint, e.g. `endpoint(connection, "c.citing_paper_id")`
+        return f"(SELECT semantic_scholar_id FROM s2_ids WHERE id = {column})" if S2Ids.is_enabled(connection) else column
+
+    @staticmethod
+    def intern(connection, semantic_scholar_ids) -> dict:
+        # semantic scholar id -> key, unknown ids get a stub row. the ids are bound as one json array instead of one parameter each,
+        # which is ~3x faster for an api page than an executemany plus chunked `IN (...)` lookups.
+        # see: https://www.sqlite.org/json1.html#jeach
+        ids = json.dumps(list(set(semantic_scholar_ids)))
+        connection.execute(text("INSERT OR IGNORE INTO s2_ids (semantic_scholar_id) SELECT value FROM json_each(:ids)"), {"ids": ids})
+        return dict(connection.execute(text("SELECT s.semantic_scholar_id, s.id FROM json_each(:ids) j JOIN s2_ids s ON s.semantic_scholar_id = j.value"), {"ids": ids}).fetchall())
+
+    @staticmethod
+    def encode(connection, rows: list) -> list:
+        # rows of (citing ss id, cited ss id, ...) as they should be stored: with keys in the interned mode, unchanged otherwise
+        if not rows or not S2Ids.is_enabled(connection):
+            return rows
+        keys = S2Ids.intern(connection, [row[0] for row in rows] + [row[1] for row in rows])
+        return [(keys[row[0]], keys[row[1]], *row[2:]) for row in rows]
+
+
+def rebuild_citations(connection, endpoint_type: str, references: str, expression: str, batch_size: int) -> int:
+    # sqlite can't change the type of a column, so the rows are copied into a new table with the other endpoint type,
+    # in id ranges so an interrupted copy is resumed. other columns, indexes and triggers are kept as they are.
+    # see: https://www.sqlite.org/lang_altertable.html#otheralter
+    columns = connection.execute("PRAGMA table_info(citations)").fetchall()
+    definitions, values = [], []
+    for _, name, column_type, not_null, default, _ in columns:
+        column_type = endpoint_type if name in ENDPOINTS else column_type
+        definitions.append(f"{name} {column_type}{' NOT NULL' if not_null else ''}{f' DEFAULT {default}' if default is not None else ''}")
+        values.append(expression.format(column=name) if name in ENDPOINTS else name)
+    definitions.append(f"PRIMARY KEY ({', '.join(row[1] for row in sorted(columns, key=lambda row: row[5]) if row[5] > 0)})")
+    definitions += [f"FOREIGN KEY({name}) REFERENCES {references}" for name in ENDPOINTS]
+    connection.execute(f"CREATE TABLE IF NOT EXISTS citations_rebuilt ({', '.join(definitions)})")
+
+    names = ", ".join(row[1] for row in columns)
+    max_id = connection.execute("SELECT COALESCE(MAX(id), 0) FROM citations").fetchone()[0]
+    copied = connection.execute("SELECT COALESCE(MAX(id), 0) FROM citations_rebuilt").fetchone()[0]
+    for start in range(copied, max_id, batch_size):
+        connection.execute(f"INSERT INTO citations_rebuilt ({names}) SELECT {', '.join(values)} FROM citations WHERE id > ? AND id <= ?", (start, start + batch_size))
+        connection.commit()
+        print(f"\tcopied {min(start + batch_size, max_id)}/{max_id} citation ids")
+
+    schema = [sql for (sql,) in connection.execute("SELECT sql FROM sqlite_master WHERE tbl_name = 'citations' AND type IN ('index', 'trigger') AND sql IS NOT NULL")]
+    # views on `citations` (see label_provenance.py) would otherwise be re-checked while the table is missing
+    connection.execute("PRAGMA legacy_alter_table = ON")
+    connection.executescript(";\n".join(["BEGIN", "DROP TABLE citations", "ALTER TABLE citations_rebuilt RENAME TO citations", *schema, "COMMIT"]))
+    connection.execute("PRAGMA legacy_alter_table = OFF")
+    return max_id - copied
+
+
+def migrate(db_path: str, intern: bool = True, batch_size: int = 50_000, vacuum: bool = True):
+    # converts an existing database in place, see `migrate` in context_compression.py. don't run it next to an ingestion.
+    connection = sqlite3.connect(db_path)
+    is_interned = any(row[1] == "cited_paper_id" and row[2].upper() == "INTEGER" for row in connection.execute("PRAGMA table_info(citations)"))
+    converted = 0
+    if intern and not is_interned:
+        if not any(row[1] == "s2_key" for row in connection.execute("PRAGMA table_info(papers)")):
+            connection.execute("ALTER TABLE papers ADD COLUMN s2_key INTEGER")
+        connection.executescript(SCHEMA)
+        # papers first, so their keys are small and dense, then stub rows for everything else that is cited or citing
+        connection.execute("INSERT OR IGNORE INTO s2_ids (semantic_scholar_id) SELECT semantic_scholar_id FROM papers ORDER BY id")
+        connection.execute("UPDATE papers SET s2_key = (SELECT id FROM s2_ids WHERE semantic_scholar_id = papers.semantic_scholar_id) WHERE s2_key IS NULL")
+        for column in ENDPOINTS:
+            connection.execute(f"INSERT OR IGNORE INTO s2_ids (semantic_scholar_id) SELECT {column} FROM citations")
+        connection.commit()
+        print(f"interned {connection.execute('SELECT COUNT(*) FROM s2_ids').fetchone()[0]} semantic scholar ids")
+        converted = rebuild_citations(connection, "INTEGER", "s2_ids (id)", "(SELECT id FROM s2_ids WHERE semantic_scholar_id = {column})", batch_size)
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_citations_cited_paper_id ON citations (cited_paper_id)")
+        connection.commit()
+    elif not intern and is_interned:
+        converted = rebuild_citations(connection, "VARCHAR", "papers (semantic_scholar_id)", "(SELECT semantic_scholar_id FROM s2_ids WHERE id = {column})", batch_size)
+        # the index on `citations.cited_paper_id` is kept, it serves the same joins in the plain mode
+        connection.executescript(
+            """
+            DROP TRIGGER IF EXISTS papers_s2_key;
+            DROP INDEX IF EXISTS ix_papers_s2_key;
+            ALTER TABLE papers DROP COLUMN s2_key;
+            DROP TABLE s2_ids;
+            """
+        )
+        connection.commit()
+    if vacuum:
+        connection.execute("VACUUM")
+    connection.close()
+    return converted
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="convert the citation endpoints between semantic scholar ids and interned integer keys")
+    parser.add_argument("--db", type=str, default="./citeQ.db")
+    parser.add_argument("--restore", action="store_true", help="convert back to semantic scholar ids")
+    args = parser.parse_args()
+    migrate(args.db, intern=not args.restore)
@@ -0,0 +1,99 @@
+import time
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from db import Citation, engine, create_missing_columns
+from s2_ids import S2Ids
+from logger import LOG_SINGLETON as LOG
+
+# flags citations whose citing and cited paper share an author, replaces the Citation → Paper → Authorship × 2 joins of the notebook.
+#
+# the author sets of all papers are held as one sorted int array in csr layout: the authors of paper i are
+# `authors[offsets[i] : offsets[i + 1]]`, sorted by researcher id. the authorship keys `paper * num_researchers + researcher`
+# are sorted too, so all citations are checked at once: every author of a citing paper is looked up in the cited paper
+# with a single `searchsorted`, and a citation is a self-citation if any lookup hits.
+#
+# `self_citation` is null if either paper has no authorships in the database (usually the citing paper, see `get_citations`).
+# filters: "c.self_citation IS NOT 1" for independent citations (unknown counts as independent), "c.self_citation = 1" for self-citations.
+
+
+class SelfCitationIndex:
+    def __init__(self, paper_ids: np.ndarray, offsets: np.ndarray, authors: np.ndarray):
+        self.paper_ids = paper_ids  # sorted semantic scholar ids or s2_ids keys
+        self.offsets = offsets
+        self.authors = authors
+        self.num_researchers = int(authors.max()) + 1 if len(authors) else 1
+        paper_of_author = np.repeat(np.arange(len(paper_ids), dtype=np.int64), np.diff(offsets))
+        self.keys = paper_of_author * self.num_researchers + authors  # sorted, since authors are sorted within each paper
+
+    @staticmethod
+    def id_dtype(connection):
+        # citation endpoints are integer keys in the interned mode (see s2_ids.py), which are also much faster to sort and search
+        return np.int64 if S2Ids.is_enabled(connection) else str
+
+    @staticmethod
+    def build(connection):
+        rows = connection.execute(text(f"SELECT DISTINCT p.{S2Ids.paper_key(connection)}, a.researcher_id FROM authorships a JOIN papers p ON p.id = a.paper_id")).fetchall()
+        paper_ids, papers = np.unique(np.array([row[0] for row in rows], dtype=SelfCitationIndex.id_dtype(connection)), return_inverse=True)
+        authors = np.fromiter((row[1] for row in rows), dtype=np.int64, count=len(rows))
+        order = np.lexsort((authors, papers))
+        offsets = np.zeros(len(paper_ids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(papers, minlength=len(paper_ids)))
+        return SelfCitationIndex(paper_ids, offsets, authors[order])
+
+    def lookup(self, semantic_scholar_ids: np.ndarray) -> np.ndarray:
+        # index of each paper, -1 if it has no authorships
+        if len(self.paper_ids) == 0:
+            return np.full(len(semantic_scholar_ids), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.paper_ids, semantic_scholar_ids), len(self.paper_ids) - 1)
+        return np.where(self.paper_ids[positions] == semantic_scholar_ids, positions, -1)
+
+    def flag(self, citing_ids: np.ndarray, cited_ids: np.ndarray) -> np.ndarray:
+        # 1 self-citation, 0 independent, -1 unknown
+        citing, cited = self.lookup(citing_ids), self.lookup(cited_ids)
+        known = np.flatnonzero((citing >= 0) & (cited >= 0))
+        flags = np.full(len(citing_ids), -1, dtype=np.int8)
+        flags[known] = 0
+
+        # one row per (citation, author of the citing paper)
+        starts = self.offsets[citing[known]]
+        counts = self.offsets[citing[known] + 1] - starts
+        rows = np.repeat(known, counts)
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        queries = cited[rows] * self.num_researchers + self.authors[positions]
+
+        hits = np.searchsorted(self.keys, queries)
+        hits = self.keys[np.minimum(hits, len(self.keys) - 1)] == queries if len(self.keys) else np.zeros(0, dtype=bool)
+        flags[np.unique(rows[hits])] = 1
+        return flags
+
+    @staticmethod
+    def refresh(session: Session) -> dict:
+        create_missing_columns(Citation, "self_citation")
+        start = time.perf_counter()
+        connection = session.connection()
+        index = SelfCitationIndex.build(connection)
+        rows = connection.execute(text("SELECT id, citing_paper_id, cited_paper_id, self_citation FROM citations")).fetchall()
+        ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        old = np.fromiter((-1 if row[3] is None else int(row[3]) for row in rows), dtype=np.int8, count=len(rows))
+        dtype = SelfCitationIndex.id_dtype(connection)
+        flags = index.flag(np.array([row[1] for row in rows], dtype=dtype), np.array([row[2] for row in rows], dtype=dtype))
+        del rows
+
+        # only rows whose flag changed are written
+        changed = np.flatnonzero(flags != old)
+        updates = [{"id": int(ids[i]), "flag": None if flags[i] < 0 else int(flags[i])} for i in changed]
+        for i in range(0, len(updates), 10_000):
+            connection.execute(text("UPDATE citations SET self_citation = :flag WHERE id = :id"), updates[i : i + 10_000])
+        session.commit()
+
+        summary = {"citations": len(flags), "self_citations": int((flags == 1).sum()), "independent": int((flags == 0).sum()), "unknown": int((flags < 0).sum()), "updated": len(updates)}
+        LOG.info(f"self-citations: {summary} in {time.perf_counter() - start:.1f} s")
+        return summary
+
+
+if __name__ == "__main__":
+    session = Session(engine)
+    SelfCitationIndex.refresh(session)
+    session.close()
@@ -1,19 +1,20 @@
 from enum import Enum
 
 
-from transformers import pipeline
-import tensorflow as tf
-import torch as th
-
-
 class SentimentLabel(Enum):
     NEGATIVE = 0
     POSITIVE = 1
 
 
 class TransformerClassifier:
+    preprocessor = None  # optional `context_preprocessing.ContextPreprocessor`, only its cleaning and trimming apply here
+
     @staticmethod
     def get_sentiment_score(text: str) -> tuple[SentimentLabel, float]:
+        if TransformerClassifier.preprocessor is not None:
+            text, _ = TransformerClassifier.preprocessor.preprocess(text)
+        from transformers import pipeline  # heavy, only imported once a context is classified
+
         classifier = pipeline("text-classification", model="distilbert-base-uncased-finetuned-sst-2-english")
         result = classifier(text)
         assert result
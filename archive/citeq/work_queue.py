@@ -0,0 +1,235 @@
+import json
+import socket
+import threading
+import time
+import os
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import requests
+from sqlalchemy import text, insert
+
+from db import ClassificationChunk, LabelProvenance, engine, create_missing_tables
+from label_provenance import CURRENT_LABELS_VIEW
+from logger import LOG_SINGLETON as LOG
+
+# replaces hand-picked `--start/--end` ranges: unlabelled citations are split into chunks that workers lease.
+# a worker has to heartbeat while it works on a chunk, chunks whose lease expired are handed out again.
+# workers either share the sqlite database or talk to a small http coordinator (`QueueCoordinator`).
+# "unlabelled" is decided by the `current_labels` view, so labels that `classify` only recorded as provenance
+# (its csv shards aren't imported into `citations.llm_purpose` yet) aren't queued again.
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    def __init__(self, engine=engine, lease_seconds: float = 600):
+        self.engine = engine
+        self.lease_seconds = lease_seconds
+        create_missing_tables(ClassificationChunk, LabelProvenance)
+        with self.engine.begin() as connection:
+            connection.execute(text(CURRENT_LABELS_VIEW))
+
+    def init(self, chunk_size: int = 1000, reset: bool = False) -> int:
+        with self.engine.begin() as connection:
+            if reset:
+                connection.execute(text("DELETE FROM classification_chunks"))
+            elif connection.execute(text("SELECT COUNT(*) FROM classification_chunks WHERE status != 'done'")).scalar() > 0:
+                LOG.info("queue already has open chunks, use reset to rebuild it")
+                return 0
+
+            ids = connection.execute(text("SELECT citation_id FROM current_labels WHERE label IS NULL ORDER BY citation_id")).scalars().all()
+            chunks = [{"start_id": ids[i], "end_id": ids[min(i + chunk_size, len(ids)) - 1], "size": len(ids[i : i + chunk_size])} for i in range(0, len(ids), chunk_size)]
+            if chunks:
+                connection.execute(text("INSERT INTO classification_chunks (start_id, end_id, size, status, attempts) VALUES (:start_id, :end_id, :size, 'pending', 0)"), chunks)
+        LOG.info(f"queued {len(ids)} unlabelled citations in {len(chunks)} chunks")
+        return len(chunks)
+
+    def claim(self, worker: str) -> dict | None:
+        # a single update statement is atomic in sqlite, so two workers can never lease the same chunk.
+        # expired leases are picked up here as well, which requeues them without a separate janitor.
+        now = time.time()
+        with self.engine.begin() as connection:
+            row = connection.execute(
+                text(
+                    """
+                    UPDATE classification_chunks
+                    SET status = 'leased', worker = :worker, lease_expires_at = :expires, attempts = attempts + 1
+                    WHERE id = (
+                        SELECT id FROM classification_chunks
+                        WHERE status = 'pending' OR (status = 'leased' AND lease_expires_at < :now)
+                        ORDER BY id LIMIT 1
+                    )
+                    RETURNING id, start_id, end_id, attempts
+                    """
+                ),
+                {"worker": worker, "expires": now + self.lease_seconds, "now": now},
+            ).first()
+            if row is None:
+                return None
+            citations = connection.execute(
+                text(
+                    """
+                    SELECT c.id, context_text(c.context) FROM citations c
+                    JOIN current_labels l ON l.citation_id = c.id
+                    WHERE c.id BETWEEN :start AND :end AND l.label IS NULL
+                    ORDER BY c.id
+                    """
+                ),
+                {"start": row.start_id, "end": row.end_id},
+            ).fetchall()
+        if row.attempts > 1:
+            LOG.info(f"chunk {row.id} requeued after an expired lease (attempt {row.attempts})")
+        return {"id": row.id, "start_id": row.start_id, "end_id": row.end_id, "citations": [list(citation) for citation in citations]}
+
+    def heartbeat(self, chunk_id: int, worker: str) -> bool:
+        # false means the lease was lost and the chunk may already be processed by someone else
+        with self.engine.begin() as connection:
+            result = connection.execute(
+                text("UPDATE classification_chunks SET lease_expires_at = :expires WHERE id = :id AND worker = :worker AND status = 'leased'"),
+                {"expires": time.time() + self.lease_seconds, "id": chunk_id, "worker": worker},
+            )
+            return result.rowcount == 1
+
+    def complete(self, chunk_id: int, worker: str, results: list, provenance: list = None) -> bool:
+        # results: [(citation id, label)]. labels are only written if the worker still owns the lease.
+        # provenance: optional (model, prompt fingerprint) the labels are recorded with, see label_provenance.py
+        with self.engine.begin() as connection:
+            owned = connection.execute(
+                text("UPDATE classification_chunks SET status = 'done', lease_expires_at = NULL WHERE id = :id AND worker = :worker AND status = 'leased'"),
+                {"id": chunk_id, "worker": worker},
+            )
+            if owned.rowcount != 1:
+                LOG.warning(f"lease of chunk {chunk_id} was lost, discarding its results")
+                return False
+            if results:
+                connection.execute(text("UPDATE citations SET llm_purpose = :label WHERE id = :id"), [{"id": c_id, "label": label} for c_id, label in results])
+                if provenance is not None:
+                    model, prompt_fingerprint = provenance
+                    rows = [{"citation_id": c_id, "model": model, "prompt_fingerprint": prompt_fingerprint, "label": label} for c_id, label in results]
+                    connection.execute(insert(LabelProvenance), rows)
+        return True
+
+    def progress(self) -> dict:
+        with self.engine.connect() as connection:
+            rows = connection.execute(text("SELECT status, COUNT(*), SUM(size) FROM classification_chunks GROUP BY status")).fetchall()
+        return {row[0]: {"chunks": row[1], "citations": row[2]} for row in rows}
+
+
+class RemoteWorkQueue:
+    # same interface as `WorkQueue`, backed by a `QueueCoordinator` for machines without access to the database
+
+    def __init__(self, url: str, timeout: float = 60):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def post(self, path: str, body: dict) -> dict:
+        r = requests.post(f"{self.url}{path}", json=body, timeout=self.timeout)
+        r.raise_for_status()
+        return r.json()
+
+    def claim(self, worker: str) -> dict | None:
+        return self.post("/claim", {"worker": worker}).get("chunk")
+
+    def heartbeat(self, chunk_id: int, worker: str) -> bool:
+        return self.post("/heartbeat", {"chunk_id": chunk_id, "worker": worker})["ok"]
+
+    def complete(self, chunk_id: int, worker: str, results: list, provenance: list = None) -> bool:
+        return self.post("/complete", {"chunk_id": chunk_id, "worker": worker, "results": results, "provenance": provenance})["ok"]
+
+    def progress(self) -> dict:
+        r = requests.get(f"{self.url}/progress", timeout=self.timeout)
+        r.raise_for_status()
+        return r.json()
+
+
+class QueueCoordinator:
+    # exposes a `WorkQueue` over http: POST /claim, /heartbeat, /complete and GET /progress
+
+    def __init__(self, queue: WorkQueue, host: str = "0.0.0.0", port: int = 8765):
+        self.queue = queue
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+
+    def make_handler(self):
+        queue = self.queue
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, body: dict, status: int = 200):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                if self.path == "/progress":
+                    return self.send_json(queue.progress())
+                self.send_json({"error": "not found"}, 404)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if self.path == "/claim":
+                    return self.send_json({"chunk": queue.claim(body["worker"])})
+                if self.path == "/heartbeat":
+                    return self.send_json({"ok": queue.heartbeat(body["chunk_id"], body["worker"])})
+                if self.path == "/complete":
+                    return self.send_json({"ok": queue.complete(body["chunk_id"], body["worker"], body["results"], body.get("provenance"))})
+                self.send_json({"error": "not found"}, 404)
+
+        return Handler
+
+    def serve_forever(self):
+        LOG.info(f"queue coordinator listening on {self.server.server_address}")
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()
+
+
+class QueueWorker:
+    def __init__(self, queue, classify, worker: str = None, heartbeat_seconds: float = 60, provenance: tuple = None):
+        # `classify(context, citation_id)` returns a `SentimentClass`, `provenance` is the (model, prompt fingerprint) it uses
+        self.queue = queue
+        self.classify = classify
+        self.provenance = list(provenance) if provenance is not None else None
+        self.worker = worker or default_worker_id()
+        self.heartbeat_seconds = heartbeat_seconds
+
+    def keep_alive(self, chunk_id: int, done: threading.Event, lost: threading.Event):
+        while not done.wait(self.heartbeat_seconds):
+            if not self.queue.heartbeat(chunk_id, self.worker):
+                lost.set()
+                return
+
+    def run(self, max_chunks: int = None) -> int:
+        processed = 0
+        while max_chunks is None or processed < max_chunks:
+            chunk = self.queue.claim(self.worker)
+            if chunk is None:
+                LOG.info("no more chunks to classify")
+                break
+
+            LOG.info(f"{self.worker}: classifying chunk {chunk['id']} ({len(chunk['citations'])} citations)")
+            done, lost = threading.Event(), threading.Event()
+            heartbeat = threading.Thread(target=self.keep_alive, args=(chunk["id"], done, lost), daemon=True)
+            heartbeat.start()
+            try:
+                results = []
+                for c_id, context in chunk["citations"]:
+                    if lost.is_set():
+                        break
+                    results.append((c_id, self.classify(context, c_id).name))
+            finally:
+                done.set()
+                heartbeat.join()
+
+            if lost.is_set():
+                LOG.warning(f"lease of chunk {chunk['id']} expired while classifying, moving on")
+                continue
+            self.queue.complete(chunk["id"], self.worker, results, self.provenance)
+            processed += 1
+        return processed